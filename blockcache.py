@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import os, time, errno, hashlib, logging, threading, collections
+
+import metrics
+from singleflight import SingleFlight
+
+
+class BlockCache(object):
+    """A size-capped on-disk cache of file content, in fixed-size blocks.
+
+    Blocks are keyed by resource ID, revision and block index, so that a new revision of a file
+    never sees the blocks of an old one. Missing blocks are fetched with a callable taking the
+    start and end offsets of a byte range. The least recently used blocks are evicted once the
+    cache holds more than max_bytes, and the order of use survives restarts through the block
+    files' modification times.
+    """
+
+    def __init__(self, directory, max_bytes, block_size=1048576):
+        "Class constructor."
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks = collections.OrderedDict()    ## Block sizes keyed by file name, least recently used first.
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._flights = SingleFlight(ttl=0)         ## Shares fetches of a block between concurrent readers.
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        self._scan()
+
+    def _scan(self):
+        "Index the blocks left by an earlier run, oldest first."
+        blocks = []
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            blocks.append((st.st_mtime, name, st.st_size))
+        blocks.sort()
+        with self._lock:
+            for mtime, name, size in blocks:
+                self._blocks[name] = size
+                self._bytes += size
+            self._evict()
+        logging.debug("Block cache holds %d blocks (%d bytes)" % (len(self._blocks), self._bytes))
+
+    def _getName(self, res_id, revision, index):
+        "Return the file name of a block."
+        return "%s-%d" % (hashlib.sha1("%s\0%s" % (res_id, revision)).hexdigest(), index)
+
+    def _evict(self):
+        "Remove the least recently used blocks until the cache fits. Called with the lock held."
+        while self._bytes > self._max_bytes and self._blocks:
+            name, size = self._blocks.popitem(last=False)
+            self._bytes -= size
+            self._evictions += 1
+            try:
+                os.remove(os.path.join(self._directory, name))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _get(self, name):
+        "Return the content of a cached block, or None."
+        with self._lock:
+            if name not in self._blocks:
+                return None
+            # Mark the block as most recently used.
+            self._blocks[name] = self._blocks.pop(name)
+        path = os.path.join(self._directory, name)
+        try:
+            f = open(path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            os.utime(path, None)
+        except (IOError, OSError):
+            # Evicted by another thread since we looked.
+            return None
+        return data
+
+    def _put(self, name, data):
+        "Store a block."
+        path = os.path.join(self._directory, name)
+        tmppath = "%s.%d.tmp" % (path, threading.current_thread().ident)
+        f = open(tmppath, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmppath, path)
+        with self._lock:
+            if name in self._blocks:
+                self._bytes -= self._blocks.pop(name)
+            self._blocks[name] = len(data)
+            self._bytes += len(data)
+            self._evict()
+
+    def _getBlock(self, res_id, revision, index, file_size, fetch):
+        "Return the content of a block, fetching it if it isn't cached."
+        name = self._getName(res_id, revision, index)
+        data = self._get(name)
+        if data is not None:
+            with self._lock:
+                self._hits += 1
+            metrics.increment("gdrive_block_cache_requests_total", result="hit")
+            return data
+        with self._lock:
+            self._misses += 1
+        metrics.increment("gdrive_block_cache_requests_total", result="miss")
+        return self._flights.do(("block", name), self._fill, name, index, file_size, fetch)
+
+    def _fill(self, name, index, file_size, fetch):
+        "Fetch a block and store it."
+        start = index * self._block_size
+        data = fetch(start, min(start + self._block_size, file_size))
+        self._put(name, data)
+        return data
+
+    def read(self, res_id, revision, file_size, offset, length, fetch):
+        "Read length bytes at offset from a file of the specified size and revision."
+        end = min(offset + length, file_size)
+        if offset >= end:
+            return ''
+        chunks = []
+        for index in xrange(offset // self._block_size, (end - 1) // self._block_size + 1):
+            data = self._getBlock(res_id, revision, index, file_size, fetch)
+            block_start = index * self._block_size
+            chunks.append(data[max(offset, block_start) - block_start:end - block_start])
+        return ''.join(chunks)
+
+    def peek(self, res_id, revision, file_size, offset, length):
+        "Return length bytes at offset if every block holding them is cached, or else None."
+        end = min(offset + length, file_size)
+        if offset >= end:
+            return ''
+        chunks = []
+        for index in xrange(offset // self._block_size, (end - 1) // self._block_size + 1):
+            data = self._get(self._getName(res_id, revision, index))
+            if data is None:
+                return None
+            block_start = index * self._block_size
+            chunks.append(data[max(offset, block_start) - block_start:end - block_start])
+        with self._lock:
+            self._hits += 1
+        metrics.increment("gdrive_block_cache_requests_total", result="hit")
+        return ''.join(chunks)
+
+    def prefetch(self, res_id, revision, file_size, index, fetch):
+        "Fetch a block ahead of it being read, unless it is already cached or being fetched."
+        name = self._getName(res_id, revision, index)
+        with self._lock:
+            if name in self._blocks:
+                return
+        metrics.increment("gdrive_block_cache_requests_total", result="prefetch")
+        # A reader wanting the block meanwhile waits for this fetch, rather than making its own.
+        self._flights.do(("block", name), self._fill, name, index, file_size, fetch)
+
+    def getBlockSize(self):
+        return self._block_size
+
+    def getStats(self):
+        "Return a dict of cache statistics."
+        with self._lock:
+            return { "hits": self._hits,
+                     "misses": self._misses,
+                     "evictions": self._evictions,
+                     "blocks": len(self._blocks),
+                     "bytes": self._bytes }
@@ -20,8 +20,10 @@ import sys
 import os
 import time
 import atexit
+import signal
 import logging
-from signal import SIGTERM
+import threading
+from signal import SIGTERM, SIGKILL
 
 from log import Formatter
 
@@ -32,6 +34,8 @@ from log import Formatter
 # To use, subclass the Daemon class and override the run() method.
 # See http://www.erlenstar.demon.co.uk/unix/faq_2.html#SEC16 for details.
 
+STOP_TIMEOUT = 60   # Seconds to wait for the daemon to shut down before killing it.
+
 class Daemon(object):
     "A generic Unix daemon class."
 
@@ -43,6 +47,7 @@ class Daemon(object):
             self._stdout = logfile
         self._stderr = self._stdout
         self._logger = None
+        self._stopping = threading.Event()  ## Set when the daemon has been asked to stop.
 
     def daemonise(self):
         "Daemonise the process."
@@ -78,6 +83,10 @@ class Daemon(object):
         pid = str(os.getpid())
         file(self._pidfile,'w+').write("%s\n" % pid)
 
+        # Shut down cooperatively on SIGTERM, without interrupting system calls in progress.
+        signal.signal(SIGTERM, self._handleSigterm)
+        signal.siginterrupt(SIGTERM, False)
+
         self._logger = logging.getLogger()
         if self._logger.handlers:
             for handler in self._logger.handlers:
@@ -97,7 +106,21 @@ class Daemon(object):
 
     def _deletePidFile(self):
         "Remove the pidfile."
-        os.remove(self._pidfile)
+        if os.path.exists(self._pidfile):
+            os.remove(self._pidfile)
+
+    def _handleSigterm(self, signum, frame):
+        "Signal handler for SIGTERM."
+        logging.info("Received SIGTERM, shutting down...")
+        self.shutdown()
+
+    def shutdown(self):
+        "Ask the daemon to stop. Subclasses may override this to stop any work in progress."
+        self._stopping.set()
+
+    def isStopping(self):
+        "Return True if the daemon has been asked to stop."
+        return self._stopping.is_set()
 
     def _getPid(self):
         "Return the pid of the running daemon process, or None."
@@ -136,9 +159,17 @@ class Daemon(object):
             sys.stderr.write("Daemon is not running.\n")
             return
         try:
-            while 1:
-                os.kill(pid, SIGTERM)
+            os.kill(pid, SIGTERM)
+            # Give the daemon a chance to finish in-flight work and save its state.
+            deadline = time.time() + STOP_TIMEOUT
+            while time.time() < deadline:
+                os.kill(pid, 0)
                 time.sleep(0.1)
+            sys.stderr.write("Daemon did not stop within %d seconds, killing it.\n" % STOP_TIMEOUT)
+            os.kill(pid, SIGKILL)
+            time.sleep(0.1)
+            if os.path.exists(self._pidfile):
+                os.remove(self._pidfile)
         except OSError, err:
             err = str(err)
             if err.find("No such process") > 0:
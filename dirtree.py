@@ -19,6 +19,7 @@
 
 # This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
 
+import shelve, logging, collections
 from UserDict import DictMixin
 
 
@@ -58,21 +59,36 @@ class _Node(dict):
     def numkeys(self):
         '''Return the number of keys in the subtree rooted at this node.'''
         numk = 0
-        if self.value is not _Null:
+        if self.value is not _Null and self.children:
             numk = sum(child.numkeys() for child in self.children.itervalues())
         return numk
 
+    def count(self):
+        '''Return the number of values below this node, not counting evicted subtrees.'''
+        if not self.children:
+            return 0
+        return sum(int(child.value is not _Null) + child.count() for child in self.children.itervalues())
+
     def __repr__(self):
         valstr = '_Null'
         if self.value is not _Null:
             valstr = repr(self.value)
+        if self.children is None:
+            return '(%s, <evicted>)' % valstr
         return '(%s, {%s})' % (valstr, ', '.join('%r: %r' % cstr for cstr in self.children.iteritems()))
 
     def __getstate__(self):
+        # Evicted nodes have no children in memory, and store the key of their subtree in the path.
+        if self.children is None:
+            return (self.value, None, self.path)
         return (self.value, self.children)
 
     def __setstate__(self, state):
-        self.value, self.children = state
+        self.path = None
+        if len(state) == 3:
+            self.value, self.children, self.path = state
+        else:
+            self.value, self.children = state
 
 
 class DirectoryTree(DictMixin, object):
@@ -92,12 +108,36 @@ class DirectoryTree(DictMixin, object):
     [('', '/'), ('/a/b/c/d', '/a/b/c/d'), ('/a/b/c/d/e', '/a/b/c/d/e'), ('/foo/bar', '/foo/bar')]
     >>> t.search("/a/b/c")
     ['/a/b/c/d', '/a/b/c/d/e']
+    >>> t.children("/a/b/c")
+    [('/a/b/c/d', '/a/b/c/d')]
+    >>> t.children("/a/b/c/x")
+    []
     """
 
+    # Subtrees rooted at this depth are the units of eviction (depth 1 is the root folder).
+    EVICT_DEPTH = 3
+
     def __init__(self, seq=None, **kwargs):
         self._root = _Node('/')
+        self._initStore()
         self.update(seq, **kwargs)
-    
+
+    def _initStore(self):
+        self._store = None                          # On-disk store of evicted subtrees, if any.
+        self._max_resident = 0                      # Maximum number of resident values, or 0 for no limit.
+        self._units = collections.OrderedDict()     # Maps keys of resident subtrees to [node, count], in LRU order.
+        self._resident = 0                          # Number of values in resident subtrees.
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __getstate__(self):
+        return { '_root': self._root }
+
+    def __setstate__(self, state):
+        self._root = state['_root']
+        self._initStore()
+
     def __len__(self):
         return self._root.numkeys()
 
@@ -116,26 +156,49 @@ class DirectoryTree(DictMixin, object):
 
     def __setitem__(self, key, value):
         node = self._root
-        for part in key.split('/'):
-            next_node = node.children.get(part)
+        unit = None
+        parts = key.split('/')
+        for depth, part in enumerate(parts):
+            children = self._getChildren(node, depth)
+            next_node = children.get(part)
             if next_node is None:
-                node = node.children.setdefault(part, _Node())
+                node = children.setdefault(part, _Node())
             else:
                 node = next_node
-        node.value = value
+            if depth + 1 == self.EVICT_DEPTH:
+                node.path = '/'.join(parts[:depth + 1])
+                unit = node
+        if self._store is not None:
+            if node.value is _Null and unit is not None and unit is not node:
+                self._units[unit.path][1] += 1
+                self._resident += 1
+            node.value = value
+            self._enforceLimit()
+        else:
+            node.value = value
 
     def __delitem__(self, key):
         parts = []
         node = self._root
-        for part in key.split('/'):
-            parts.append(node, part)
-            node = node.children.get(part)
+        unit = None
+        for depth, part in enumerate(key.split('/')):
+            parts.append((node, part))
+            node = self._getChildren(node, depth).get(part)
             if node is None:
                 break
+            if depth + 1 == self.EVICT_DEPTH:
+                unit = node
         if node is None or node.value is _Null:
             raise KeyError
         node.value = _Null
-        while node.value is _Null and not node.children and parts:
+        if unit is not None and unit is not node and unit.path in self._units:
+            self._units[unit.path][1] -= 1
+            self._resident -= 1
+        while node.value is _Null and node.children == {} and parts:
+            if node is unit:
+                # The whole subtree has gone.
+                if self._units.pop(unit.path, None) is not None and self._store is not None:
+                    self._store.pop(unit.path, None)
             node, part = parts.pop()
             del node.children[part]
 
@@ -151,12 +214,91 @@ class DirectoryTree(DictMixin, object):
 
     def _find(self, key):
         node = self._root
-        for part in key.split('/'):
-            node = node.children.get(part)
+        for depth, part in enumerate(key.split('/')):
+            node = self._getChildren(node, depth).get(part)
             if node is None:
                 break
         return node
 
+    def _getChildren(self, node, depth):
+        "Return the children of a node at the given depth, faulting them in from the store if necessary."
+        if depth == self.EVICT_DEPTH and self._store is not None:
+            if node.children is None:
+                self._misses += 1
+                node.children = self._store[node.path]
+                self._units[node.path] = [node, node.count()]
+                self._resident += self._units[node.path][1]
+                self._enforceLimit()
+            elif node.path in self._units:
+                self._hits += 1
+                self._units[node.path] = self._units.pop(node.path)
+            else:
+                # A new subtree.
+                self._units[node.path] = [node, node.count()]
+                self._resident += self._units[node.path][1]
+        return node.children
+
+    def _enforceLimit(self):
+        "Evict the least recently used subtrees until the resident values are within the limit."
+        # The most recently used subtree is never evicted, since it may be in use.
+        while self._max_resident and self._resident > self._max_resident and len(self._units) > 1:
+            key, (node, count) = self._units.popitem(last=False)
+            self._store[key] = node.children
+            node.children = None
+            self._resident -= count
+            self._evictions += 1
+
+    def hasEvicted(self):
+        "Return True if any subtrees are held in the store rather than in memory."
+        def evicted(node, depth):
+            if node.children is None:
+                return True
+            if depth == self.EVICT_DEPTH:
+                return False
+            return any(evicted(child, depth + 1) for child in node.children.itervalues())
+        return evicted(self._root, 0)
+
+    def setStore(self, path, max_resident):
+        """Keep at most max_resident values in memory, evicting cold subtrees to a store at the specified path.
+           With max_resident 0 nothing more is evicted, but subtrees evicted earlier can still be faulted in."""
+        if self.hasEvicted():
+            self._store = shelve.open(path, 'c', protocol=2)
+        else:
+            # Nothing refers to an existing store, so start it afresh.
+            self._store = shelve.open(path, 'n', protocol=2)
+        self._max_resident = max_resident
+        # Register the subtrees that are already resident.
+        def register(node, parts, depth):
+            if depth == self.EVICT_DEPTH:
+                node.path = '/'.join(parts)
+                if node.children is not None:
+                    self._units[node.path] = [node, node.count()]
+                    self._resident += self._units[node.path][1]
+                return
+            for part, child in (node.children or {}).iteritems():
+                register(child, parts + [part], depth + 1)
+        register(self._root, [], 0)
+        self._enforceLimit()
+
+    def sync(self):
+        "Write any evicted subtrees to disk."
+        if self._store is not None:
+            self._store.sync()
+
+    def close(self):
+        "Write any evicted subtrees to disk, and close the store. Evicted subtrees cannot be read after this."
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def getStats(self):
+        "Return a dict of resident value and store hit/miss statistics."
+        return { "resident": self._resident,
+                 "subtrees": len(self._units),
+                 "hits": self._hits,
+                 "misses": self._misses,
+                 "evictions": self._evictions }
+
     def keys(self, prefix=None):
         "Return a list of the trie keys."
         return list(self.iterkeys(prefix))
@@ -177,7 +319,7 @@ class DirectoryTree(DictMixin, object):
         def generator(node, parts=parts):
             if node.value is not _Null:
                 yield ('/'.join(parts), node.value)
-            for part, child in node.children.iteritems():
+            for part, child in self._getChildren(node, len(parts)).items():
                 parts.append(part)
                 for subresult in generator(child):
                     yield subresult
@@ -186,8 +328,8 @@ class DirectoryTree(DictMixin, object):
         node = self._root
         if prefix is not None:
             for part in prefix.split('/'):
+                node = self._getChildren(node, len(parts)).get(part)
                 parts.append(part)
-                node = node.children.get(part)
                 if node is None:
                     node = _Node()
                     break
@@ -212,7 +354,73 @@ class DirectoryTree(DictMixin, object):
     def search(self, prefix=None):
         "Return a list of keys in the trie matching the supplied prefix."
         return list(self.iterkeys(prefix))
-        
+
+    def children(self, prefix):
+        "Return a list of the (key, value) tuples immediately below the supplied prefix."
+        node = self._find(prefix)
+        if node is None:
+            return []
+        children = self._getChildren(node, len(prefix.split('/')))
+        return [('%s/%s' % (prefix, part), child.value) for part, child in children.iteritems() if child.value is not _Null]
+
+
+class StoredDict(DictMixin, object):
+    """A dict held on disk in a shelve, for maps too large to keep in memory. Keys must be strings.
+    Pickling it only records the path of the shelve, which must have been synced first.
+
+    >>> import tempfile, os, pickle
+    >>> path = os.path.join(tempfile.mkdtemp(), 'store')
+    >>> d = StoredDict(path, { 'a': 1 })
+    >>> d['b'] = 2
+    >>> d = pickle.loads(pickle.dumps(d))
+    >>> sorted(d.items())
+    [('a', 1), ('b', 2)]
+    >>> d.pop('a')
+    1
+    >>> d.get('a')
+    """
+
+    def __init__(self, path, items=None):
+        self._path = path
+        self._shelf = shelve.open(path, 'n', protocol=2)
+        if items:
+            self.update(items)
+
+    def __getstate__(self):
+        self._shelf.sync()
+        return { '_path': self._path }
+
+    def __setstate__(self, state):
+        self._path = state['_path']
+        self._shelf = shelve.open(self._path, 'c', protocol=2)
+
+    def __getitem__(self, key):
+        return self._shelf[str(key)]
+
+    def __setitem__(self, key, value):
+        self._shelf[str(key)] = value
+
+    def __delitem__(self, key):
+        del self._shelf[str(key)]
+
+    def __contains__(self, key):
+        return str(key) in self._shelf
+
+    def __len__(self):
+        return len(self._shelf)
+
+    def keys(self):
+        return self._shelf.keys()
+
+    def sync(self):
+        "Write any changes to disk."
+        self._shelf.sync()
+
+    def close(self):
+        "Close the shelve."
+        self._shelf.close()
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
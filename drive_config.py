@@ -16,7 +16,7 @@
 
 # This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
 
-import os, sys, logging, shutil, csv, ConfigParser, stat
+import os, sys, logging, csv, ConfigParser
 
 from log import Formatter
 
@@ -48,17 +48,37 @@ class DriveConfig(object):
     
     CONFIG_DIR = '.config/%s' % CLIENT_ID   # Configuration directory.
     TOKEN_FILE = 'token.txt'                # Token blob file name. 
+    ACCESS_TOKEN_FILE = 'access_token.json' # Cached access token file name.
     METADATA_FILE = 'metadata.dat'          # Metadata file name.
     CONFIG_FILE = 'gdrive.cfg'              # Configuration file name.
     PID_FILE = 'drived.pid'                 # PID file name.
     LOG_FILE = 'drived.log'                 # Log file name.
-    MAX_RESULTS = 500                       # Maximum results to return per request.
+    SOCKET_FILE = 'drived.sock'             # Daemon query socket file name.
+    MOUNT_SOCKET_FILE = 'gdfs.sock'         # FUSE mount query socket file name.
+    QUEUE_FILE = 'queue.journal'            # Pending operation journal file name.
+    STORE_FILE = 'metadata.store'           # Evicted metadata store file name.
+    ID_STORE_FILE = 'metadata.ids'          # Resource ID map store file name, when memory is limited.
+    TRACE_FILE = 'fuse_trace.txt'           # Filesystem call latency dump file name.
+    STAGING_DIR = 'staging'                 # Directory of files written through the mount, awaiting upload.
+    BLOCK_DIR = 'blocks'                    # File content cache directory name.
+    ENTRY_SIZE = 2048                       # Approximate memory used by one cached metadata entry, in bytes.
     
     # URI to get the root feed. 
     ROOT_FEED_URI = "/feeds/default/private/full/folder%3Aroot/contents"
 
     # The href of the root folder. If a resource parent is this, then it lives in the root folder.
     ROOT_FOLDER_HREF = "https://docs.google.com/feeds/default/private/full/folder%3Aroot"
+
+    # URI to create resumable uploads in the root folder.
+    ROOT_UPLOAD_URI = "https://docs.google.com/feeds/upload/create-session/default/private/full"
+
+    # Partial response field selections, asking for only the parts of feeds that the metadata uses.
+    # Listing entries keep their revisions feed link, which GetRevisions needs to describe a file.
+    LISTING_FIELDS = ("@gd:etag,link[@rel='next'],"
+                      "entry(title,content,gd:resourceId,gd:quotaBytesUsed,"
+                      "category[@scheme='http://schemas.google.com/g/2005#kind'],"
+                      "gd:feedLink[@rel='http://schemas.google.com/docs/2007/revisions'])")
+    CHANGES_FIELDS = "link[@rel='next'],entry(gd:resourceId,docs:changestamp)"
     
     # Default configuration values, for user-configurable options. 
     CONFIG_DEFAULTS = { 
@@ -67,17 +87,44 @@ class DriveConfig(object):
         }, 
         "general": { 
             "excludes": "",             # A comma-delimited list of strings specifying paths to be ignored.
+            "concurrency": "16",        # Maximum number of concurrent API requests when the daemon or file system walks the tree.
+            "connections": "16",        # Maximum number of open connections to any one host.
+            "page_size": "1000",        # Number of entries to request per page of a feed.
+            "projection": "true",       # Request only the feed fields that the metadata uses.
+            "rate": "10",               # API request budget for the process, in requests per second (0 for none).
         },
         "logging": {
             "level": "NONE"             # Sets the log-level (NONE, DEBUG, INFO, WARN, ERROR).
+        },
+        "daemon": {
+            "accounts": "",             # A comma-delimited list of accounts served by the daemon.
+            "workers": "4",             # Number of transfer workers shared by all accounts.
+            "bandwidth": "0",           # Aggregate transfer rate limit in bytes per second (0 for none).
+            "metrics_port": "0",        # Port for the Prometheus metrics endpoint on localhost (0 for none).
+            "stats_file": "",           # Path of a file to write metrics to periodically, if any.
+            "memory_limit": "0"         # Approximate ceiling for cached metadata in memory, in MiB (0 for none).
+        },
+        "fuse": {
+            "cache_size": "1024",       # Size of the on-disk file content cache, in MiB.
+            "block_size": "1024",       # Size of the blocks that file content is cached in, in KiB.
+            "refresh_interval": "60",   # Seconds between background metadata refreshes from the change feed.
+            "readahead": "8192",        # Largest window prefetched ahead of a sequential reader, in KiB.
+            "prefetch_threads": "4",    # Number of threads prefetching file content.
+            "trace": "false",           # Record latency histograms of filesystem calls, dumped on SIGUSR1.
+            "trace_sample": "10",       # Trace one in this many filesystem calls.
+            "upload_delay": "2"         # Seconds without a file being saved before uploads of saved files start.
         }
     }
 
-    def __init__(self, verbose=False, debug=False, logger=None):
+    # Options holding comma-delimited lists.
+    LIST_OPTIONS = ("excludes", "accounts")
+
+    def __init__(self, verbose=False, debug=False, logger=None, account=None):
         "Class constructor."
         
         self._verbose = verbose
         self._debug = debug
+        self._account = account # Account name, or None for the default account.
         self._config = {}       # Configuration dict.
         self._logger = logger   # Supplied logger overrides.
         
@@ -112,6 +159,9 @@ class DriveConfig(object):
     def getConfigDir(self):
         "Find (create if necessary) the configuration directory."
         cfgdir = os.path.join(self.getHomeDir(), self.CONFIG_DIR)
+        if self._account:
+            # Each additional account keeps its own token, metadata and configuration.
+            cfgdir = os.path.join(cfgdir, self._account)
         if os.path.exists(cfgdir):
             if not os.path.isdir(cfgdir):
                 sys.exit("Error: \"%s\" exists but is not a directory!" % cfgdir)
@@ -130,15 +180,44 @@ class DriveConfig(object):
     def getTokenFile(self):
         return self.getConfigFile(self.TOKEN_FILE)
 
+    def getAccessTokenFile(self):
+        return self.getConfigFile(self.ACCESS_TOKEN_FILE)
+
     def getMetadataFile(self):
         return self.getConfigFile(self.METADATA_FILE)
 
+    def getStoreFile(self):
+        return self.getConfigFile(self.STORE_FILE)
+
+    def getIdStoreFile(self):
+        return self.getConfigFile(self.ID_STORE_FILE)
+
+    def getQueueFile(self):
+        return self.getConfigFile(self.QUEUE_FILE)
+
     def getPidFile(self):
         return self.getConfigFile(self.PID_FILE)
 
     def getLogFile(self):
         return self.getConfigFile(self.LOG_FILE)
 
+    def getTraceFile(self):
+        return self.getConfigFile(self.TRACE_FILE)
+
+    def getBlockCacheDir(self):
+        # Like the socket, a directory is not a regular configuration file.
+        return os.path.join(self.getConfigDir(), self.BLOCK_DIR)
+
+    def getStagingDir(self):
+        return os.path.join(self.getConfigDir(), self.STAGING_DIR)
+
+    def getSocketFile(self):
+        # The socket is not a regular file, so getConfigFile() would reject it.
+        return os.path.join(self.getConfigDir(), self.SOCKET_FILE)
+
+    def getMountSocketFile(self):
+        return os.path.join(self.getConfigDir(), self.MOUNT_SOCKET_FILE)
+
     def defaultConfig(self):
         logging.debug("Using default configuration...")
         self._config = self.CONFIG_DEFAULTS.copy()
@@ -158,7 +237,7 @@ class DriveConfig(object):
                 self._config[section] = {}
                 options = config.options(section)
                 for option in options:
-                    if option == "excludes":
+                    if option in self.LIST_OPTIONS:
                         exclist = []
                         parser = csv.reader(config.get(section, option), skipinitialspace=True)
                         for fields in parser:
@@ -182,7 +261,7 @@ class DriveConfig(object):
             for section in self._config:
                 config.add_section(section)
                 for option in self._config[section]:
-                    if option == "excludes":
+                    if option in self.LIST_OPTIONS:
                         if self._config[section][option]:
                             excstr = ', '.join(self._config[section][option])
                             config.set(section, option, excstr)
@@ -267,6 +346,96 @@ class DriveConfig(object):
         except KeyError:
             return None
 
+    def _getOption(self, section, option):
+        "Get a configuration option, falling back to the default value."
+        try:
+            return self._config[section][option]
+        except KeyError:
+            return self.CONFIG_DEFAULTS[section][option]
+
+    def getConcurrency(self):
+        "Get the maximum number of concurrent API requests."
+        return int(self._getOption("general", "concurrency"))
+
+    def getPageSize(self):
+        "Get the number of entries to request per page of a feed."
+        return int(self._getOption("general", "page_size"))
+
+    def getProjection(self):
+        "Return True if feeds should be requested with only the fields that the metadata uses."
+        return self._getOption("general", "projection").lower() in ("true", "yes", "on", "1")
+
+    def getRequestRate(self):
+        "Get the API request budget for the process, in requests per second."
+        return float(self._getOption("general", "rate"))
+
+    def getBlockCacheSize(self):
+        "Get the size of the on-disk file content cache, in bytes."
+        return int(self._getOption("fuse", "cache_size")) * 1024 * 1024
+
+    def getBlockSize(self):
+        "Get the size of the blocks that file content is cached in, in bytes."
+        return int(self._getOption("fuse", "block_size")) * 1024
+
+    def getRefreshInterval(self):
+        "Get the number of seconds between background metadata refreshes of a mounted drive."
+        return int(self._getOption("fuse", "refresh_interval"))
+
+    def getReadAheadSize(self):
+        "Get the largest window of file content prefetched ahead of a sequential reader, in bytes."
+        return int(self._getOption("fuse", "readahead")) * 1024
+
+    def getPrefetchThreads(self):
+        "Get the number of threads prefetching file content."
+        return int(self._getOption("fuse", "prefetch_threads"))
+
+    def getTrace(self):
+        "Return True if filesystem calls should be traced."
+        return self._getOption("fuse", "trace").lower() in ("true", "yes", "on", "1")
+
+    def getTraceSampleInterval(self):
+        "Get the number of filesystem calls for each one traced."
+        return int(self._getOption("fuse", "trace_sample"))
+
+    def getUploadDelay(self):
+        "Get the number of seconds without a file being saved through the mount before uploads start."
+        return float(self._getOption("fuse", "upload_delay"))
+
+    def getMaxConnections(self):
+        "Get the maximum number of open connections to any one host."
+        return int(self._getOption("general", "connections"))
+
+    def getMaxResidentEntries(self):
+        "Get the maximum number of metadata entries to keep in memory, or zero for no limit."
+        return int(self._getOption("daemon", "memory_limit")) * 1024 * 1024 / self.ENTRY_SIZE
+
+    def getAccount(self):
+        "Get the account name, or None for the default account."
+        return self._account
+
+    def getAccounts(self):
+        "Get the list of accounts served by the daemon."
+        accounts = self._getOption("daemon", "accounts")
+        if isinstance(accounts, str):
+            accounts = [account.strip() for account in accounts.split(',') if account.strip()]
+        return accounts
+
+    def getWorkers(self):
+        "Get the number of transfer workers."
+        return int(self._getOption("daemon", "workers"))
+
+    def getBandwidth(self):
+        "Get the aggregate transfer rate limit, in bytes per second."
+        return int(self._getOption("daemon", "bandwidth"))
+
+    def getMetricsPort(self):
+        "Get the port for the metrics endpoint, or zero if it is disabled."
+        return int(self._getOption("daemon", "metrics_port"))
+
+    def getStatsFile(self):
+        "Get the path of the metrics stats file, if any."
+        return self._getOption("daemon", "stats_file")
+
     def checkLocalFile(self, path, overwrite=False):
         "Return True if it is safe to write to the specified file."
         if not os.path.exists(path):
@@ -284,9 +453,9 @@ class DriveConfig(object):
         return True
 
     def checkLocalFolder(self, path, overwrite=False):
-        "Return True if it is safe to write to the specified folder."
+        """Return True if it is safe to write to the specified folder. The folder is not changed here:
+           if it exists and overwrite is False, the caller must replace it."""
         if not os.path.exists(path):
-            os.mkdir(path)
             return True
         if not os.path.isdir(path):
             # TODO: handle this?
@@ -296,10 +465,6 @@ class DriveConfig(object):
             answer = raw_input("Local folder \"%s\" already exists, overwrite? (y/N):" % path)
             if answer.upper() != 'Y':
                 return False
-            logging.debug("Removing \"%s\"..." % path)
-            shutil.rmtree(path)
-            os.mkdir(path)
-            os.chmod(path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
         return True
 
     def getLogger(self):
@@ -16,16 +16,89 @@
 
 # This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
 
-import os, sys, time, logging
+import os, sys, time, logging, threading
 
 from gdata.client import Error
 
 import daemon
+import ipc
+import metrics
 from gdocs import Session
+from retry import isTransient
+from transfer import TransferPool
 from drive_config import DriveConfig
 
-UPDATE_INTERVAL = 30    # Sync update interval in seconds.
-RETRY_INTERVAL = 60     # Retry interval in seconds.
+UPDATE_INTERVAL = 30        # Initial sync update interval in seconds.
+MIN_UPDATE_INTERVAL = 15    # Update interval used after activity, in seconds.
+MAX_UPDATE_INTERVAL = 600   # Ceiling for the update interval while idle, in seconds.
+BACKOFF_FACTOR = 2          # Idle update interval growth factor.
+RETRY_INTERVAL = 60         # Retry interval in seconds.
+STATS_INTERVAL = 10         # Interval between writes of the stats file, in seconds.
+
+class AccountSync(threading.Thread):
+    "Poll loop keeping the local copy of one account in sync."
+
+    def __init__(self, account, logger, transfers):
+        "Class constructor."
+        name = "sync-%s" % account if account else "sync"
+        super(AccountSync, self).__init__(name=name)
+        self.daemon = True
+        self.account = account
+        self.session = None
+        self.lock = threading.Lock()    ## Guards the session attribute, which the query server reads.
+        self._logger = logger
+        self._transfers = transfers
+        self._stopping = threading.Event()
+
+    def run(self):
+        "Run the poll loop."
+        logging.debug("Creating session for account %s..." % self.account)
+        session = Session(logger=self._logger, account=self.account, transfers=self._transfers, background=True,
+                          concurrent=True)
+        if session == None:
+            logging.error("Could not create Google Docs session for account %s!" % self.account)
+            return
+        with self.lock:
+            self.session = session
+            if self._stopping.is_set():
+                session.requestStop()
+
+        interval = UPDATE_INTERVAL
+        while not self._stopping.is_set():
+            logging.debug("Poll loop for account %s..." % self.account)
+            try:
+                # Probe the largest changestamp first, it is much cheaper than a full update.
+                # The session is thread-safe, so queries are answered while this runs.
+                with metrics.timer("gdrive_sync_cycle_seconds", account=self.account or "default"):
+                    changed = session.hasPendingWork() or session.hasChanges()
+                    if changed:
+                        session.update(download=True, interactive=False)
+                if changed:
+                    interval = MIN_UPDATE_INTERVAL
+                else:
+                    interval = min(interval * BACKOFF_FACTOR, MAX_UPDATE_INTERVAL)
+                    logging.debug("No changes for account %s, next poll in %d seconds" % (self.account, interval))
+                self._stopping.wait(interval)
+            except Error:
+                logging.exception("Google Docs exception:")
+                self._stopping.wait(RETRY_INTERVAL)
+            except Exception, e:
+                if not isTransient(e):
+                    logging.exception("Daemon exception:")
+                    break
+                # A network outage outlasted the retries, so wait for it to pass.
+                logging.error("Network error for account %s: %s" % (self.account, e))
+                self._stopping.wait(RETRY_INTERVAL)
+        session.close()
+
+    def stop(self):
+        "Stop taking new work, and let the session finish the transfer in progress."
+        self._stopping.set()
+        # The session is created by the poll loop, so it may not exist yet.
+        session = self.session
+        if session:
+            session.requestStop()
+
 
 class DriveDaemon(daemon.Daemon, object):
     "Google Drive daemon class."
@@ -33,6 +106,9 @@ class DriveDaemon(daemon.Daemon, object):
     def __init__(self):
         "Class constructor."
         config = DriveConfig()
+        self._config = config
+        self._accounts = []
+        self._socketfile = config.getSocketFile()
         pidfile = config.getPidFile()
         loglevel = config.getLogLevel()
         logfile = config.getLogFile()
@@ -40,22 +116,52 @@ class DriveDaemon(daemon.Daemon, object):
 
     def run(self):
         "Run the daemon."
-        
-        logging.debug("Creating session...")
-        session = Session(logger=self._logger)
-        if session == None:
-            sys.exit("Error, could not create Google Docs session!")
 
-        while True:
-            logging.debug("Daemon poll loop...")
-            try:
-                session.update(download=True, interactive=False)
-                time.sleep(UPDATE_INTERVAL)
-            except Error:
-                logging.exception("Google Docs exception:")
-                time.sleep(RETRY_INTERVAL)
-            except Exception:
-                logging.exception("Daemon exception:")
-                break
+        # All accounts share one pool of transfer workers and one bandwidth budget.
+        transfers = TransferPool(self._config.getWorkers(), self._config.getBandwidth())
+        metrics.setGauge("gdrive_transfer_queue_depth", transfers.getQueueDepth)
+
+        metrics_server = None
+        if self._config.getMetricsPort():
+            metrics_server = metrics.MetricsServer(self._config.getMetricsPort(), metrics.registry)
+            metrics_server.start()
+        statsfile = self._config.getStatsFile()
 
+        accounts = self._config.getAccounts()
+        if not accounts:
+            accounts = [None]
+        for account in accounts:
+            self._accounts.append(AccountSync(account, self._logger, transfers))
+
+        # Serve metadata queries from the command line client.
+        server = ipc.QueryServer(self._socketfile, self._accounts)
+        server.start()
+
+        for sync in self._accounts:
+            sync.start()
+
+        # Signals are only delivered to the main thread, so it just waits here.
+        last_stats = 0
+        while not self.isStopping() and any(sync.is_alive() for sync in self._accounts):
+            if statsfile and time.time() - last_stats >= STATS_INTERVAL:
+                metrics.registry.writeStatsFile(statsfile)
+                last_stats = time.time()
+            self._stopping.wait(1)
+
+        for sync in self._accounts:
+            sync.stop()
+        for sync in self._accounts:
+            sync.join()
+        transfers.stop()
+        server.stop()
+        if metrics_server:
+            metrics_server.stop()
+        if statsfile:
+            metrics.registry.writeStatsFile(statsfile)
         logging.debug("Daemon exiting...")
+
+    def shutdown(self):
+        "Stop taking new work, and let the sessions finish the transfers in progress."
+        super(DriveDaemon, self).shutdown()
+        for sync in self._accounts:
+            sync.stop()
@@ -20,11 +20,21 @@ import stat
 import errno
 import os
 import time
+import calendar
+import threading
+import logging
 
 import fuse
 from fuse import Fuse
 
 import gdocs
+import ipc
+import ratelimit
+import tracing
+from drive_config import DriveConfig
+from blockcache import BlockCache
+from readahead import Prefetcher, ReadAhead
+from writeback import WriteBack, StagedFile
 
 fuse.fuse_python_api = (0, 2)
 
@@ -48,52 +58,198 @@ class GDriveFs(Fuse):
         Fuse.__init__(self, *args, **kwargs)
         self._uid = os.getuid()
         self._gid = os.getgid()
-        self._session = gdocs.Session(verbose=True, debug=True)
+        self._mounted = time.time()     ## Mount time, for items with no modification time.
+        self._session = None            ## Drive session, created in fsinit.
+        self._cache = None              ## On-disk block cache, created in fsinit.
+        self._prefetcher = None         ## Fetches file content ahead of sequential readers.
+        self._readahead = 0             ## Largest read-ahead window, in bytes.
+        self._refresher = None          ## Background metadata refresh thread.
+        self._writeback = None          ## Stages written files, and uploads them in the background.
+        self._queries = None            ## Answers queries from the command line client, e.g. about failed uploads.
+
+    def fsinit(self):
+        "Set up the session once mounted, after FUSE has forked into the background."
+        self._session = gdocs.Session(verbose=True, debug=True, concurrent=True)
+        config = self._session.getConfig()
+        self._cache = BlockCache(config.getBlockCacheDir(), config.getBlockCacheSize(), config.getBlockSize())
+        self._prefetcher = Prefetcher(config.getPrefetchThreads())
+        self._readahead = config.getReadAheadSize()
+        self._writeback = WriteBack(self._session, config.getStagingDir(), config.getUploadDelay())
+        self._writeback.start()
+        self._refresher = threading.Thread(target=self._refresh, args=(config.getRefreshInterval(),))
+        self._refresher.daemon = True
+        self._refresher.start()
+        self._queries = ipc.QueryServer(config.getMountSocketFile(), [ipc.Account(None, self._session)])
+        self._queries.start()
+
+    def fsdestroy(self):
+        "Stop the background refresh and uploads on unmount."
+        if self._session != None:
+            self._queries.stop()
+            self._session.requestStop()
+            self._writeback.stop()
+            self._refresher.join()
+            self._session.close()
+
+    def _refresh(self, interval):
+        "Keep the cached metadata up to date with the change feed."
+        # Refreshing must give way to the requests of processes reading the mount.
+        with ratelimit.lane(ratelimit.BACKGROUND):
+            while True:
+                try:
+                    if self._session.hasChanges():
+                        self._session.refresh()
+                except Exception, e:
+                    logging.error("Metadata refresh failed: %s" % e)
+                if self._session.waitForStop(interval):
+                    break
+
+    def _getModifiedTime(self, item):
+        "Return the modification time of an item, as seconds since the epoch."
+        updated = item.get("updated")
+        if not updated:
+            return self._mounted
+        try:
+            # e.g. 2012-04-13T10:11:12.000Z, always UTC.
+            return calendar.timegm(time.strptime(updated[:19], "%Y-%m-%dT%H:%M:%S"))
+        except ValueError:
+            return self._mounted
 
     def getattr(self, path):
-        "Get path attributes."
-        print "getattr(%s)" % (path)
+        "Get path attributes from the cached metadata."
         st = MyStat()
         st.st_uid = self._uid
         st.st_gid = self._gid
         if path == '/':
             st.st_mode = stat.S_IFDIR | 0755
             st.st_nlink = 2
-        else:
-            if self._session.isFolder(path):
-                st.st_mode = stat.S_IFDIR | 0755
-                st.st_nlink = 2
-            elif self._session.isFile(path):
-                st.st_mode = stat.S_IFREG | 0444
+            st.st_atime = st.st_mtime = st.st_ctime = self._mounted
+            return st
+        item = self._session.getItem(path)
+        localpath = self._writeback.getLocalFile(path)
+        if localpath != None:
+            # Changes not yet uploaded take precedence over the cached metadata.
+            try:
+                local = os.stat(localpath)
+            except OSError:
+                local = None
+            if local != None:
+                st.st_mode = stat.S_IFREG | 0644
                 st.st_nlink = 1
-                st.st_size = self._session.getFileSize(path)
-            else:
-                return -errno.ENOENT
+                st.st_size = local.st_size
+                st.st_atime = st.st_mtime = st.st_ctime = local.st_mtime
+                return st
+        if item == None:
+            return -errno.ENOENT
+        if item["type"] == "folder":
+            st.st_mode = stat.S_IFDIR | 0755
+            st.st_nlink = 2
+        else:
+            st.st_mode = stat.S_IFREG | 0644
+            st.st_nlink = 1
+            st.st_size = int(item.get("size") or 0)
+        st.st_atime = st.st_mtime = st.st_ctime = self._getModifiedTime(item)
         return st
 
     def readdir(self, path, offset):
-        "Generator for the contents of a directory."
-        print "readdir(%s,%s)" % (path, offset)
-        folders, files = self._session.readFolder(path)
+        "Generator for the contents of a directory, from the cached metadata."
+        folders, files = self._session.listFolder(path)
         items = [ '/.', '/..' ]
         items.extend(folders)
         items.extend(files)
+        # Include new files that haven't been uploaded yet.
+        items.extend(p for p in self._writeback.listFolder(path) if p not in files)
         for r in  items:
-            print "Yielding", r
-            # Pathnames are prefixed with '/'
-            yield fuse.Direntry(r[1:])
+            # Yield the basename of each path.
+            yield fuse.Direntry(os.path.basename(r))
 
-    def open(self, path, flags):    
-        "Open file."
-        print "open(%s,%s)" % (path, flags)
+    def _openItem(self, item):
+        "Return the read-ahead state for a newly opened file."
+        uri = item["uri"]
+        # A new revision has a new checksum, so it never sees blocks cached for an old one.
+        revision = item.get("md5checksum") or item.get("updated", "")
+        return ReadAhead(self._cache, self._prefetcher, item["resource_id"], revision, int(item["size"]),
+                         lambda start, end: self._session.fetchRange(uri, start, end), self._readahead)
+
+    def _openWrite(self, path, flags):
+        "Return a handle on a working copy of a file, or an error number."
+        item = self._session.getItem(path)
+        if item != None and item["type"] == "folder":
+            return -errno.EISDIR
+        if item == None and self._writeback.getLocalFile(path) == None:
+            return -errno.ENOENT
+        try:
+            return self._writeback.open(path, (flags & os.O_TRUNC) != 0, item)
+        except Exception, e:
+            logging.error("open(%s) failed: %s" % (path, e))
+            return -errno.EIO
+
+    def open(self, path, flags):
+        "Open file, returning the state kept for each open handle."
         accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
         if (flags & accmode) != os.O_RDONLY:
-            return -errno.EACCES
+            # Writes go to a local copy, uploaded once the file is closed.
+            return self._openWrite(path, flags)
+        handle = self._writeback.openRead(path)
+        if handle != None:
+            return handle
+        item = self._session.getItem(path)
+        if item == None:
+            return -errno.ENOENT
+        if item["type"] == "folder":
+            return -errno.EISDIR
+        return self._openItem(item)
+
+    def create(self, path, flags, mode):
+        "Create and open a new file."
+        parent = os.path.dirname(path)
+        if parent != '/' and not self._session.isFolder(parent):
+            return -errno.ENOENT
+        return self._writeback.open(path, True, None)
+
+    def write(self, path, buf, offset, fh=None):
+        "Write file."
+        if not isinstance(fh, StagedFile):
+            return -errno.EBADF
+        return fh.write(buf, offset)
+
+    def truncate(self, path, length):
+        "Truncate a file that isn't open."
+        handle = self._openWrite(path, os.O_WRONLY)
+        if not isinstance(handle, StagedFile):
+            return handle
+        handle.truncate(length)
+        self._writeback.release(handle)
 
-    def read(self, path, size, offset):
+    def ftruncate(self, path, length, fh=None):
+        "Truncate an open file."
+        if not isinstance(fh, StagedFile):
+            return -errno.EBADF
+        fh.truncate(length)
+
+    def read(self, path, size, offset, fh=None):
         "Read file."
-        print "read(%s,%s,%s)" % (path, size, offset)
-        return -errno.ENOENT
+        if fh == None:
+            item = self._session.getItem(path)
+            if item == None:
+                return -errno.ENOENT
+            if item["type"] == "folder":
+                return -errno.EISDIR
+            fh = self._openItem(item)
+        try:
+            return fh.read(offset, size)
+        except Exception, e:
+            logging.error("read(%s) failed: %s" % (path, e))
+            return -errno.EIO
+
+    def release(self, path, flags, fh=None):
+        "Close file, queueing the upload of any changes."
+        if isinstance(fh, StagedFile):
+            self._writeback.release(fh)
+
+    def getCacheStats(self):
+        "Return the block cache hit/miss statistics."
+        return self._cache.getStats()
 
 def main():
     usage="""
@@ -104,8 +260,15 @@ GDriveFs - Google Drive Filesystem
     fs = GDriveFs(version="%prog " + fuse.__version__, usage=usage, dash_s_do='setsingle')
 
     fs.flags = 0
-    fs.multithreaded = 0
+    # Callbacks are answered from the cached metadata, so slow reads don't hold up other callers.
+    fs.multithreaded = 1
     fs.parse(errex=1)
+    config = DriveConfig()
+    if config.getTrace():
+        # Tracing replaces the methods on the instance, so it costs nothing unless enabled.
+        tracer = tracing.Tracer(config.getTraceSampleInterval())
+        tracer.instrument(fs, ("getattr", "readdir", "open", "read", "write"))
+        tracer.installSignalHandler(config.getTraceFile())
     fs.main()
 
 if __name__ == '__main__':
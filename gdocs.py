@@ -16,49 +16,124 @@
 
 # This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
 
-import os, sys, logging, pickle, pprint, stat, hashlib, random, time
+import os, sys, errno, logging, pickle, pprint, stat, hashlib, time, threading, shutil
 
 import gdata.gauth
 import gdata.client
 import gdata.docs.client
+import gdata.docs.data
+import atom.http_core
 
 from drive_config import DriveConfig
-from dirtree import DirectoryTree
+from dirtree import DirectoryTree, StoredDict
+from workqueue import WorkQueue
+from syncengine import SyncEngine
+from retry import RetryPolicy, isTransient
+from httppool import PooledHttpClient
+from singleflight import SingleFlight
+from tokenmanager import TokenManager
 import progressbar
+import mimetype
+import transfer
+import ratelimit
+import metrics
 
 
-class Session(object):
+class _Progress(object):
+    "Counts the folders and files done by one download or upload, for logging and the progress bar."
 
-    def __init__(self, verbose=False, debug=False, logger=None):
+    def __init__(self, num_folders, num_files, interactive):
         "Class constructor."
+        self._lock = threading.Lock()
+        self.num_folders = num_folders
+        self.num_files = num_files
+        self.folder_count = 1
+        self.file_count = 1
+        self._bar = None
+        if interactive and num_folders + num_files > 2:
+            self._bar = progressbar.ProgressBar(width=80)
+
+    def folderDone(self):
+        with self._lock:
+            self.folder_count += 1
+
+    def fileDone(self):
+        with self._lock:
+            self.file_count += 1
+
+    def render(self, message):
+        "Show the progress made so far, if a progress bar is shown."
+        with self._lock:
+            if self._bar:
+                self._bar.render(self.file_count * 100 / max(self.num_files, 1), message)
+
+
+class Session(object):
+
+    PARTIAL_SUFFIX = ".gdrive-part"     # Suffix for files that are still being downloaded.
+    FOLDER_OPERATIONS = ("delete", "mkdir")         # Queued operations on local folders, run before transfers.
+    TRANSFER_OPERATIONS = ("download", "upload")    # Queued operations that are run on the transfer pool.
+
+    def __init__(self, verbose=False, debug=False, logger=None, account=None, transfers=None, client=None, http_client=None,
+                 background=False, concurrent=False):
+        """Class constructor. A client that has already been authorised (e.g. one talking to a replay
+           server) may be supplied, and otherwise http_client overrides the transport of the client created.
+           Requests from a background session give way to those from interactive ones. A long-lived
+           concurrent session walks the tree with a pool of request workers, which close() stops."""
         self._debug = debug
         self._verbose = verbose
-        self._config = DriveConfig(verbose, debug, logger)
+        self._account = account         ## Account name, or None for the default account.
+        self._transfers = transfers     ## Shared TransferPool, or None to transfer inline.
+        self._config = DriveConfig(verbose, debug, logger, account)
 
         self._token = None      ## OAuth 2,0 token object.
         self._client = None     ## Google Docs API client object.
 
+        self._lock = threading.RLock()                      ## Guards the metadata maps and upload links.
         self._metadata = {}                                 ## Metadata dict.
         self._metadata["changestamp"] = 0                   ## Stores the last changestamp, if any.
         self._metadata["map"] = {}
         self._metadata["map"]["bypath"] = DirectoryTree()   ## Maps paths to resource IDs.
         self._metadata["map"]["byid"] = {}                  ## Maps resource IDs to paths.
+        self._metadata["etags"] = {}                        ## Maps folder paths to the ETags of their last listing.
 
-        self._folder_count = 0
-        self._file_count = 0
-        self._bar = None
+        self._upload_links = {}     ## Caches resumable-create URIs by folder resource ID.
+        self._stop = threading.Event()  ## Set when the session has been asked to stop work.
 
-        self._authorise()
-        if self._token == None:
-            # TODO: throw exception.
-            sys.exit("Error: failed to authorise with service!")
-        self._setup()
+        if background:
+            lane = ratelimit.BACKGROUND
+        else:
+            lane = ratelimit.INTERACTIVE
+        ## Retries transient request failures, within the process-wide request budget.
+        self._retry = RetryPolicy(governor=ratelimit.getGovernor(self._config.getRequestRate()), lane=lane)
+        ## Shares identical resource requests in flight. Results are not kept, as they go stale once a file changes.
+        self._flights = SingleFlight(ttl=0)
+
+        self._concurrent = concurrent and self._config.getConcurrency() > 1
+        self._engine = None     ## Runs API requests concurrently, created when first needed.
+
+        if client != None:
+            self._client = client
+        else:
+            self._authorise()
+            if self._token == None:
+                # TODO: throw exception.
+                sys.exit("Error: failed to authorise with service!")
+            self._setup(http_client)
         if self._client == None:
             # TODO: throw exception.
             sys.exit("Error: failed to create Docs client!")
 
         # Load cached metadata, if any.
         loaded = self._load()
+        self._setupStore()
+
+        # Open the queue of pending operations. Its checkpoint may be more recent than the saved metadata.
+        self._queue = WorkQueue(self._config.getQueueFile())
+        metrics.setGauge("gdrive_work_queue_dead_letters", lambda: len(self._queue.getDeadLetters()), account=self._getAccountLabel())
+        checkpoint = self._queue.getCheckpoint()
+        if loaded and checkpoint > self._metadata["changestamp"]:
+            self._metadata["changestamp"] = checkpoint
 
         if not loaded:
             # Initialise metadata.
@@ -72,18 +147,57 @@ class Session(object):
 
     def reset(self):
         "Reset local cached metadata."
-        self._metadata = {}
-        self._metadata["changestamp"] = 0
-        self._metadata["map"] = {}
-        self._metadata["map"]["bypath"] = DirectoryTree()
-        self._metadata["map"]["byid"] = {}
+        metadata = {}
+        metadata["changestamp"] = 0
+        metadata["map"] = {}
+        metadata["map"]["bypath"] = DirectoryTree()
+        metadata["map"]["byid"] = {}
+        metadata["etags"] = {}
+        with self._lock:
+            old_metadata = self._metadata
+            self._metadata = metadata
+            self._upload_links = {}
+            # The new maps may reuse the store files, so the old ones must be closed first.
+            self._closeStore(old_metadata)
+        self._setupStore()
         self._walk()
         self._save()
-        self._folder_count = 0
-        self._file_count = 0
-        self._num_folders = 0
-        self._num_files = 0
-        self._bar = None
+
+    def close(self):
+        "Stop the request workers, if any, and close the queue of pending operations and the metadata store."
+        with self._lock:
+            engine = self._engine
+            self._engine = None
+            self._concurrent = False
+        if engine:
+            engine.stop()
+        self._queue.close()
+        with self._lock:
+            self._closeStore(self._metadata)
+
+    def _getEngine(self):
+        "Return the SyncEngine, creating it on first use, or None if requests are not run concurrently."
+        with self._lock:
+            if self._engine == None and self._concurrent:
+                self._engine = SyncEngine(self, self._config.getConcurrency())
+            return self._engine
+
+    def _getAccountLabel(self):
+        "Return the account name used to label metrics."
+        return self._account or "default"
+
+    def requestStop(self):
+        "Ask the session to stop taking on new work, finishing any transfer in progress."
+        self._stop.set()
+
+    def isStopping(self):
+        "Return True if the session has been asked to stop."
+        return self._stop.is_set()
+
+    def waitForStop(self, timeout):
+        "Wait up to timeout seconds for a stop request. Returns True if the session is stopping."
+        self._stop.wait(timeout)
+        return self._stop.is_set()
 
     def _authorise(self):
         "Perform OAuth 2.0 authorisation."
@@ -132,96 +246,100 @@ class Session(object):
             f.write(blob)
             f.close()
 
-    def _setup(self):
+        # Reuse the access token from an earlier run, if it is still valid, rather than refreshing it.
+        self._tokens = TokenManager(self._token, self._config.getAccessTokenFile())
+        if saved_auth:
+            self._tokens.load()
+        else:
+            self._tokens.save()
+
+    def _setup(self, http_client=None):
         "Setup Google Docs session."
         # Create the Google Documents List API client.
         logging.info("Creating the Docs client...")
         self._client = gdata.docs.client.DocsClient(source=self._config.APP_NAME)
         #client.ssl = True  # Force HTTPS use.
+        # Reuse connections across requests. This must be done before authorising the client,
+        # which wraps the request method of the http_client.
+        self._client.http_client = http_client or PooledHttpClient(self._config.getMaxConnections())
         #client.http_client.debug = True  # Turn on HTTP debugging.
 
         # Authorise the client.
         logging.info("Authorising the Docs client API...")
-        self._client = self._token.authorize(self._client)
+        self._client = self._tokens.authorize(self._client)
+
+    def _call(self, endpoint, func, *args, **kwargs):
+        "Call a Docs API client method through the retry policy, returning None if it fails."
+        try:
+            return self._retry.call(endpoint, func, *args, **kwargs)
+        except gdata.client.NotModified:
+            raise
+        except Exception, e:
+            logging.error("Request %s never succeeded: %s" % (endpoint, e))
+            return None
 
     # Wrapper for gdata.docs.client.GetAllResources.
     def _getAllResources(self, uri):
-        "Get all resources, with exponential backoff and retry." 
-        for n in range(0, 5):
-            try:
-                items = self._client.GetAllResources(uri=uri)
-                return items
-            except:
-                time.sleep((2 ** n) + (random.randint(0, 1000) / 1000))
-        logging.fatal("An error occurred contacting the Google servers, the request never succeeded, aborting.")
-        return None
-    
+        "Get all resources, with retry."
+        return self._call("GetAllResources", self._client.GetAllResources, uri=uri)
+
+    def _project(self, uri, fields):
+        "Add the partial response fields and page size to a feed URI, unless it already has them."
+        if self._config.getProjection() and 'fields' not in uri.query:
+            uri.query['fields'] = fields
+        if 'max-results' not in uri.query:
+            uri.query['max-results'] = self._config.getPageSize()
+
+    # Wrapper for gdata.docs.client.GetResources.
+    def _getResources(self, uri, etag=None):
+        "Get a page of a resource feed, with retry. Raises NotModified if the feed still has the specified ETag."
+        uri = atom.http_core.Uri.parse_uri(uri)
+        self._project(uri, self._config.LISTING_FIELDS)
+        def getResources():
+            http_request = atom.http_core.HttpRequest()
+            if etag is not None:
+                http_request.headers['If-None-Match'] = etag
+            return self._client.GetResources(uri=uri, http_request=http_request)
+        return self._call("GetResources", getResources)
+
     # Wrapper for gdata.docs.client.GetResourceById.
-    def _getResourceById(self, res_id, show_root=True):
-        "Get resource by ID, with exponential backoff and retry." 
-        for n in range(0, 5):
-            try:
-                resource = self._client.GetResourceById(res_id, show_root=show_root)
-                return resource
-            except:
-                time.sleep((2 ** n) + (random.randint(0, 1000) / 1000))
-        logging.fatal("An error occurred contacting the Google servers, the request never succeeded, aborting.")
-        return None
-    
+    def _getResourceById(self, res_id, show_root=True, strict=False):
+        "Get resource by ID, with retry. Returns None if it fails, or if strict is True, raises the error."
+        call = self._retry.call if strict else self._call
+        return self._flights.do(("GetResourceById", res_id, show_root, strict),
+                                call, "GetResourceById", self._client.GetResourceById, res_id, show_root=show_root)
+
     # Wrapper for gdata.docs.client.GetResourceBySelfLink.
     def _getResourceBySelfLink(self, href, show_root=True):
-        "Get resource by self link, with exponential backoff and retry." 
-        for n in range(0, 5):
-            try:
-                resource = self._client.GetResourceBySelfLink(href, show_root=show_root)
-                return resource
-            except:
-                time.sleep((2 ** n) + (random.randint(0, 1000) / 1000))
-        logging.fatal("An error occurred contacting the Google servers, the request never succeeded, aborting.")
-        return None
-    
-    # Wrapper for gdata.docs.client.GetChanges.
+        "Get resource by self link, with retry."
+        return self._flights.do(("GetResourceBySelfLink", href, show_root),
+                                self._call, "GetResourceBySelfLink", self._client.GetResourceBySelfLink, href, show_root=show_root)
+
+    # Equivalent to gdata.docs.client.GetChanges, which has no way to add other query parameters.
     def _getChanges(self, changestamp=None, max_results=100, show_root=True):
-        "Get a change feed, with exponential backoff and retry." 
-        for n in range(0, 5):
-            try:
-                feed = self._client.GetChanges(changestamp, max_results, show_root)
-                return feed
-            except:
-                time.sleep((2 ** n) + (random.randint(0, 1000) / 1000))
-        logging.fatal("An error occurred contacting the Google servers, the request never succeeded, aborting.")
-        return None
+        "Get a change feed, with retry."
+        uri = atom.http_core.Uri.parse_uri(gdata.docs.client.CHANGE_FEED_URI)
+        if changestamp is not None:
+            uri.query['start-index'] = changestamp
+        uri.query['max-results'] = max_results
+        uri.query['showroot'] = str(show_root).lower()
+        self._project(uri, self._config.CHANGES_FIELDS)
+        return self._call("GetChanges", self._client.GetFeed, uri, desired_class=gdata.docs.data.ChangeFeed)
 
     # Wrapper for gdata.docs.client.GetNext.
     def _getNext(self, feed):
-        "Get next chink of entries from feed, with exponential backoff and retry." 
-        for n in range(0, 5):
-            try:
-                feed = self._client.GetNext(feed)
-                return feed
-            except:
-                time.sleep((2 ** n) + (random.randint(0, 1000) / 1000))
-        logging.fatal("An error occurred contacting the Google servers, the request never succeeded, aborting.")
-        return None
+        "Get next chunk of entries from feed, with retry."
+        return self._call("GetNext", self._client.GetNext, feed)
 
     # Wrapper for gdata.docs.client.GetRevisions.
     def _getRevisions(self, resource):
-        "Get a revisions feed, with exponential backoff and retry." 
-        for n in range(0, 5):
-            try:
-                revisions = self._client.GetRevisions(resource)
-                return revisions
-            except gdata.client.Unauthorized:
-                logging.warn("Unauthorised error on resource")
-                return None
-            except:
-                time.sleep((2 ** n) + (random.randint(0, 1000) / 1000))
-        logging.fatal("An error occurred contacting the Google servers, the request never succeeded, aborting.")
-        return None
+        "Get a revisions feed, with retry."
+        return self._flights.do(("GetRevisions", resource.resource_id.text),
+                                self._call, "GetRevisions", self._client.GetRevisions, resource)
 
     def getMetadata(self):
         "Return Google Docs user metadata."
-        metadata = self._client.GetMetadata()
+        metadata = self._retry.call("GetMetadata", self._client.GetMetadata)
         metadict = { 'quota': { 'total':   metadata.quota_bytes_total.text,
                                 'used':    metadata.quota_bytes_used.text,
                                 'trashed': metadata.quota_bytes_used_in_trash.text },
@@ -248,19 +366,17 @@ class Session(object):
 
     def _resourceIdToPath(self, resource_id):
         "Get the path for a resource ID."
-        try:
-            path = self._metadata["map"]["byid"][resource_id]
-        except KeyError:
-            path = None
-        return path
+        with self._lock:
+            return self._metadata["map"]["byid"].get(resource_id)
 
     def _pathToUri(self, path):
         "Get the URI for a path."
         if path == '/':
             uri = self._config.ROOT_FEED_URI
         else:
-            if path in self._metadata["map"]["bypath"]:
-                uri = self._metadata["map"]["bypath"][path]["uri"]
+            item = self._getItem(path)
+            if item != None:
+                uri = item["uri"]
             else:
                 # TODO: try to handle this better.
                 logging.error("Path \"%s\" is unknown!" % path)
@@ -275,44 +391,107 @@ class Session(object):
         if path == '/':
             res_id = "folder:root"
         else:
-            if path in self._metadata["map"]["bypath"]:
-                res_id = self._metadata["map"]["bypath"][path]["resource_id"]
+            item = self._getItem(path)
+            if item != None:
+                res_id = item["resource_id"]
             else:
                 # TODO: try to handle this better.
                 logging.error("Path \"%s\" is unknown!" % path)
                 raise KeyError
         return res_id
 
+    def _entryToItem(self, path, entry):
+        "Build a metadata item for a resource entry in the specified folder."
+        item = { "path": os.path.join(path, entry.title.text),
+                 "resource_id": entry.resource_id.text,
+                 "uri": entry.content.src,
+                 "size": entry.quota_bytes_used.text }
+        item["shared"] = "false"
+        if entry.get_resource_type() == 'folder':
+            item["type"] = "folder"
+        else:
+            item["type"] = "file"
+        return item
+
+    def _setResourceMetadata(self, item, metadata):
+        "Merge the revision metadata for a file into its metadata item."
+        if metadata:
+            item.update(metadata)
+        else:
+            logging.warn("No metadata found for path %s, assuming shared resource" % item["path"])
+            item["shared"] = "true"
+
+    def _addItem(self, item):
+        "Add a metadata item to the local maps."
+        with self._lock:
+            self._metadata["map"]["bypath"].add(item["path"], item)
+            self._metadata["map"]["byid"][item["resource_id"]] = item["path"]
+
+    def _removeItem(self, path):
+        "Remove a metadata item, and everything below it, from the local maps."
+        with self._lock:
+            tree = self._metadata["map"]["bypath"]
+            for itempath, item in tree.items(path):
+                del tree[itempath]
+                self._metadata["map"]["byid"].pop(item["resource_id"], None)
+                self._metadata["etags"].pop(itempath, None)
+
+    def _getFolderEntries(self, path):
+        """Get the entries in a folder and the ETag of the listing, or (None, None) on failure.
+           Raises NotModified if the folder is unchanged since its ETag was recorded."""
+        feed = self._getResources(self._pathToUri(path), self._metadata["etags"].get(path))
+        if feed == None:
+            return None, None
+        metrics.increment("gdrive_folder_listings_total", result="modified")
+        entries = feed.entry
+        # Only single-page listings have an ETag worth keeping, since each page has its own.
+        etag = feed.etag
+        next_link = feed.GetNextLink()
+        while next_link is not None:
+            etag = None
+            feed = self._getResources(next_link.href)
+            if feed == None:
+                return None, None
+            entries.extend(feed.entry)
+            next_link = feed.GetNextLink()
+        return entries, etag
+
+    def _setFolderEtag(self, path, etag):
+        "Record the ETag of a folder listing, once its entries have been added to the maps."
+        with self._lock:
+            if etag:
+                self._metadata["etags"][path] = etag
+            else:
+                self._metadata["etags"].pop(path, None)
+
     def _readFolder(self, path):
         "Read the contents of a folder."
         logging.debug("Reading folder \"%s\"" % path)
-        uri = self._pathToUri(path)
-        items = self._getAllResources(uri)
+        try:
+            items, etag = self._getFolderEntries(path)
+        except gdata.client.NotModified:
+            logging.debug("Folder \"%s\" is unchanged" % path)
+            metrics.increment("gdrive_folder_listings_total", result="not_modified")
+            return self.listFolder(path)
+        if items == None:
+            logging.error("Failed to read folder \"%s\"" % path)
+            return [], []
         folders = []
         files = []
         for entry in items:
-            itempath = os.path.join(path, entry.title.text)
-            itemid = entry.resource_id.text
-            item = { "path": itempath,
-                     "resource_id": itemid,
-                     "uri": entry.content.src,
-                     "size": entry.quota_bytes_used.text }
-            item["shared"] = "false"
-            if entry.get_resource_type() == 'folder':
-                item["type"] = "folder"
-                folders.append(itempath)
+            item = self._entryToItem(path, entry)
+            if item["type"] == "folder":
+                folders.append(item["path"])
             else:
-                files.append(itempath)
-                item["type"] = "file"
-                logging.debug("Getting metadata for path %s" % itempath)
+                files.append(item["path"])
+                logging.debug("Getting metadata for path %s" % item["path"])
                 metadata = self._getResourceMetadata(entry)
-                if metadata:
-                    item.update(metadata)
-                else:
-                    logging.warn("No metadata found for path %s, assuming shared resource" % itempath)
-                    item["shared"] = "true"
-            self._metadata["map"]["bypath"].add(itempath, item)
-            self._metadata["map"]["byid"][itemid] = itempath
+                if metadata == None:
+                    # A later walk would skip the file if the folder is unchanged, so don't keep the ETag.
+                    etag = None
+                self._setResourceMetadata(item, metadata)
+            self._addItem(item)
+        self._setFolderEtag(path, etag)
         folders.sort()
         files.sort()
         return folders, files
@@ -321,12 +500,50 @@ class Session(object):
         "Get the list of items in the specified folder."
         return self._readFolder(path)
 
+    def listFolder(self, path):
+        "Get the list of items in the specified folder from the cached metadata."
+        if path == '/':
+            prefix = ''
+        else:
+            prefix = path.rstrip('/')
+        folders = []
+        files = []
+        with self._lock:
+            children = self._metadata["map"]["bypath"].children(prefix)
+        for itempath, item in children:
+            if item["type"] == "folder":
+                folders.append(itempath)
+            else:
+                files.append(itempath)
+        folders.sort()
+        files.sort()
+        return folders, files
+
+    def _getItem(self, path):
+        "Return the cached metadata for the specified remote path, or None."
+        with self._lock:
+            try:
+                return self._metadata["map"]["bypath"][path]
+            except KeyError:
+                return None
+
+    def getItem(self, path):
+        "Return a copy of the cached metadata for the specified remote path, or None."
+        item = self._getItem(path)
+        if item == None:
+            return None
+        return dict(item)
+
     def readRoot(self):
         "Get the list of items in the root folder."
         return self._readFolder('/')
 
     def _walk(self, root='/'):
         "Walk the server-side tree, populating the local maps."
+        engine = self._getEngine()
+        if engine:
+            engine.walk(root)
+            return
         folders, files = self._readFolder(root)
         for folder in folders:
             self._walk(root=folder)
@@ -339,21 +556,59 @@ class Session(object):
             f = open(metafile, 'rb')
             self._metadata = pickle.load(f)
             f.close()
+            # Metadata saved by older versions has no listing ETags.
+            self._metadata.setdefault("etags", {})
             return True
         return False
 
+    def _setupStore(self):
+        "Bound the memory used by the metadata maps, if a memory limit is configured."
+        tree = self._metadata["map"]["bypath"]
+        byid = self._metadata["map"]["byid"]
+        max_entries = self._config.getMaxResidentEntries()
+        if not max_entries:
+            if tree.hasEvicted():
+                # Saved under a memory limit that has since been removed, so the evicted subtrees are still needed.
+                tree.setStore(self._config.getStoreFile(), 0)
+            if isinstance(byid, StoredDict):
+                self._metadata["map"]["byid"] = dict(byid.items())
+                byid.close()
+            return
+        logging.debug("Keeping at most %d metadata entries in memory" % max_entries)
+        tree.setStore(self._config.getStoreFile(), max_entries)
+        if not isinstance(byid, StoredDict):
+            # The resource ID map grows with the path map, so it is kept on disk as well.
+            self._metadata["map"]["byid"] = StoredDict(self._config.getIdStoreFile(), byid)
+        account = self._getAccountLabel()
+        for name in ("resident", "hits", "misses", "evictions"):
+            metrics.setGauge("gdrive_metadata_store_%s" % name, lambda name=name: self._metadata["map"]["bypath"].getStats()[name], account=account)
+
+    def _closeStore(self, metadata):
+        "Close the on-disk stores of the specified metadata maps, if any."
+        metadata["map"]["bypath"].close()
+        if isinstance(metadata["map"]["byid"], StoredDict):
+            metadata["map"]["byid"].close()
+
     def _save(self):
         "Save metadata to local file."
         metafile = self._config.getMetadataFile()
         logging.debug("Saving metadata...")
-        f = open(metafile, 'wb')
-        pickle.dump(self._metadata, f)
-        f.close()
+        with self._lock:
+            # Evicted subtrees are referenced from the metadata file, so they must be on disk first.
+            self._metadata["map"]["bypath"].sync()
+            f = open(metafile, 'wb')
+            pickle.dump(self._metadata, f)
+            f.close()
+        account = self._getAccountLabel()
+        metrics.setGauge("gdrive_metadata_bytes", os.path.getsize(metafile), account=account)
+        metrics.setGauge("gdrive_metadata_entries", len(self._metadata["map"]["byid"]), account=account)
+        metrics.setGauge("gdrive_changestamp", self._metadata["changestamp"], account=account)
 
     def isFolder(self, path):
         "Return true if the specified path is a folder."
-        if path in self._metadata["map"]["bypath"]:
-            if self._metadata["map"]["bypath"][path]["type"] == "folder":
+        item = self._getItem(path)
+        if item != None:
+            if item["type"] == "folder":
                 return True
             else:
                 return False
@@ -395,9 +650,10 @@ class Session(object):
             if path.startswith(self._config.getLocalRoot()):
                 path = self._config.getRemotePath(path)
             try:
-                author["name"] = self._metadata["map"]["bypath"][path]["author-name"]
-                author["email"] = self._metadata["map"]["bypath"][path]["author-email"]
-            except KeyError:
+                item = self._getItem(path)
+                author["name"] = item["author-name"]
+                author["email"] = item["author-email"]
+            except (KeyError, TypeError):
                 author["name"] = None
                 author["email"] = None
         return author
@@ -416,8 +672,8 @@ class Session(object):
             if path.startswith(self._config.getLocalRoot()):
                 path = self._config.getRemotePath(path)
             try:
-                date = self._metadata["map"]["bypath"][path]["updated"]
-            except KeyError:
+                date = self._getItem(path)["updated"]
+            except (KeyError, TypeError):
                 pass
         return date
 
@@ -444,8 +700,8 @@ class Session(object):
             if path.startswith(self._config.getLocalRoot()):
                 path = self._config.getRemotePath(path)
             try:
-                size = int(self._metadata["map"]["bypath"][path]["size"])
-            except KeyError:
+                size = int(self._getItem(path)["size"])
+            except (KeyError, TypeError):
                 pass
         return size
 
@@ -480,11 +736,12 @@ class Session(object):
         if not self.isFolder(path):
             if path.startswith(self._config.getLocalRoot()):
                 path = self._config.getRemotePath(path)
-            if path not in self._metadata["map"]["bypath"] or "md5checksum" not in self._metadata["map"]["bypath"][path]:
+            item = self._getItem(path)
+            if item == None or "md5checksum" not in item:
                 shared = None
                 try:
-                    shared = self._metadata["map"]["bypath"][path]["shared"]
-                except KeyError:
+                    shared = item["shared"]
+                except (KeyError, TypeError):
                     # This will really only happen if the metadata is from an old version of the app.
                     pass
                 if shared:
@@ -492,8 +749,8 @@ class Session(object):
                 parent = '/' + '/'.join(path.split('/')[:-2])
                 self._readFolder(parent)
             try:
-                checksum = self._metadata["map"]["bypath"][path]["md5checksum"]
-            except KeyError:
+                checksum = self._getItem(path)["md5checksum"]
+            except (KeyError, TypeError):
                 logging.error("Path \"%s\" is not recognised!" % path)
         return checksum
 
@@ -512,38 +769,118 @@ class Session(object):
         logging.debug("Max changestamp: %d" % metadict["changestamp"])
         return metadict["changestamp"]
 
+    def hasChanges(self):
+        "Return True if the server has changes beyond the stored changestamp."
+        if self._metadata["changestamp"] == 0:
+            return True
+        # The stored changestamp is one beyond the last change seen.
+        return self._getLargestChangestamp() >= self._metadata["changestamp"]
+
     def _getChangeList(self, changestamp=0):
-        "Get a list of resource IDs that have changed since the specified changestamp."
+        "Get a list of (resource ID, changestamp) tuples for changes since the specified changestamp."
         changes = []
-        resource_ids = []
+        result = []
         if changestamp == 0:
             logging.debug("Getting all changes...")
-            feed = self._getChanges(max_results=self._config.MAX_RESULTS, show_root=True)
+            feed = self._getChanges(max_results=self._config.getPageSize(), show_root=True)
         else:
             logging.debug("Getting changes since changestamp=%s..." % changestamp)
-            feed = self._getChanges(changestamp=str(changestamp), max_results=self._config.MAX_RESULTS, show_root=True)
+            feed = self._getChanges(changestamp=str(changestamp), max_results=self._config.getPageSize(), show_root=True)
         if feed:
             changes.extend(feed.entry)
-        while feed and len(feed.entry) == self._config.MAX_RESULTS:
+        # The service may return fewer entries per page than were asked for, so follow the next links.
+        while feed and feed.GetNextLink() is not None:
             feed = self._getNext(feed)
-            changes.extend(feed.entry)
+            if feed:
+                changes.extend(feed.entry)
         if len(changes) > 0:
-            # Save a changestamp of one beyond the last.
-            self._metadata["changestamp"] = int(changes[-1].changestamp.value) + 1
-            logging.debug("Got %d changes, last changestamp is %d" % (len(changes), self._metadata["changestamp"]))
+            logging.debug("Got %d changes, last changestamp is %s" % (len(changes), changes[-1].changestamp.value))
             for change in changes:
-                resource_ids.append(change.resource_id.text)
+                result.append((change.resource_id.text, int(change.changestamp.value)))
         else:
             logging.debug("No changes found")
-        return resource_ids
+        return result
+
+    def _applyChange(self, res_id, path, download, interactive):
+        """Bring the local tree up to date with a single changed resource. Returns False on a failure
+           that is worth trying again, and True once the change has been applied or skipped."""
+        res_path = self._resourceIdToPath(res_id)
+        if res_path == None:
+            logging.debug("No local path for resource ID %s" % res_id)
+            # The resource is not in our cache.
+            try:
+                resource = self._getResourceById(res_id, show_root=True, strict=True)
+            except gdata.client.RequestError, e:
+                if isTransient(e):
+                    logging.error("Failed to get resource \"%s\": %s" % (res_id, e))
+                    return False
+                # Typically a resource created and deleted again since the last update.
+                logging.warn("Skipping change to resource \"%s\", which cannot be fetched: %s" % (res_id, e))
+                return True
+            except Exception, e:
+                logging.error("Failed to get resource \"%s\": %s" % (res_id, e))
+                return False
+            self._printresource(resource)
+            # Repeatedly get the parent until we find one in our cache, or else reach the root,
+            # which should always exist. If it has no parent, and is not in root, then it must
+            # be shared.
+            # TODO: support shared resources somehow.
+            parents = resource.InCollections()
+            for parent in parents:
+                logging.debug("parent: %s" % parent.href)
+                if parent.href == self._config.ROOT_FOLDER_HREF:
+                    logging.debug("Parent is root folder")
+                    top_path = '/'
+                else:
+                    parent_resource = self._getResourceBySelfLink(parent.href, show_root=True)
+                    parent_resid = parent_resource.resource_id.text
+                    logging.debug("Parent resource ID %s" % parent_resid)
+                    parent_resids = [parent_resid]
+                    while self._resourceIdToPath(parent_resid) == None:
+                        logging.debug("Parent resource ID %s not in cache" % parent_resid)
+                        parent = parent.InCollections()
+                        parent_resource = self._getResourceBySelfLink(parent.href, show_root=True)
+                        parent_resid = parent_resource.resource_id.text
+                        parent_resids.insert(0, parent_resid)
+                    top_path = self._resourceIdToPath(parent_resid)
+                    logging.debug("Found parent path %s in cache for resource ID %s" % (top_path, parent_resid))
+                self._walk(top_path)
+                # Download the top_path subtree here.
+                if download:
+                    self.download(top_path, self._config.getLocalPath(top_path), overwrite=True, interactive=interactive, drain=False)
+            res_path = self._resourceIdToPath(res_id)
+            if res_path == None:
+                logging.warn("No parent path found, must be a shared resource, skipping...")
+                return True
+        # Check if resource path is in the path specified.
+        if res_path.startswith(path):
+            logging.debug("Get resource %s (%s)" % (res_id, res_path))
+            if download:
+                self.download(res_path, self._config.getLocalPath(res_path), overwrite=True, interactive=interactive, drain=False)
+        else:
+            logging.debug("Ignoring change to path %s, not in target path %s" % (res_path, path))
+        return True
+
+    def _checkpoint(self, changestamp):
+        "Record the changestamp up to which all changes have been planned."
+        with self._lock:
+            self._metadata["changestamp"] = changestamp
+        # The queued operations must be durable before the changes they came from are skipped.
+        self._queue.setCheckpoint(changestamp)
 
     def update(self, path='/', download=False, interactive=True):
         "Update the local tree at the specified path to match the server."
         logging.debug("Updating %s ..." % path)
+        # Finish any operations left over from an interrupted run before planning new ones.
+        self._processQueue()
         localpath = self._config.getLocalPath(path)
-        if path == '/' or not os.path.exists(localpath):
+        if not os.path.exists(localpath) or (path == '/' and self._metadata["changestamp"] == 0):
             logging.debug("Local copy does not exist, fetching...")
-            self.download(path, localpath, overwrite=True, interactive=interactive)
+            changestamp = self._getLargestChangestamp() + 1
+            complete = self.download(path, localpath, overwrite=True, interactive=interactive, drain=False)
+            # Only a complete fetch of the whole tree makes the change feed up to that point redundant.
+            if path == '/' and complete and not self.isStopping():
+                self._checkpoint(changestamp)
         else:
             # Request change feed from the last changestamp.
             # If no stored changestamp, then start at the beginning.
@@ -552,88 +889,87 @@ class Session(object):
                 self._metadata["changestamp"] = self._getLargestChangestamp() + 1
                 self._walk(root=path)
                 if download:
-                    self.download(path, localpath, overwrite=True, interactive=interactive)
+                    self.download(path, localpath, overwrite=True, interactive=interactive, drain=False)
             # Now check for changes again, since before we walked.
-            resource_ids = self._getChangeList(self._metadata["changestamp"])
-            if len(resource_ids) > 0:
-                # Iterate over the changes, downloading each resource.
-                for res_id in resource_ids:
-                    res_path = self._resourceIdToPath(res_id)
-                    if res_path == None:
-                        logging.debug("No local path for resource ID %s" % res_id)
-                        # The resource is not in our cache.
-                        resource = self._getResourceById(res_id, show_root=True)
-                        if not resource:
-                            # TODO: This should never fail.
-                            logging.error("Failed to get resource \"%s\"" % res_id)
-                            break
-                        self._printresource(resource)
-                        # Repeatedly get the parent until we find one in our cache, or else reach the root,
-                        # which should always exist. If it has no parent, and is not in root, then it must
-                        # be shared.
-                        # TODO: support shared resources somehow.
-                        parents = resource.InCollections()
-                        for parent in parents:
-                            logging.debug("parent: %s" % parent.href)
-                            if parent.href == self._config.ROOT_FOLDER_HREF:
-                                logging.debug("Parent is root folder")
-                                top_path = '/'
-                            else:
-                                parent_resource = self._getResourceBySelfLink(parent.href, show_root=True)
-                                parent_resid = parent_resource.resource_id.text
-                                logging.debug("Parent resource ID %s" % parent_resid)
-                                parent_resids = [parent_resid]
-                                while parent_resid not in self._metadata["map"]["byid"]:
-                                    logging.debug("Parent resource ID %s not in cache" % parent_resid)
-                                    parent = parent.InCollections()
-                                    parent_resource = self._getResourceBySelfLink(parent.href, show_root=True)
-                                    parent_resid = parent_resource.resource_id.text
-                                    parent_resids.insert(0, parent_resid)
-                                top_path = self._resourceIdToPath(parent_resid)
-                                logging.debug("Found parent path %s in cache for resource ID %s" % (top_path, parent_resid))
-                            self._walk(top_path)
-                            # Download the top_path subtree here.
-                            if download:
-                                self.download(top_path, self._config.getLocalPath(top_path), overwrite=True, interactive=interactive)
-                        res_path = self._resourceIdToPath(res_id)
-                        if res_path == None:
-                            logging.warn("No parent path found, must be a shared resource, skipping...")
-                            continue
-                    # Check if resource path is in the path specified.
-                    if res_path.startswith(path):
-                        logging.debug("Get resource %s (%s)" % (res_id, res_path))
-                        if download:
-                            self.download(res_path, self._config.getLocalPath(res_path), overwrite=True, interactive=interactive)
-                    else:
-                        logging.debug("Ignoring change to path %s, not in target path %s" % (res_path, path))
+            changes = self._getChangeList(self._metadata["changestamp"])
+            # Iterate over the changes, downloading each resource. The stored changestamp
+            # is advanced after each change, so that an interrupted update can resume.
+            for res_id, changestamp in changes:
+                if self.isStopping():
+                    logging.info("Stop requested, checkpointing at changestamp %d" % self._metadata["changestamp"])
+                    break
+                if not self._applyChange(res_id, path, download, interactive):
+                    break
+                # Save a changestamp of one beyond the last.
+                self._checkpoint(changestamp + 1)
+        self._processQueue()
+        self._save()
+
+    def refresh(self):
+        "Bring the cached metadata up to date with the change feed, without touching the local tree."
+        if self._metadata["changestamp"] == 0:
+            changestamp = self._getLargestChangestamp() + 1
+            self._walk()
+            if not self.isStopping():
+                self._checkpoint(changestamp)
+            self._save()
+            return
+        changes = self._getChangeList(self._metadata["changestamp"])
+        if not changes:
+            return
+        # Re-list the folder holding each changed resource, which refreshes its metadata.
+        folders = set()
+        for res_id, changestamp in changes:
+            path = self._resourceIdToPath(res_id)
+            if path != None:
+                folders.add(os.path.dirname(path))
+        for folder in sorted(folders):
+            if self.isStopping():
+                return
+            cached = self.listFolder(folder)
+            current = self._readFolder(folder)
+            # Drop anything that has been deleted or moved out of the folder.
+            for itempath in set(cached[0] + cached[1]) - set(current[0] + current[1]):
+                self._removeItem(itempath)
+        # Anything new, or moved out of its folder, is looked up again by walking its nearest cached parent folder.
+        for res_id, changestamp in changes:
+            if self.isStopping():
+                return
+            if self._resourceIdToPath(res_id) == None and not self._applyChange(res_id, '/', False, False):
+                return
+        self._checkpoint(changes[-1][1] + 1)
         self._save()
 
     def getNumResources(self, path=None):
         "Returns the total number of resources (files, folders) in the specified path, and all subtrees."
-        return len(self._metadata["map"]["bypath"].keys(path))
+        if path == None or path == '/':
+            # Count the entries below the root, and not the root placeholder itself.
+            path = ''
+        with self._lock:
+            return len(self._metadata["map"]["bypath"].keys(path))
 
     def getNumRemoteFolders(self, path=None):
         "Returns the total number of folders in the specified remote path, and all subtrees."
         count = 0
-        if path == '/':
-            values = self._metadata["map"]["bypath"].itervalues()
-        else:
-            values = self._metadata["map"]["bypath"].itervalues(path)
-        for value in values:
-            if value["type"] == "folder":
-                count += 1
+        if path == None or path == '/':
+            # The root node holds a placeholder, rather than metadata.
+            path = ''
+        with self._lock:
+            for value in self._metadata["map"]["bypath"].itervalues(path):
+                if value["type"] == "folder":
+                    count += 1
         return count
 
     def getNumRemoteFiles(self, path=None):
         "Returns the total number of files in the specified remote path, and all subtrees."
         count = 0
-        if path == '/':
-            values = self._metadata["map"]["bypath"].itervalues()
-        else:
-            values = self._metadata["map"]["bypath"].itervalues(path)
-        for value in values:
-            if value["type"] != "folder":
-                count += 1
+        if path == None or path == '/':
+            # The root node holds a placeholder, rather than metadata.
+            path = ''
+        with self._lock:
+            for value in self._metadata["map"]["bypath"].itervalues(path):
+                if value["type"] != "folder":
+                    count += 1
         return count
 
     def getNumLocalFolders(self, path):
@@ -650,93 +986,325 @@ class Session(object):
             count += len(files)
         return count
 
-    def _download(self, path, localpath, overwrite=False):
-        "Download a file."
-        entry = None
-        if path != '/':
-            entry = self._getResourceById(self._pathToResourceId(path))
-            if not entry:
-                logging.error("Failed to download path \"%s\"" % path)
-                return False
+    def _download(self, path, localpath, overwrite, progress):
+        "Queue the operations needed to download a file or folder tree."
+        if self.isStopping():
+            logging.debug("Stop requested, not downloading %s" % path)
+            return False
         if self.isFolder(path):
             if not self._config.checkLocalFolder(localpath, overwrite):
                 logging.error("Cannot overwrite local path \"%s\", exiting!" % localpath)
                 return
-            logging.info("Downloading folder %s (%d of %d)..." % (localpath, self._folder_count, self._num_folders))
+            if os.path.isdir(localpath) and not overwrite:
+                # The user agreed to replace the existing folder.
+                self._queue.put("delete", path, localpath=localpath)
+            self._queue.put("mkdir", path, localpath=localpath)
+            logging.info("Downloading folder %s (%d of %d)..." % (localpath, progress.folder_count, progress.num_folders))
             (folders, files) = self._readFolder(path)
             for fname in files:
                 lpath = os.path.join(localpath, os.path.basename(fname))
-                self._download(fname, lpath, overwrite)
-                self._file_count += 1
+                self._download(fname, lpath, overwrite, progress)
             for folder in folders:
                 lpath = os.path.join(localpath, os.path.basename(folder))
-                self._download(folder, lpath, overwrite)
-            self._folder_count += 1
+                if not self._download(folder, lpath, overwrite, progress):
+                    return False
+            if self.isStopping():
+                return False
+            progress.folderDone()
         else:
-            logging.info("Downloading file %s (%d bytes) (%d of %d)..." % (localpath, self.getRemoteFileSize(path), self._file_count, self._num_files))
-            if self._bar:
-                self._bar.render(self._file_count * 100 / self._num_files, localpath)
-            if not self._config.checkLocalFile(localpath, overwrite):
+            try:
+                uri = self._getItem(path)["uri"]
+            except (KeyError, TypeError):
+                logging.error("Failed to download path \"%s\"" % path)
                 return False
-            self._client.DownloadResource(entry, localpath)
-            os.chmod(localpath, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+            if os.path.isdir(localpath):
+                logging.error("Local path \"%s\" exists, but is not a file!" % localpath)
+                return False
+            # An existing file is replaced when the download completes, so only ask here.
+            if not overwrite and not self._config.checkLocalFile(localpath, overwrite):
+                return False
+            self._queue.put("download", path, localpath=localpath, uri=uri)
         return True
 
-    def download(self, path, localpath=None, overwrite=False, interactive=False):
-        "Download a file or a folder tree."
-        self._folder_count = 1
-        self._num_folders = self.getNumRemoteFolders(path)
-        self._file_count = 1
-        self._num_files = self.getNumRemoteFiles(path)
-        if interactive:
-            if self._num_folders + self._num_files > 2:
-                self._bar = progressbar.ProgressBar(width=80)
+    def _runOperation(self, item, progress=None):
+        "Perform a queued operation, counting it towards the progress of a download or upload, if any."
+        if item["op"] == "download":
+            localpath = item["localpath"]
+            if progress:
+                logging.info("Downloading file %s (%d bytes) (%d of %d)..." % (localpath, self.getRemoteFileSize(item["path"]), progress.file_count, progress.num_files))
+                progress.render(localpath)
+            else:
+                logging.info("Downloading file %s (%d bytes)..." % (localpath, self.getRemoteFileSize(item["path"])))
+            # Download to a temporary file, so that an interrupted transfer never leaves a truncated file.
+            partpath = localpath + self.PARTIAL_SUFFIX
+            self._fetchFile(item["uri"], partpath)
+            os.rename(partpath, localpath)
+            os.chmod(localpath, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        elif item["op"] == "mkdir":
+            if not os.path.isdir(item["localpath"]):
+                os.makedirs(item["localpath"])
+                os.chmod(item["localpath"], stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+        elif item["op"] == "delete":
+            localpath = item["localpath"]
+            if os.path.isdir(localpath):
+                shutil.rmtree(localpath)
+            elif os.path.exists(localpath):
+                os.remove(localpath)
+        elif item["op"] == "upload":
+            self._upload(item["localpath"], item["folder"], item.get("title"), item.get("replace", False))
+            if item.get("replace"):
+                # Pick up the new revision, so that readers see it once the local copy is gone.
+                self._readFolder(item["folder"])
+
+    def _processQueue(self, progress=None):
+        "Run the queued operations, acknowledging each one as it completes."
+        if len(self._queue) == 0:
+            return
+        self._queue.sync()
+        # Folders are removed and created first, in the order queued, so that files can then be transferred into them.
+        while not self.isStopping():
+            next_item = self._queue.get(self.FOLDER_OPERATIONS)
+            if next_item == None:
+                break
+            op_id, item = next_item
+            job = transfer.Transfer(self._runOperation, (item,), {})
+            job.run()
+            self._finishOperation(op_id, job)
+        pending = []
+        while not self.isStopping():
+            next_item = self._queue.get(self.TRANSFER_OPERATIONS)
+            if next_item == None:
+                break
+            op_id, item = next_item
+            pending.append((op_id, self._submit(self._runOperation, item, progress)))
+        for op_id, job in pending:
+            self._finishOperation(op_id, job)
+            if progress:
+                progress.fileDone()
+        metrics.setGauge("gdrive_work_queue_depth", len(self._queue), account=self._getAccountLabel())
+
+    def _finishOperation(self, op_id, job):
+        "Wait for a queued operation to complete, and acknowledge it, or return it to the queue if it failed."
+        try:
+            job.wait()
+            self._queue.ack(op_id)
+        except Exception:
+            logging.exception("Operation failed:")
+            self._queue.release(op_id)
+
+    def processQueue(self):
+        "Run the queued operations."
+        self._processQueue()
+
+    def hasPendingWork(self, due=True):
+        "Return True if there are queued operations that are due to be run, or any at all if due is False."
+        if due:
+            return self._queue.getNumDue() > 0
+        return len(self._queue) > 0
+
+    def getDeadLetters(self):
+        "Return the queued operations that have been given up on after failing repeatedly."
+        return [item for op_id, item in self._queue.getDeadLetters()]
+
+    def retryDeadLetters(self):
+        "Queue the operations that have been given up on to be run again. Returns the number queued."
+        return self._queue.retryDeadLetters()
+
+    def clearDeadLetters(self):
+        """Discard the operations that have been given up on, returning a list of them. The staged copies
+           of files written through the mount are removed with their uploads, so that they stop hiding the
+           remote files."""
+        items = self._queue.clearDeadLetters()
+        staging = os.path.join(self._config.getStagingDir(), '')
+        for item in items:
+            if item["op"] == "upload" and item.get("replace") and item["localpath"].startswith(staging):
+                logging.info("Discarding local changes to %s" % item["path"])
+                try:
+                    os.remove(item["localpath"])
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        return items
+
+    def _submit(self, func, *args):
+        "Run a transfer on the shared pool, if there is one, or else immediately."
+        if self._transfers:
+            return self._transfers.submit(self._account, func, *args)
+        job = transfer.Transfer(func, args, {})
+        job.run()
+        return job
+
+    def _fetchFile(self, uri, localpath):
+        "Stream the content at the specified URI to a local file."
+        response = self._retry.call("Download", self._client.request, 'GET', uri)
+        if response.status != 200:
+            raise gdata.client.error_from_response("Server responded with", response, gdata.client.RequestError)
+        f = open(localpath, 'wb')
+        try:
+            while True:
+                data = response.read(transfer.CHUNK_SIZE)
+                if not data:
+                    break
+                if self._transfers:
+                    self._transfers.limiter.consume(len(data))
+                f.write(data)
+                metrics.increment("gdrive_bytes_downloaded_total", len(data), account=self._getAccountLabel())
+        finally:
+            f.close()
+        metrics.increment("gdrive_files_downloaded_total", account=self._getAccountLabel())
+
+    def fetchRange(self, uri, start, end):
+        "Fetch the bytes from start up to end of the content at the specified URI."
+        def fetch():
+            http_request = atom.http_core.HttpRequest(uri=atom.http_core.Uri.parse_uri(uri), method='GET',
+                                                      headers={ 'Range': 'bytes=%d-%d' % (start, end - 1) })
+            # GDClient.request treats 206 Partial Content as an error, so use the authorised transport directly.
+            response = self._client.http_client.request(http_request)
+            if response.status == 206:
+                return response.read()
+            if response.status == 200:
+                # The server ignored the range.
+                return response.read()[start:end]
+            if response.status == 416:
+                return ''
+            # Set the status, so that the retry policy can tell whether the failure is transient.
+            raise gdata.client.error_from_response("Server responded with", response, gdata.client.RequestError)
+        data = self._retry.call("DownloadRange", fetch)
+        metrics.increment("gdrive_bytes_downloaded_total", len(data), account=self._getAccountLabel())
+        return data
+
+    def getConfig(self):
+        "Return the session configuration."
+        return self._config
+
+    def download(self, path, localpath=None, overwrite=False, interactive=False, drain=True):
+        "Download a file or a folder tree. Returns False if not all of the tree could be queued."
+        progress = _Progress(self.getNumRemoteFolders(path), self.getNumRemoteFiles(path), interactive)
         if localpath is None:
             localpath = self._config.getLocalPath(path)
             logging.debug("Using local path %s" % localpath)
         for exclude in self._config.getExcludes():
             if path == '/' + exclude:
                 logging.debug("Skipping folder on exclude list")
-                return
-        self._download(path, localpath, overwrite)
-        self._folder_count = 0
-        self._file_count = 0
-
-    def _upload(self, localpath, path):
-        "Upload a file."
+                return False
+        complete = self._download(path, localpath, overwrite, progress)
+        if drain:
+            self._processQueue(progress)
+        return complete
 
-	# http://planzero.org/blog/2012/04/13/uploading_any_file_to_google_docs_with_python
+    def _getUploadUri(self, path):
+        "Get the resumable-create URI for uploads into the specified remote folder."
+        if path == '/':
+            return self._config.ROOT_UPLOAD_URI
+        item = self._getItem(path)
+        if item == None:
+            # Refresh the parent listing, in case the folder was created since the last walk.
+            self._readFolder(os.path.dirname(path))
+            item = self._getItem(path)
+        if item == None or item["type"] != "folder":
+            logging.error("Path \"%s\" is not a known folder!" % path)
+            return None
+        res_id = item["resource_id"]
+        with self._lock:
+            if res_id in self._upload_links:
+                return self._upload_links[res_id]
+        logging.debug("Resolving upload link for folder \"%s\" (%s)" % (path, res_id))
+        resource = self._getResourceById(res_id)
+        if not resource:
+            logging.error("Failed to get resource \"%s\"" % res_id)
+            return None
+        uri = resource.get_resumable_create_media_link().href
+        with self._lock:
+            self._upload_links[res_id] = uri
+        return uri
 
-	# The default root collection URI
-	uri = 'https://docs.google.com/feeds/upload/create-session/default/private/full'
+    def _getUpdateUri(self, path):
+        "Get the resumable-edit URI for replacing the content of the specified remote file, or None."
+        item = self._getItem(path)
+        if item == None or item["type"] == "folder":
+            return None
+        resource = self._getResourceById(item["resource_id"])
+        if not resource:
+            logging.error("Failed to get resource \"%s\"" % item["resource_id"])
+            return None
+        return resource.get_resumable_edit_media_link().href
 
-	# if collection path is set
-	if path <> "/":
-		resources = self._client.GetAllResources(uri='https://docs.google.com/feeds/default/private/full/-/folder?title=' + path + '&title-exact=true')
+    def _upload(self, localpath, path, title=None, replace=False):
+        """Upload a file into the specified remote folder, named title or else after the local file.
+           If replace is True, an existing remote file of that name has its content replaced."""
 
-		uri = resources[0].get_resumable_create_media_link().href
-	
-	# Make sure Google doesn't try to do any conversion on the upload (e.g. convert images to documents)
-	uri += '?convert=false'
+        # http://planzero.org/blog/2012/04/13/uploading_any_file_to_google_docs_with_python
 
-	# Create an uploader and upload the file
-	# Hint: it should be possible to use UploadChunk() to allow display of upload statistics for large uploads
-	t1 = time.time()
+        if title == None:
+            title = os.path.basename(localpath)
+        update_uri = None
+        if replace:
+            update_uri = self._getUpdateUri(os.path.join(path, title))
+        if update_uri != None:
+            uri = update_uri
+        else:
+            uri = self._getUploadUri(path)
+            if uri == None:
+                raise gdata.client.Error("Cannot upload to unknown folder \"%s\"" % path)
 
-	fh = open(localpath)
-	import magic
-	import atom
-	file_type = magic.Magic(mime=True).from_file(fh.name)
-	file_size = os.path.getsize(fh.name)
+        # Make sure Google doesn't try to do any conversion on the upload (e.g. convert images to documents)
+        uri += '?convert=false'
 
-	logging.info("Uploading...")
-	uploader = gdata.client.ResumableUploader(self._client, fh, file_type, file_size, chunk_size=1048576, desired_class=gdata.data.GDEntry)
-	res = uploader.UploadFile(uri, entry=gdata.data.GDEntry(title=atom.data.Title(text=os.path.basename(fh.name))))
+        # Create an uploader and upload the file
+        # Hint: it should be possible to use UploadChunk() to allow display of upload statistics for large uploads
+        t1 = time.time()
 
-	logging.info('Uploaded', '{0:.2f}'.format(file_size / 1024 / 1024) + ' MiB in ' + str(round(time.time() - t1, 2)) + ' seconds')
-	logging.info("Created: %s" % res)
+        import atom
+        file_type = mimetype.getDetector().fromFile(localpath)
+        file_size = os.path.getsize(localpath)
 
-        #logging.error("Upload is not yet implemented!")
+        logging.info("Uploading...")
+        fh = open(localpath, 'rb')
+        try:
+            uploader = gdata.client.ResumableUploader(self._client, fh, file_type, file_size, chunk_size=1048576, desired_class=gdata.data.GDEntry)
+            # Starting an upload session creates nothing, so it is safe to retry.
+            if update_uri != None:
+                # Overwrite whatever revision is current, rather than failing on a stale ETag.
+                self._retry.call("Upload", uploader._init_session, uri, headers={ 'If-Match': '*' }, method='PUT')
+            else:
+                self._retry.call("Upload", uploader._init_session, uri, entry=gdata.data.GDEntry(title=atom.data.Title(text=title)))
+            res = self._sendChunks(uploader, fh)
+        finally:
+            fh.close()
+
+        metrics.increment("gdrive_bytes_uploaded_total", file_size, account=self._getAccountLabel())
+        metrics.increment("gdrive_files_uploaded_total", account=self._getAccountLabel())
+        logging.info("Uploaded %.2f MiB in %.2f seconds" % (file_size / 1024.0 / 1024.0, time.time() - t1))
+        logging.info("Created: %s" % res)
+        return res
+
+    def _sendChunks(self, uploader, fh):
+        """Send a file to an upload session a chunk at a time, and return the entry created, or None if the
+           response to the last chunk was lost. A failed chunk is retried from wherever the server got up to,
+           so the session is never restarted, and the file is never created twice."""
+        state = { "offset": 0, "resync": False }
+
+        def sendChunk():
+            if state["resync"]:
+                # The server may have received some or all of the failed chunk.
+                status = uploader.QueryUploadStatus()
+                if status is True:
+                    return True
+                state["offset"] = status or 0
+            state["resync"] = True
+            fh.seek(state["offset"])
+            data = fh.read(uploader.chunk_size)
+            entry = uploader.UploadChunk(state["offset"], data)
+            state["resync"] = False
+            state["offset"] += len(data)
+            return entry
+
+        while True:
+            entry = self._retry.call("UploadChunk", sendChunk)
+            if entry is True:
+                return None
+            if entry != None:
+                return entry
 
     def upload(self, localpath, path=None, interactive=False):
         "Upload a file or a folder tree."
@@ -745,16 +1313,14 @@ class Session(object):
                 path = localpath[len(self._config.getLocalRoot()):]
             else:
                 path = '/'
-        self._folder_count = 1
-        self._num_folders = self.getNumLocalFolders(path)
-        self._file_count = 1
-        self._num_files = self.getNumLocalFiles(path)
-        if interactive:
-            if self._num_folders + self._num_files > 2:
-                self._bar = progressbar.ProgressBar(width=80)
-        self._upload(localpath, path)
-        self._folder_count = 0
-        self._file_count = 0
+        progress = _Progress(self.getNumLocalFolders(path), self.getNumLocalFiles(path), interactive)
+        self._queue.put("upload", os.path.join(path, os.path.basename(localpath)), localpath=localpath, folder=path)
+        self._processQueue(progress)
+
+    def queueReplace(self, localpath, path):
+        """Queue the upload of a local file to the specified remote path, replacing the file there, if any.
+           A pending upload to the same path is superseded, so repeated saves are only uploaded once."""
+        self._queue.put("upload", path, localpath=localpath, folder=os.path.dirname(path), title=os.path.basename(path), replace=True)
 
     def getInfo(self):
         "Return general information."
@@ -762,6 +1328,14 @@ class Session(object):
         userdata["Total resources"] = self.getNumResources()
         return userdata
 
+    def getStoreStats(self):
+        "Return the metadata store hit/miss statistics."
+        return self._metadata["map"]["bypath"].getStats()
+
+    def getConnectionStats(self):
+        "Return the HTTP connection reuse statistics."
+        return self._client.http_client.getStats()
+
     def dump(self):
         "Dump metadata."
         pprint.pprint(self._metadata, indent=2)
@@ -21,12 +21,15 @@ import optparse
 import pprint
 
 import gdocs
+import ipc
 from drived import DriveDaemon
 from drive_config import DriveConfig
 
 session = None
+account = None
 commands = {}
 aliases = {}
+queries = set()
 
 def command(func):
     if not func.__doc__:
@@ -37,6 +40,11 @@ def command(func):
         func.__doc__ += "Aliases: %s" % ",".join(func_aliases)
     return func
 
+def query(func):
+    "Mark a command as answerable by the running daemon."
+    queries.add(func.func_name)
+    return func
+
 def alias(name):
     def decorator(func):
         if name in commands:
@@ -110,6 +118,12 @@ Shows the status of the GDrive daemon.
 """
     daemon = DriveDaemon()
     print daemon.status()
+    config = DriveConfig(account=account)
+    for remote in (ipc.connect(config, account), ipc.connect(config, account, config.getMountSocketFile())):
+        if remote != None:
+            dead = remote.getDeadLetters()
+            if dead:
+                print "%d operations have failed repeatedly, see \"gdrive deadletters\"" % len(dead)
 
 @command
 def restart(argv):
@@ -123,6 +137,7 @@ Restarts the GDrive daemon, gdrived.
     daemon.restart()
 
 @command
+@query
 @alias("ls")
 def list(argv):
     """List folder contents.
@@ -142,6 +157,7 @@ Lists the contents of the specified path. If no path is specified, then the root
         print path, session.getFileSize(path), session.getFileDate(path), session.getFileChecksum(path)
 
 @command
+@query
 def filestatus(argv):
     """Show the status of a file.
 gdrive filestatus <path>
@@ -157,6 +173,23 @@ Shows the status of the specified path.
     print session.filestatus(path, interactive=True)
 
 @command
+@query
+def stat(argv):
+    """Show the cached metadata of a file or folder.
+gdrive stat <path>
+
+Shows the cached metadata of the specified remote path, without contacting the server.
+
+"""
+    path = None
+    if len(argv) == 0:
+        return usage()
+    else:
+        path = argv[0]
+    pprint.pprint(session.getItem(path))
+
+@command
+@query
 def md5(argv):
     """Print the MD5 checksums of the local and remote copies of the specified remote file path.
 gdrive md5 <path>
@@ -169,7 +202,7 @@ prints the local and remote MD5 checksums of the specified path.
         return usage()
     else:
         path = argv[0]
-    config = DriveConfig()
+    config = DriveConfig(account=account)
     rhash = session.getRemoteFileChecksum(path)
     lpath = config.getLocalPath(path)
     lhash = session.getLocalFileChecksum(lpath)
@@ -230,6 +263,33 @@ the root of the server tree.
             path = argv[1]
     session.upload(localpath, path, interactive=True)
 
+@command
+@query
+def deadletters(argv):
+    """List, retry or discard failed operations.
+gdrive deadletters [retry|clear]
+
+Lists the queued operations that have been given up on after failing repeatedly, including uploads of files written
+through a mounted GDriveFs. With "retry", they are queued to be run again. With "clear", they are discarded, and the
+changes to files written through the mount are thrown away.
+"""
+    if len(argv) > 0 and argv[0] not in ("retry", "clear"):
+        return usage()
+    sessions = [session]
+    # Uploads of files written through the mount are queued by the mount itself.
+    config = DriveConfig(account=account)
+    mount = ipc.connect(config, account, config.getMountSocketFile())
+    if mount != None:
+        sessions.append(mount)
+    for s in sessions:
+        if len(argv) == 0:
+            for item in s.getDeadLetters():
+                print item["op"], item["path"], item.get("localpath", "")
+        elif argv[0] == "retry":
+            print "Queued %d operations" % s.retryDeadLetters()
+        else:
+            print "Discarded %d operations" % len(s.clearDeadLetters())
+
 @command
 def reset(argv):
     """Reset GDrive cached metadata.
@@ -249,6 +309,7 @@ This command dumps cached GDrive metadata.
     session.dump()
 
 @command
+@query
 def info(argv):
     """Print general information.
 gdrive info
@@ -269,6 +330,7 @@ Utility to access Google Drive.
     parser = optparse.OptionParser(description=helpStr)
     parser.add_option('-v', '--verbose', dest='verbose', action='store_true', default=False,                   help='Turn on extra logging')
     parser.add_option('-d', '--debug',   dest='debug',   action='store_true', default=False,                   help='Turn on debug logging')
+    parser.add_option('-a', '--account', dest='account', action='store',      default=None,                    help='Use the named account')
     (options, args) = parser.parse_args()
     return (options, args)
 
@@ -289,16 +351,25 @@ def main(argv):
         usage()
         return None
 
-    global session
-    session = gdocs.Session(verbose=opts.verbose, debug=opts.debug)
+    if args[i] in commands:
+        func = commands[args[i]]
+    else:
+        func = aliases[args[i]]
+
+    global session, account
+    account = opts.account
+    if func.func_name in queries:
+        # Use the warm metadata held by the daemon, if it is running.
+        session = ipc.connect(DriveConfig(opts.verbose, opts.debug), opts.account)
+    if session == None:
+        session = gdocs.Session(verbose=opts.verbose, debug=opts.debug, account=opts.account)
     if session == None:
         sys.exit("Error, could not create Google Docs session!")
 
-    res = None
-    if args[i] in commands:
-        res = commands[args[i]](args[i+1:])
-    elif args[i] in aliases:
-        res = aliases[args[i]](args[i+1:])
+    try:
+        res = func(args[i+1:])
+    except ipc.QueryError, e:
+        sys.exit("Error: %s" % e)
 
     return res
 
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import time, socket, httplib, logging, threading, urllib, urlparse, base64
+
+import atom.http_core
+
+import metrics
+
+
+class _PooledResponse(object):
+    "Wraps an HTTP response, returning its connection to the pool once the body has been read."
+
+    def __init__(self, pool, key, connection, response):
+        "Class constructor."
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _release(self, reusable):
+        "Give the connection back to the pool, or discard it if it cannot be reused."
+        if self._connection is None:
+            return
+        connection = self._connection
+        self._connection = None
+        if reusable and not self._response.will_close:
+            self._pool._checkin(self._key, connection)
+        else:
+            self._pool._discard(self._key, connection)
+
+    def read(self, amt=None):
+        "Read from the response body."
+        try:
+            data = self._response.read(amt)
+        except:
+            self._release(False)
+            raise
+        if self._response.isclosed():
+            self._release(True)
+        return data
+
+    def close(self):
+        "Close the response. The connection is only reused if the body was read to the end."
+        self._release(self._response.isclosed())
+        self._response.close()
+
+    def __del__(self):
+        self._release(False)
+
+
+class PooledHttpClient(atom.http_core.HttpClient):
+    """An atom HTTP client that keeps connections alive and reuses them for later requests.
+
+    At most max_per_host connections to any one host are in use at a time; further requests
+    wait for a connection to be released. Install it on a client before authorising it, as the
+    OAuth 2.0 token wraps the request method of the client's http_client.
+
+    Like atom's ProxiedHttpClient, it honours the http_proxy and https_proxy environment
+    variables (and no_proxy), tunnelling HTTPS requests through the proxy with CONNECT.
+    """
+
+    def __init__(self, max_per_host=16, timeout=60):
+        "Class constructor."
+        self._max_per_host = max_per_host
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}         ## Idle connections, keyed by (scheme, host, port).
+        self._slots = {}        ## Semaphores limiting the connections in use, keyed as above.
+        self._created = 0
+        self._reused = 0
+        self._handshake_time = 0.0
+
+    def _getSlots(self, key):
+        "Get the semaphore limiting connections to a host."
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self._max_per_host)
+            return self._slots[key]
+
+    def _checkout(self, key, uri):
+        "Get an idle connection to the host, or open a new one. Returns (connection, reused)."
+        self._getSlots(key).acquire()
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self._reused += 1
+                metrics.increment("gdrive_http_connections_total", state="reused")
+                return idle.pop(), True
+        try:
+            connection = self._connect(key, uri)
+        except:
+            self._getSlots(key).release()
+            raise
+        return connection, False
+
+    def _getProxy(self, key):
+        "Get the proxy to use for a host, as a (host, port, headers) tuple, or None to connect directly."
+        scheme, host, port = key
+        proxy = urllib.getproxies().get(scheme)
+        if not proxy or urllib.proxy_bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        proxy = urlparse.urlparse(proxy)
+        headers = {}
+        if proxy.username:
+            credentials = '%s:%s' % (urllib.unquote(proxy.username), urllib.unquote(proxy.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
+        return proxy.hostname, proxy.port or 80, headers
+
+    def _connect(self, key, uri):
+        "Open a new connection, timing the TCP and TLS handshake."
+        scheme, host, port = key
+        proxy = self._getProxy(key)
+        if proxy and scheme == 'https':
+            connection = httplib.HTTPSConnection(proxy[0], proxy[1], timeout=self._timeout)
+            connection.set_tunnel(host, port, proxy[2])
+        elif proxy:
+            connection = httplib.HTTPConnection(proxy[0], proxy[1], timeout=self._timeout)
+        elif scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, timeout=self._timeout)
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=self._timeout)
+        t1 = time.time()
+        connection.connect()
+        elapsed = time.time() - t1
+        with self._lock:
+            self._created += 1
+            self._handshake_time += elapsed
+        metrics.increment("gdrive_http_connections_total", state="new")
+        metrics.observe("gdrive_http_handshake_seconds", elapsed, scheme=scheme)
+        return connection
+
+    def _checkin(self, key, connection):
+        "Return a connection to the idle list."
+        with self._lock:
+            self._idle.setdefault(key, []).append(connection)
+        self._getSlots(key).release()
+
+    def _discard(self, key, connection):
+        "Close a connection and free its slot."
+        try:
+            connection.close()
+        except Exception:
+            pass
+        self._getSlots(key).release()
+
+    def _send(self, connection, key, method, uri, headers, body_parts):
+        "Send a request over an open connection and return the response."
+        if self.debug:
+            connection.debuglevel = 1
+        proxy = None
+        if key[0] == 'http':
+            proxy = self._getProxy(key)
+        if proxy:
+            # A plain HTTP proxy takes the absolute URI, and no tunnel.
+            connection.putrequest(method, str(uri), skip_host=True)
+        else:
+            connection.putrequest(method, uri._get_relative_path(), skip_host=True)
+        # Unlike httplib, leave out the port if it's the default (see atom.http_core.HttpClient).
+        if uri.port and int(uri.port) != connection.default_port:
+            connection.putheader('Host', '%s:%s' % (uri.host, uri.port))
+        else:
+            connection.putheader('Host', uri.host)
+        if proxy:
+            for header_name, value in proxy[2].iteritems():
+                connection.putheader(header_name, value)
+        for header_name, value in headers.iteritems():
+            connection.putheader(header_name, value)
+        connection.endheaders()
+        if body_parts and filter(lambda x: x != '', body_parts):
+            for part in body_parts:
+                atom.http_core._send_data_part(part, connection)
+        return connection.getresponse()
+
+    def _http_request(self, method, uri, headers=None, body_parts=None):
+        "Make an HTTP request on a pooled connection."
+        if isinstance(uri, (str, unicode)):
+            uri = atom.http_core.Uri.parse_uri(uri)
+        if headers is None:
+            headers = {}
+        default_port = 443 if uri.scheme == 'https' else 80
+        key = (uri.scheme, uri.host, int(uri.port or default_port))
+        # A request can only be resent if its body can be read again.
+        resendable = not body_parts or all(isinstance(part, (str, unicode)) for part in body_parts)
+        while True:
+            connection, reused = self._checkout(key, uri)
+            try:
+                response = self._send(connection, key, method, uri, headers, body_parts)
+            except (socket.error, httplib.HTTPException), e:
+                self._discard(key, connection)
+                if reused and resendable:
+                    # The server closed the idle connection, try again on a new one.
+                    logging.debug("Pooled connection to %s failed (%s), reconnecting" % (uri.host, e))
+                    continue
+                raise
+            except:
+                self._discard(key, connection)
+                raise
+            return _PooledResponse(self, key, connection, response)
+
+    def close(self):
+        "Close all idle connections."
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def getStats(self):
+        "Return connection reuse and handshake statistics."
+        with self._lock:
+            idle = sum(len(connections) for connections in self._idle.values())
+            return { "created": self._created,
+                     "reused": self._reused,
+                     "idle": idle,
+                     "handshake_seconds": self._handshake_time }
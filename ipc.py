@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import os, socket, json, logging, threading, SocketServer
+
+
+class QueryError(Exception):
+    "Raised when the daemon fails to answer a query."
+    pass
+
+
+class _QueryHandler(SocketServer.StreamRequestHandler):
+    "Handles a single client connection, one JSON request per line."
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                result = self.server.dispatch(request["op"], request.get("args", {}), request.get("account"))
+                response = { "result": result }
+            except Exception, e:
+                logging.exception("Query failed:")
+                response = { "error": "%s: %s" % (e.__class__.__name__, e) }
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class Account(object):
+    "A session to be queried, for a process serving a single one."
+
+    def __init__(self, account, session):
+        "Class constructor."
+        self.account = account
+        self.session = session
+        self.lock = threading.Lock()
+
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    "Local Unix socket server answering metadata queries from a running Session."
+
+    daemon_threads = True
+
+    def __init__(self, path, accounts):
+        "Class constructor."
+        self._path = path
+        self._accounts = accounts   ## Objects with account, session and lock attributes.
+        self._thread = None
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, _QueryHandler)
+        os.chmod(path, 0600)
+
+    def start(self):
+        "Start serving queries in a background thread."
+        logging.debug("Starting query server on %s" % self._path)
+        self._thread = threading.Thread(target=self.serve_forever, name="query-server")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        "Stop serving queries and remove the socket."
+        logging.debug("Stopping query server...")
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+    def _getAccount(self, name):
+        "Return the account with the specified name, or the only account if no name is given."
+        if name == None and len(self._accounts) == 1:
+            return self._accounts[0]
+        for account in self._accounts:
+            if account.account == name:
+                return account
+        raise QueryError("Unknown account \"%s\"" % name)
+
+    def dispatch(self, op, args, account=None):
+        "Run the named query and return its JSON-serialisable result."
+        handler = getattr(self, "_op_%s" % op, None)
+        if handler == None:
+            raise QueryError("Unknown query \"%s\"" % op)
+        if op == "ping":
+            return True
+        account = self._getAccount(account)
+        with account.lock:
+            session = account.session
+        if session == None:
+            raise QueryError("Session for account \"%s\" is not ready yet" % account.account)
+        # The session is thread-safe, so queries don't wait for a sync in progress.
+        return handler(session, **args)
+
+    def _stat(self, session, path):
+        return { "size":     session.getFileSize(path),
+                 "date":     session.getFileDate(path),
+                 "checksum": session.getFileChecksum(path),
+                 "item":     session.getItem(path) }
+
+    def _op_ping(self, session):
+        return True
+
+    def _op_list(self, session, path):
+        folders, files = session.listFolder(path)
+        stats = {}
+        for fpath in files:
+            stats[fpath] = self._stat(session, fpath)
+        return { "folders": folders, "files": files, "stats": stats }
+
+    def _op_stat(self, session, path):
+        return self._stat(session, path)
+
+    def _op_md5(self, session, path, remote=True):
+        if remote:
+            return session.getRemoteFileChecksum(path)
+        return session.getLocalFileChecksum(path)
+
+    def _op_info(self, session):
+        return session.getInfo()
+
+    def _op_filestatus(self, session, path):
+        return session.filestatus(path)
+
+    def _op_deadletters(self, session):
+        return session.getDeadLetters()
+
+    def _op_retrydeadletters(self, session):
+        return session.retryDeadLetters()
+
+    def _op_cleardeadletters(self, session):
+        return session.clearDeadLetters()
+
+
+class QueryClient(object):
+    "Client for the daemon query socket."
+
+    def __init__(self, path, account=None, timeout=30):
+        "Class constructor."
+        self._account = account
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path)
+        self._file = self._sock.makefile('rb')
+
+    def call(self, op, **args):
+        "Send a query to the daemon and return the result."
+        try:
+            self._sock.sendall(json.dumps({ "op": op, "args": args, "account": self._account }) + "\n")
+            line = self._file.readline()
+        except socket.timeout:
+            raise QueryError("Daemon did not answer the \"%s\" query in time" % op)
+        if not line:
+            raise QueryError("Daemon closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise QueryError(response["error"])
+        return response["result"]
+
+    def close(self):
+        "Close the connection."
+        self._file.close()
+        self._sock.close()
+
+
+class RemoteSession(object):
+    "Proxy for the query methods of the Session held by the running daemon."
+
+    def __init__(self, client):
+        "Class constructor."
+        self._client = client
+        self._stats = {}    ## Caches file stats returned by folder listings.
+
+    def _getStat(self, path):
+        if path not in self._stats:
+            self._stats[path] = self._client.call("stat", path=path)
+        return self._stats[path]
+
+    def readFolder(self, path):
+        "Get the list of items in the specified folder."
+        result = self._client.call("list", path=path)
+        self._stats.update(result["stats"])
+        return result["folders"], result["files"]
+
+    def getItem(self, path):
+        "Return the cached metadata for the specified remote path, or None."
+        return self._getStat(path)["item"]
+
+    def getFileSize(self, path):
+        "Return the size in bytes of the specified local or remote path, if it is a file."
+        return self._getStat(path)["size"]
+
+    def getFileDate(self, path):
+        "Return the last modified date of the specified local or remote path, if it is a file."
+        return self._getStat(path)["date"]
+
+    def getFileChecksum(self, path):
+        "Return the MD5 checksum of the specified local or remote path, if it is a file."
+        return self._getStat(path)["checksum"]
+
+    def getRemoteFileChecksum(self, path):
+        "Return the MD5 checksum of the specified remote path, if it is a file."
+        return self._client.call("md5", path=path, remote=True)
+
+    def getLocalFileChecksum(self, path):
+        "Return the MD5 checksum of the specified local path, if it is a file."
+        return self._client.call("md5", path=path, remote=False)
+
+    def getInfo(self):
+        "Return general information."
+        return self._client.call("info")
+
+    def filestatus(self, path, interactive=False):
+        "Get the status of a file."
+        return self._client.call("filestatus", path=path)
+
+    def getDeadLetters(self):
+        "Return the queued operations that have been given up on after failing repeatedly."
+        return self._client.call("deadletters")
+
+    def retryDeadLetters(self):
+        "Queue the operations that have been given up on to be run again. Returns the number queued."
+        return self._client.call("retrydeadletters")
+
+    def clearDeadLetters(self):
+        "Discard the operations that have been given up on, returning a list of them."
+        return self._client.call("cleardeadletters")
+
+
+def connect(config, account=None, path=None):
+    """Return a RemoteSession for the running daemon, or None if it is not available.
+       Another query socket, such as that of the FUSE mount, may be specified instead."""
+    if path == None:
+        path = config.getSocketFile()
+    if not os.path.exists(path):
+        return None
+    try:
+        client = QueryClient(path, account)
+        client.call("ping")
+    except (socket.error, QueryError), e:
+        logging.debug("Daemon query socket is not available: %s" % e)
+        return None
+    return RemoteSession(client)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import os, time, logging, threading, BaseHTTPServer
+
+
+# Default latency histogram bucket upper bounds, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+    "A cumulative histogram of observed values."
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        "Class constructor."
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        "Record a value."
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer(object):
+    "Context manager recording the duration of a block in a histogram."
+
+    def __init__(self, registry, name, labels):
+        self._registry = registry
+        self._name = name
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._registry.observe(self._name, time.time() - self._start, **self._labels)
+        return False
+
+
+class Registry(object):
+    "A thread-safe collection of counters, gauges and histograms."
+
+    def __init__(self):
+        "Class constructor."
+        self._lock = threading.Lock()
+        self._counters = {}     ## Maps (name, labels) to values.
+        self._gauges = {}       ## Maps (name, labels) to values, or to functions returning values.
+        self._histograms = {}   ## Maps (name, labels) to Histogram objects.
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted(labels.iteritems())))
+
+    def increment(self, name, value=1, **labels):
+        "Add a value to a counter."
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def setGauge(self, name, value, **labels):
+        "Set a gauge to a value, or to a function evaluated whenever the gauge is read."
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        "Record a value in a histogram."
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def timer(self, name, **labels):
+        "Return a context manager recording the duration of a block in a histogram."
+        return _Timer(self, name, labels)
+
+    def getCounter(self, name, **labels):
+        "Return the current value of a counter."
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    def _formatLabels(self, labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels)
+
+    def render(self):
+        "Return the metrics in the Prometheus text exposition format."
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append("# TYPE %s counter" % name)
+                typed.add(name)
+            lines.append("%s%s %s" % (name, self._formatLabels(labels), value))
+        for (name, labels), value in gauges:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    logging.exception("Failed to read gauge %s:" % name)
+                    continue
+            if name not in typed:
+                lines.append("# TYPE %s gauge" % name)
+                typed.add(name)
+            lines.append("%s%s %s" % (name, self._formatLabels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append("# TYPE %s histogram" % name)
+                typed.add(name)
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append("%s_bucket%s %d" % (name, self._formatLabels(labels, (("le", bound),)), count))
+            lines.append("%s_bucket%s %d" % (name, self._formatLabels(labels, (("le", "+Inf"),)), histogram.count))
+            lines.append("%s_sum%s %f" % (name, self._formatLabels(labels), histogram.sum))
+            lines.append("%s_count%s %d" % (name, self._formatLabels(labels), histogram.count))
+        lines.append("")
+        return "\n".join(lines)
+
+    def writeStatsFile(self, path):
+        "Atomically write the metrics to a file."
+        tmppath = path + ".tmp"
+        f = open(tmppath, 'w')
+        f.write(self.render())
+        f.close()
+        os.rename(tmppath, path)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Serves the metrics registry at /metrics."
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format % args)
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    "HTTP server exposing the metrics registry on localhost."
+
+    def __init__(self, port, registry):
+        "Class constructor."
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), _MetricsHandler)
+        self.registry = registry
+        self._thread = None
+
+    def start(self):
+        "Start serving metrics in a background thread."
+        logging.debug("Serving metrics on http://127.0.0.1:%d/metrics" % self.server_address[1])
+        self._thread = threading.Thread(target=self.serve_forever, name="metrics-server")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        "Stop serving metrics."
+        self.shutdown()
+        self.server_close()
+
+
+# The process-wide registry.
+registry = Registry()
+
+increment = registry.increment
+setGauge = registry.setGauge
+observe = registry.observe
+timer = registry.timer
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import os, threading, mimetypes, logging
+
+try:
+    import magic
+except ImportError:
+    magic = None
+
+
+DEFAULT_MIME_TYPE = "application/octet-stream"  # Used when the type cannot be detected.
+CACHE_SIZE = 16384                              # Maximum number of cached detection results.
+
+
+class MimeDetector(object):
+    "Thread-safe MIME type detector, with an extension fast path and a result cache."
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        "Class constructor."
+        self._local = threading.local()     ## Holds one libmagic instance per thread.
+        self._lock = threading.Lock()
+        self._cache = {}                    ## Maps (device, inode, mtime) to MIME type.
+        self._cache_size = cache_size
+        self._hits = 0
+        self._misses = 0
+
+    def _getMagic(self):
+        "Return the libmagic detector for the calling thread, creating it if necessary."
+        detector = getattr(self._local, "magic", None)
+        if detector is None and magic is not None:
+            # Loading the magic database is expensive, so do it once per worker thread.
+            detector = magic.Magic(mime=True)
+            self._local.magic = detector
+        return detector
+
+    def fromFile(self, path):
+        "Return the MIME type of the specified local file."
+        mime_type, encoding = mimetypes.guess_type(path, strict=False)
+        if mime_type and not encoding:
+            return mime_type
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_mtime)
+        with self._lock:
+            mime_type = self._cache.get(key)
+            if mime_type:
+                self._hits += 1
+                return mime_type
+            self._misses += 1
+        detector = self._getMagic()
+        if detector is None:
+            logging.debug("libmagic is not available, using default MIME type for %s" % path)
+            return DEFAULT_MIME_TYPE
+        mime_type = detector.from_file(path) or DEFAULT_MIME_TYPE
+        with self._lock:
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[key] = mime_type
+        return mime_type
+
+    def getStats(self):
+        "Return a dict of cache statistics."
+        with self._lock:
+            return { "hits": self._hits, "misses": self._misses, "size": len(self._cache) }
+
+
+_detector = None
+_detector_lock = threading.Lock()
+
+def getDetector():
+    "Return the process-wide MIME type detector."
+    global _detector
+    with _detector_lock:
+        if _detector is None:
+            _detector = MimeDetector()
+        return _detector
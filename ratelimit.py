@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import time, logging, threading, contextlib
+
+import metrics
+
+
+# Priority lanes. Requests in a lane wait while any request in a higher priority lane is waiting.
+INTERACTIVE = 0     # Requests a user is waiting for.
+BACKGROUND = 1      # Walks, change processing and other background sync work.
+
+_LANE_NAMES = ("interactive", "background")
+
+
+class RateGovernor(object):
+    """Limits the rate of API requests made by the process.
+
+    A token bucket is refilled at the current rate, up to a burst of one second's worth of
+    requests. The current rate starts at the configured budget, is halved when the service
+    reports that a rate limit has been exceeded (at most once a second), and then climbs back
+    slowly as requests succeed. A rate of 0 means no limit.
+    """
+
+    MIN_RATE = 0.5      # The rate never drops below this many requests per second.
+    RECOVERY = 0.02     # Fraction of the budget regained for each successful request.
+
+    def __init__(self, rate):
+        "Class constructor."
+        self._rate = float(rate)
+        self._current = self._rate
+        self._tokens = max(1.0, self._rate)
+        self._updated = time.time()
+        self._penalised = 0.0
+        self._waiting = [0, 0]      ## Number of requests waiting, per lane.
+        self._cond = threading.Condition(threading.Lock())
+        metrics.setGauge("gdrive_api_rate_limit", lambda: self._current)
+
+    def _refill(self, now):
+        "Add the tokens earned since the last refill. Called with the lock held."
+        capacity = max(1.0, self._current)
+        self._tokens = min(capacity, self._tokens + (now - self._updated) * self._current)
+        self._updated = now
+
+    def acquire(self, lane=BACKGROUND):
+        "Wait until a request may be made in the specified lane. Returns the time waited, in seconds."
+        if not self._rate:
+            return 0.0
+        start = time.time()
+        with self._cond:
+            self._waiting[lane] += 1
+            try:
+                while True:
+                    now = time.time()
+                    self._refill(now)
+                    if self._tokens >= 1 and not any(self._waiting[:lane]):
+                        self._tokens -= 1
+                        break
+                    # Wait for the next token, or for a higher priority request to take it.
+                    self._cond.wait(max(0.001, (1 - self._tokens) / self._current))
+            finally:
+                self._waiting[lane] -= 1
+                self._cond.notify_all()
+        waited = time.time() - start
+        if waited > 0.001:
+            metrics.increment("gdrive_api_throttled_seconds_total", waited, lane=_LANE_NAMES[lane])
+        return waited
+
+    def penalise(self):
+        "Slow down, since the service has reported that a rate limit was exceeded."
+        if not self._rate:
+            return
+        with self._cond:
+            now = time.time()
+            if now - self._penalised < 1.0:
+                return
+            self._penalised = now
+            self._current = max(self.MIN_RATE, self._current / 2)
+            # Stop any burst in progress.
+            self._tokens = min(self._tokens, 0.0)
+            logging.info("Rate limit exceeded, slowing down to %.1f requests per second" % self._current)
+
+    def reward(self):
+        "Speed up again after a successful request, up to the configured budget."
+        if self._current >= self._rate:
+            return
+        with self._cond:
+            self._current = min(self._rate, self._current + self._rate * self.RECOVERY)
+
+    def getRate(self):
+        "Return the current request rate limit."
+        return self._current
+
+
+_lanes = threading.local()
+
+@contextlib.contextmanager
+def lane(priority):
+    "Run requests made by the current thread in the specified lane."
+    previous = getattr(_lanes, "priority", None)
+    _lanes.priority = priority
+    try:
+        yield
+    finally:
+        _lanes.priority = previous
+
+def currentLane(default=BACKGROUND):
+    "Return the lane for requests made by the current thread."
+    priority = getattr(_lanes, "priority", None)
+    if priority is None:
+        return default
+    return priority
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+def getGovernor(rate):
+    "Return the process-wide rate governor, creating it with the specified budget on first use."
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = RateGovernor(rate)
+        return _governor
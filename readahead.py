@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import logging, threading, Queue
+
+import ratelimit
+
+
+class Prefetcher(object):
+    """A pool of background threads fetching file content ahead of readers.
+
+    Work that arrives while more than backlog items are waiting is dropped, since a reader that
+    far ahead of the prefetchers will fetch what it needs itself.
+    """
+
+    def __init__(self, workers=4, backlog=64):
+        "Class constructor."
+        self._queue = Queue.Queue(backlog)
+        self._workers = workers
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _run(self):
+        "Worker thread main loop."
+        # Nobody is waiting for a prefetch yet, so it gives way to reads.
+        with ratelimit.lane(ratelimit.BACKGROUND):
+            while True:
+                func, args = self._queue.get()
+                try:
+                    func(*args)
+                except Exception, e:
+                    logging.debug("Prefetch failed: %s" % e)
+
+    def submit(self, func, *args):
+        "Run func in the background, unless the prefetchers are too far behind."
+        with self._lock:
+            # Start the threads on first use, which is after FUSE has forked into the background.
+            while len(self._threads) < self._workers:
+                thread = threading.Thread(target=self._run, name="prefetch-%d" % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        try:
+            self._queue.put_nowait((func, args))
+        except Queue.Full:
+            logging.debug("Prefetch queue full, dropping work")
+
+
+class ReadAhead(object):
+    """Reads one open file through the block cache, prefetching ahead of sequential readers.
+
+    A read starting within a block of where the last one ended is sequential. Sequential reads go
+    through the cache in whole blocks, and keep a window of blocks beyond the read being fetched
+    in the background. The window starts at one block and doubles each time the reader gets
+    within half a window of its end, up to max_window bytes. Any other read is random, and resets
+    the window: it is answered from the cache if possible, and otherwise with a ranged request
+    for just the bytes asked for.
+    """
+
+    def __init__(self, cache, prefetcher, res_id, revision, file_size, fetch, max_window):
+        "Class constructor."
+        self._cache = cache
+        self._prefetcher = prefetcher
+        self._res_id = res_id
+        self._revision = revision
+        self._file_size = file_size
+        self._fetch = fetch         ## Callable fetching the bytes between a start and end offset.
+        self._block_size = cache.getBlockSize()
+        self._max_window = max(max_window, self._block_size)
+        self._lock = threading.Lock()
+        self._next = 0              ## Where the next sequential read is expected to start.
+        self._window = 0            ## Current read-ahead window, in bytes.
+        self._ahead = 0             ## End of the content scheduled for prefetching.
+
+    def _schedule(self, start, end):
+        "Prefetch the blocks holding the bytes from start up to end."
+        for index in xrange(start // self._block_size, (end - 1) // self._block_size + 1):
+            self._prefetcher.submit(self._cache.prefetch, self._res_id, self._revision, self._file_size, index, self._fetch)
+
+    def read(self, offset, length):
+        "Read length bytes at offset."
+        end = min(offset + length, self._file_size)
+        if offset >= end:
+            return ''
+        prefetch = None
+        with self._lock:
+            # Concurrent reads of a stream may arrive slightly out of order.
+            sequential = abs(offset - self._next) <= self._block_size
+            if sequential:
+                self._next = max(self._next, end)
+                if end > self._ahead - self._window // 2:
+                    self._window = min(max(self._window * 2, self._block_size), self._max_window)
+                    prefetch = (max(self._ahead, end), min(end + self._window, self._file_size))
+                    self._ahead = prefetch[1]
+            else:
+                self._next = end
+                self._window = 0
+                self._ahead = 0
+        if prefetch and prefetch[0] < prefetch[1]:
+            self._schedule(*prefetch)
+        if sequential:
+            return self._cache.read(self._res_id, self._revision, self._file_size, offset, length, self._fetch)
+        data = self._cache.peek(self._res_id, self._revision, self._file_size, offset, length)
+        if data is None:
+            data = self._fetch(offset, end)
+        return data
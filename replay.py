@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Records the HTTP traffic of a Session to a fixture directory, and replays it from a local
+# server, so that walks, updates and downloads can be benchmarked offline.
+#
+# Record (against the live service):   python replay.py record FIXTUREDIR [--download PATH]
+# Benchmark (offline):                  python replay.py bench FIXTUREDIR [--latency SECONDS] ...
+# Compare feed sizes and parse times:   python replay.py feeds FIXTUREDIR [FIXTUREDIR ...]
+
+import os, re, sys, time, json, random, shutil, logging, urllib, urlparse, optparse, tempfile, contextlib
+import threading, ConfigParser, SocketServer, BaseHTTPServer, cStringIO
+
+import atom.core
+import atom.http_core
+import gdata.docs.client
+import gdata.docs.data
+
+from drive_config import DriveConfig
+from httppool import PooledHttpClient
+
+
+INDEX_FILE = "index.jsonl"          # Fixture index file name, one recorded exchange per line.
+BODY_DIR = "bodies"                 # Directory holding recorded response bodies.
+HOST_HEADER = "X-Replay-Host"       # Carries the original host of a request to the replay server.
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-(\d*)$")   # Matches the single byte ranges that Session.fetchRange asks for.
+
+# Hosts whose traffic is never recorded, since it carries credentials.
+PRIVATE_HOSTS = ("accounts.google.com",)
+
+# Response headers worth keeping in fixtures.
+RECORDED_HEADERS = ("content-type", "etag", "location", "retry-after", "last-modified")
+
+
+def _normalise(path):
+    "Return a request path with its query parameters in a canonical order."
+    parts = urlparse.urlsplit(path)
+    query = urlparse.parse_qsl(parts.query, keep_blank_values=True)
+    query.sort()
+    if query:
+        return "%s?%s" % (parts.path, urllib.urlencode(query))
+    return parts.path
+
+
+class _ReplayedResponse(object):
+    "An HTTP response whose body has already been read into memory."
+
+    def __init__(self, status, reason, headers, body):
+        "Class constructor."
+        self.status = status
+        self.reason = reason
+        self.will_close = False
+        self._headers = headers
+        self._body = cStringIO.StringIO(body)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._body.read()
+        return self._body.read(amt)
+
+    def getheader(self, name, default=None):
+        for header, value in self._headers:
+            if header.lower() == name.lower():
+                return value
+        return default
+
+    def getheaders(self):
+        return list(self._headers)
+
+    def isclosed(self):
+        return self._body.tell() == len(self._body.getvalue())
+
+    def close(self):
+        pass
+
+
+class RecordingHttpClient(PooledHttpClient):
+    "A pooled HTTP client that writes every exchange with the service to a fixture directory."
+
+    def __init__(self, fixturedir, max_per_host=16):
+        "Class constructor."
+        PooledHttpClient.__init__(self, max_per_host)
+        self._fixturedir = fixturedir
+        self._record_lock = threading.Lock()    ## Guards the fixture index. The pool has its own lock.
+        self._count = 0
+        if not os.path.isdir(os.path.join(fixturedir, BODY_DIR)):
+            os.makedirs(os.path.join(fixturedir, BODY_DIR))
+        self._index = open(os.path.join(fixturedir, INDEX_FILE), 'a')
+
+    def _http_request(self, method, uri, headers=None, body_parts=None):
+        "Make a request, recording the response."
+        if isinstance(uri, (str, unicode)):
+            uri = atom.http_core.Uri.parse_uri(uri)
+        response = PooledHttpClient._http_request(self, method, uri, headers, body_parts)
+        if uri.host in PRIVATE_HOSTS:
+            return response
+        body = response.read()
+        headers = [(name, value) for name, value in response.getheaders() if name.lower() in RECORDED_HEADERS]
+        with self._record_lock:
+            self._count += 1
+            bodyfile = os.path.join(BODY_DIR, "%06d" % self._count)
+            f = open(os.path.join(self._fixturedir, bodyfile), 'wb')
+            f.write(body)
+            f.close()
+            record = { "method": method,
+                       "host": uri.host,
+                       "path": _normalise(uri._get_relative_path()),
+                       "status": response.status,
+                       "reason": response.reason,
+                       "headers": headers,
+                       "body": bodyfile }
+            self._index.write(json.dumps(record) + "\n")
+            self._index.flush()
+        return _ReplayedResponse(response.status, response.reason, response.getheaders(), body)
+
+    def close(self):
+        "Close the fixture index and any idle connections."
+        self._index.close()
+        PooledHttpClient.close(self)
+
+
+class ReplayHttpClient(PooledHttpClient):
+    "A pooled HTTP client that sends every request to a replay server, whatever its URI."
+
+    def __init__(self, port, max_per_host=16):
+        "Class constructor."
+        PooledHttpClient.__init__(self, max_per_host)
+        self._port = port
+
+    def _http_request(self, method, uri, headers=None, body_parts=None):
+        "Redirect a request to the replay server."
+        if isinstance(uri, (str, unicode)):
+            uri = atom.http_core.Uri.parse_uri(uri)
+        headers = dict(headers or {})
+        headers[HOST_HEADER] = uri.host
+        local = atom.http_core.Uri(scheme='http', host='127.0.0.1', port=self._port, path=uri.path, query=uri.query)
+        return PooledHttpClient._http_request(self, method, local, headers, body_parts)
+
+    def _getProxy(self, key):
+        "The replay server is local, so never go through a proxy."
+        return None
+
+
+class _ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Answers requests from the recorded fixtures."
+
+    protocol_version = "HTTP/1.1"
+
+    def _replay(self):
+        length = int(self.headers.getheader("content-length") or 0)
+        if length:
+            self.rfile.read(length)
+        host = self.headers.getheader(HOST_HEADER, "")
+        status, reason, headers, body = self.server.lookup(self.command, host, _normalise(self.path))
+        match = RANGE_PATTERN.match(self.headers.getheader("range", ""))
+        if status == 200 and match:
+            # Answer a ranged request from the whole recorded body.
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(body) - 1), len(body) - 1)
+            if start >= len(body):
+                status, reason, body = 416, "Requested Range Not Satisfiable", ""
+            else:
+                headers = headers + [("Content-Range", "bytes %d-%d/%d" % (start, end, len(body)))]
+                status, reason, body = 206, "Partial Content", body[start:end + 1]
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status, reason)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.server.send(self.wfile, body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _replay
+
+    def log_message(self, format, *args):
+        logging.debug("Replay: " + format % args)
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server replaying recorded fixtures.
+
+    Each request is answered after latency seconds, with the body sent at no more than bandwidth
+    bytes per second (0 for no limit). A fraction error_rate of requests, chosen by a random
+    generator seeded with seed, fails with 503 Service Unavailable. Requests recorded several
+    times are answered with each recording in turn, and then the last one repeatedly.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, fixturedir, latency=0.0, bandwidth=0, error_rate=0.0, seed=0):
+        "Class constructor."
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), _ReplayHandler)
+        self.latency = latency
+        self._fixturedir = fixturedir
+        self._bandwidth = bandwidth
+        self._error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._fixtures = {}     ## Lists of recorded exchanges, keyed by (method, host, path).
+        self._served = {}       ## The number of times each key has been served.
+        self._thread = None
+        self.stats = { "requests": 0, "errors": 0, "missing": 0, "bytes": 0 }
+        self._loadFixtures()
+
+    def _loadFixtures(self):
+        "Read the fixture index."
+        f = open(os.path.join(self._fixturedir, INDEX_FILE), 'r')
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                key = (record["method"], record["host"], record["path"])
+                self._fixtures.setdefault(key, []).append(record)
+        finally:
+            f.close()
+        logging.debug("Loaded %d fixtures" % len(self._fixtures))
+
+    def lookup(self, method, host, path):
+        "Return the (status, reason, headers, body) to answer a request with."
+        with self._lock:
+            self.stats["requests"] += 1
+            if self._error_rate and self._random.random() < self._error_rate:
+                self.stats["errors"] += 1
+                return 503, "Service Unavailable", [("Retry-After", "0")], "Injected error"
+            key = (method, host, path)
+            records = self._fixtures.get(key)
+            if not records:
+                self.stats["missing"] += 1
+                logging.warn("No fixture for %s %s%s" % key)
+                return 404, "Not Found", [], "No fixture"
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+            record = records[min(served, len(records) - 1)]
+        f = open(os.path.join(self._fixturedir, record["body"]), 'rb')
+        body = f.read()
+        f.close()
+        return record["status"], record["reason"], [tuple(header) for header in record["headers"]], body
+
+    def send(self, wfile, body):
+        "Write a response body, throttled to the configured bandwidth."
+        chunk = 16384
+        for offset in xrange(0, len(body), chunk):
+            data = body[offset:offset + chunk]
+            wfile.write(data)
+            if self._bandwidth:
+                time.sleep(float(len(data)) / self._bandwidth)
+        with self._lock:
+            self.stats["bytes"] += len(body)
+
+    def getClient(self):
+        "Return an unauthorised Docs client whose requests all go to this server."
+        client = gdata.docs.client.DocsClient(source=DriveConfig.APP_NAME)
+        client.http_client = ReplayHttpClient(self.server_address[1])
+        return client
+
+    def start(self):
+        "Start serving fixtures in a background thread."
+        self._thread = threading.Thread(target=self.serve_forever, name="replay-server")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        "Stop serving fixtures."
+        self.shutdown()
+        self.server_close()
+
+
+def _setOptions(account, options):
+    "Set configuration options of an account, from a dict of dicts keyed by section and option."
+    config = DriveConfig(account=account)
+    cfgfile = config.getConfigFile(config.CONFIG_FILE)
+    parser = ConfigParser.RawConfigParser()
+    parser.read(cfgfile)
+    for section, values in options.items():
+        if not parser.has_section(section):
+            parser.add_section(section)
+        for option, value in values.items():
+            parser.set(section, option, value)
+    f = open(cfgfile, 'w')
+    parser.write(f)
+    f.close()
+
+
+@contextlib.contextmanager
+def scratchConfig(options=None):
+    """Run with a throwaway configuration directory, with any options specified as a dict of
+       dicts keyed by section and option. Yields the path of its local storage tree."""
+    # Keep the configuration and metadata of benchmarks apart from the user's.
+    home = tempfile.mkdtemp(prefix="gdrive-bench-")
+    saved_home = os.environ.get("XDG_CONFIG_HOME")
+    os.environ["XDG_CONFIG_HOME"] = home
+    try:
+        localroot = os.path.join(home, "local")
+        os.mkdir(localroot)
+        options = dict(options or {})
+        options["localstore"] = { "path": localroot }
+        _setOptions(None, options)
+        yield localroot
+    finally:
+        if saved_home is None:
+            del os.environ["XDG_CONFIG_HOME"]
+        else:
+            os.environ["XDG_CONFIG_HOME"] = saved_home
+        shutil.rmtree(home)
+
+
+def timed(timings, name, func, *args, **kwargs):
+    "Call func, recording how long it took."
+    t1 = time.time()
+    result = func(*args, **kwargs)
+    timings.append((name, time.time() - t1))
+    return result
+
+
+def _update(session):
+    """Make the requests of a metadata update, without touching any local files: the change feed
+       since the walk, and a conditional listing of the root folder."""
+    session._getChangeList(session._getLargestChangestamp())
+    session._readFolder('/')
+
+
+def record(fixturedir, account=None, download=None, verbose=False, debug=False):
+    "Record the traffic of a full walk, an update and optionally a download."
+    import gdocs
+    # Only the credentials are taken from the account, so that its metadata, queue and local tree are left alone.
+    credentials = DriveConfig(account=account)
+    tokenfiles = (credentials.getTokenFile(), credentials.getAccessTokenFile())
+    with scratchConfig({ "general": { "rate": "0" } }) as localroot:
+        config = DriveConfig()
+        for src, dst in zip(tokenfiles, (config.getTokenFile(), config.getAccessTokenFile())):
+            if os.path.exists(src):
+                shutil.copy(src, dst)
+        http_client = RecordingHttpClient(fixturedir)
+        try:
+            # The scratch configuration has no cached metadata, so creating the session walks the whole tree.
+            session = gdocs.Session(verbose, debug, http_client=http_client)
+            _update(session)
+            if download:
+                session.download(download, os.path.join(localroot, os.path.basename(download)), overwrite=True)
+            session.close()
+        finally:
+            http_client.close()
+
+
+def bench(fixturedir, latency=0.0, bandwidth=0, error_rate=0.0, seed=0, download=None, rate=0, verbose=False, debug=False):
+    """Time a walk, an update and optionally a download against the replay server, making at most
+       rate requests per second (0 for no limit). Returns the timings."""
+    import gdocs
+    server = ReplayServer(fixturedir, latency, bandwidth, error_rate, seed)
+    server.start()
+    timings = []
+    try:
+        with scratchConfig({ "general": { "rate": str(rate) } }) as localroot:
+            session = timed(timings, "walk", gdocs.Session, verbose, debug, client=server.getClient())
+            timed(timings, "update", _update, session)
+            if download:
+                timed(timings, "download", session.download, download, os.path.join(localroot, os.path.basename(download)), overwrite=True)
+    finally:
+        server.stop()
+    return timings, server.stats
+
+
+def measureFeeds(fixturedir):
+    "Return the number of pages, entries and bytes of the recorded folder and change feeds, and the time taken to parse them."
+    totals = { "pages": 0, "entries": 0, "bytes": 0, "seconds": 0.0 }
+    f = open(os.path.join(fixturedir, INDEX_FILE), 'r')
+    records = [json.loads(line) for line in f if line.strip()]
+    f.close()
+    for record in records:
+        path = record["path"].split('?')[0]
+        if record["status"] != 200:
+            continue
+        if path.endswith("/changes"):
+            desired_class = gdata.docs.data.ChangeFeed
+        elif path.endswith("/contents"):
+            desired_class = gdata.docs.data.ResourceFeed
+        else:
+            continue
+        f = open(os.path.join(fixturedir, record["body"]), 'rb')
+        body = f.read()
+        f.close()
+        t1 = time.time()
+        feed = atom.core.parse(body, desired_class)
+        totals["seconds"] += time.time() - t1
+        totals["pages"] += 1
+        totals["entries"] += len(feed.entry)
+        totals["bytes"] += len(body)
+    return totals
+
+
+def _parseArgs():
+    "Parse command-line arguments."
+    helpStr = """
+%prog record|bench|feeds FIXTUREDIR [options]
+
+Record Docs API traffic to fixtures, benchmark a session against them offline, or
+compare the size and parse time of the feeds recorded in several fixture directories.
+
+"""
+    parser = optparse.OptionParser(usage=helpStr)
+    parser.add_option('-v', '--verbose',    dest='verbose',    action='store_true', default=False, help='Turn on extra logging')
+    parser.add_option('-d', '--debug',      dest='debug',      action='store_true', default=False, help='Turn on debug logging')
+    parser.add_option('-a', '--account',    dest='account',    action='store',      default=None,  help='Record the named account')
+    parser.add_option('--download',         dest='download',   action='store',      default=None,  help='Also download the specified remote path')
+    parser.add_option('--latency',          dest='latency',    action='store',      default=0.0,   type='float', help='Seconds to wait before each response')
+    parser.add_option('--bandwidth',        dest='bandwidth',  action='store',      default=0,     type='int',   help='Response bandwidth in bytes per second')
+    parser.add_option('--error-rate',       dest='error_rate', action='store',      default=0.0,   type='float', help='Fraction of requests to fail with 503')
+    parser.add_option('--seed',             dest='seed',       action='store',      default=0,     type='int',   help='Seed for error injection')
+    parser.add_option('--rate',             dest='rate',       action='store',      default=0.0,   type='float', help='Request budget in requests per second (0 for none)')
+    (options, args) = parser.parse_args()
+    if len(args) < 2 or args[0] not in ("record", "bench", "feeds") or (args[0] != "feeds" and len(args) != 2):
+        parser.error("expected record, bench or feeds and a fixture directory")
+    return (options, args)
+
+
+def main():
+    "Main function."
+    (opts, args) = _parseArgs()
+    command, fixturedir = args[0], args[1]
+    if command == "feeds":
+        print "%-30s %6s %8s %12s %10s %12s" % ("fixtures", "pages", "entries", "bytes/entry", "parse s", "parse ms/entry")
+        for fixturedir in args[1:]:
+            totals = measureFeeds(fixturedir)
+            entries = max(totals["entries"], 1)
+            print "%-30s %6d %8d %12.0f %10.3f %12.3f" % (fixturedir[-30:], totals["pages"], totals["entries"],
+                                                         float(totals["bytes"]) / entries, totals["seconds"],
+                                                         totals["seconds"] * 1000 / entries)
+        return
+    if command == "record":
+        record(fixturedir, opts.account, opts.download, opts.verbose, opts.debug)
+        return
+    timings, stats = bench(fixturedir, opts.latency, opts.bandwidth, opts.error_rate, opts.seed, opts.download, opts.rate, opts.verbose, opts.debug)
+    for name, elapsed in timings:
+        print "%-10s %8.3f s" % (name, elapsed)
+    print "requests   %8d (%d injected errors, %d without fixtures)" % (stats["requests"], stats["errors"], stats["missing"])
+    print "bytes      %8d" % stats["bytes"]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import time, random, socket, httplib, logging, threading
+
+import gdata.client
+
+import metrics
+import ratelimit
+
+
+# HTTP status codes worth retrying.
+TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# Reasons given in 403 responses when a rate limit has been hit.
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+class CircuitOpenError(gdata.client.Error):
+    "Raised instead of making a request while the service is believed to be unavailable."
+    pass
+
+
+def isTransient(error):
+    """Return True if a request that failed with the specified exception is worth retrying.
+       Network errors are, but other I/O errors (e.g. a missing or unreadable local file) are not."""
+    if isinstance(error, (socket.error, httplib.HTTPException)):
+        return True
+    if isinstance(error, gdata.client.RequestError):
+        return error.status in TRANSIENT_STATUSES or isRateLimited(error)
+    return False
+
+
+def isRateLimited(error):
+    "Return True if a request failed because a rate limit was exceeded."
+    if not isinstance(error, gdata.client.RequestError):
+        return False
+    if error.status == 429:
+        return True
+    if error.status == 403 and error.body:
+        for reason in RATE_LIMIT_REASONS:
+            if reason in error.body:
+                return True
+    return False
+
+
+def getRetryAfter(error):
+    "Return the delay in seconds requested by a Retry-After header on the error response, or None."
+    headers = getattr(error, "headers", None)
+    if not headers:
+        return None
+    if isinstance(headers, dict):
+        headers = headers.items()
+    for name, value in headers:
+        if name.lower() == "retry-after":
+            try:
+                return max(0, int(value))
+            except ValueError:
+                # An HTTP date, rather than a number of seconds.
+                return None
+    return None
+
+
+class RetryPolicy(object):
+    """Calls a function, retrying transient failures with decorrelated jitter.
+
+    Permanent failures (e.g. 404, bad requests) are raised immediately. After a number of
+    consecutive calls have failed, the circuit opens and calls fail fast with CircuitOpenError
+    until the cooldown has passed, after which a single trial call is allowed through.
+    """
+
+    def __init__(self, attempts=5, base_delay=1.0, max_delay=32.0, failure_threshold=5, cooldown=60.0,
+                 governor=None, lane=ratelimit.BACKGROUND):
+        "Class constructor. Each attempt waits for the governor, if any, in the lane of the calling thread or else the specified lane."
+        self._governor = governor
+        self._lane = lane
+        self._attempts = attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0          ## Number of consecutive calls that failed with transient errors.
+        self._opened = None         ## The time at which the circuit opened, or None if it is closed.
+        self._trial = False         ## True while a trial call is in progress on a half-open circuit.
+
+    def _before(self, endpoint):
+        "Fail fast if the circuit is open."
+        with self._lock:
+            if self._opened is None:
+                return
+            if time.time() - self._opened < self._cooldown or self._trial:
+                metrics.increment("gdrive_api_rejected_total", endpoint=endpoint)
+                raise CircuitOpenError("Service unavailable, not calling %s" % endpoint)
+            self._trial = True
+
+    def _after(self, success):
+        "Update the circuit state with the outcome of a call."
+        with self._lock:
+            self._trial = False
+            if success:
+                if self._opened is not None:
+                    logging.info("Service is available again, closing circuit")
+                self._failures = 0
+                self._opened = None
+                return
+            self._failures += 1
+            if self._failures >= self._failure_threshold:
+                if self._opened is None:
+                    logging.warn("%d consecutive requests failed, opening circuit for %d seconds" % (self._failures, self._cooldown))
+                self._opened = time.time()
+
+    def call(self, endpoint, func, *args, **kwargs):
+        "Call func, retrying transient failures. The endpoint names the call in logs and metrics."
+        self._before(endpoint)
+        delay = self._base_delay
+        attempt = 0
+        while True:
+            attempt += 1
+            if self._governor:
+                self._governor.acquire(ratelimit.currentLane(self._lane))
+            metrics.increment("gdrive_api_calls_total", endpoint=endpoint)
+            try:
+                with metrics.timer("gdrive_api_latency_seconds", endpoint=endpoint):
+                    result = func(*args, **kwargs)
+            except gdata.client.NotModified:
+                # Not a failure, just a conditional request that matched.
+                self._after(True)
+                raise
+            except Exception, e:
+                if self._governor and isRateLimited(e):
+                    self._governor.penalise()
+                if not isTransient(e):
+                    metrics.increment("gdrive_api_errors_total", endpoint=endpoint, kind="permanent")
+                    self._after(True)
+                    raise
+                metrics.increment("gdrive_api_errors_total", endpoint=endpoint, kind="transient")
+                if attempt >= self._attempts:
+                    self._after(False)
+                    raise
+                delay = min(self._max_delay, random.uniform(self._base_delay, delay * 3))
+                retry_after = getRetryAfter(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                logging.debug("%s failed (%s), retrying in %.2f seconds" % (endpoint, e, delay))
+                metrics.increment("gdrive_api_retries_total", endpoint=endpoint)
+                time.sleep(delay)
+                continue
+            if self._governor:
+                self._governor.reward()
+            self._after(True)
+            return result
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Benchmarks a Session against a synthetic drive, and flags regressions against a saved baseline.
+#
+# Usage: python scalebench.py [--fanout N] [--depth N] [--files N] [--changes N]
+#                             [--save-baseline FILE | --baseline FILE [--threshold FRACTION]]
+
+import sys, json, logging, optparse, resource
+
+import gdocs
+import replay
+from synthetic import DriveShape, SyntheticDrive
+
+
+def run(shape, changes, new_fraction=0.1, verbose=False, debug=False):
+    "Run the benchmark suite, returning a dict of results."
+    results = {}
+    timings = []
+    drive = replay.timed(timings, "generate", SyntheticDrive, shape)
+    results["resources"] = drive.getNumResources()
+    # Measure the session itself, rather than the request budget.
+    with replay.scratchConfig({ "general": { "rate": "0" } }):
+        session = replay.timed(timings, "walk", gdocs.Session, verbose, debug, client=drive)
+        replay.timed(timings, "count", lambda: (session.getNumResources('/'),
+                                                session.getNumRemoteFolders('/'),
+                                                session.getNumRemoteFiles('/')))
+        replay.timed(timings, "save", session._save)
+        replay.timed(timings, "load", session._load)
+        # The first update records the changestamp, so that the next only sees the new changes.
+        replay.timed(timings, "verify", session.update, '/', download=False, interactive=False)
+        drive.mutate(changes, new_fraction)
+        replay.timed(timings, "update", session.update, '/', download=False, interactive=False)
+        results["indexed"] = session.getNumResources('/')
+    for name, elapsed in timings:
+        results["%s_seconds" % name] = elapsed
+    # ru_maxrss is in KiB on Linux.
+    results["maxrss_mib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return results
+
+
+def compare(results, baseline, threshold):
+    "Return the list of (name, value, baseline value) for results worse than the baseline by more than threshold."
+    regressions = []
+    for name, value in sorted(results.items()):
+        if not (name.endswith("_seconds") or name.endswith("_mib")):
+            continue
+        if name not in baseline:
+            continue
+        if value > baseline[name] * (1 + threshold):
+            regressions.append((name, value, baseline[name]))
+    return regressions
+
+
+def _parseArgs():
+    "Parse command-line arguments."
+    helpStr = """
+%prog [options]
+
+Benchmark a session against a synthetic drive of the specified shape.
+
+"""
+    parser = optparse.OptionParser(usage=helpStr)
+    parser.add_option('-v', '--verbose',     dest='verbose',       action='store_true', default=False,       help='Turn on extra logging')
+    parser.add_option('-d', '--debug',       dest='debug',         action='store_true', default=False,       help='Turn on debug logging')
+    parser.add_option('--fanout',            dest='fanout',        action='store', type='int',   default=10,          help='Subfolders per folder')
+    parser.add_option('--depth',             dest='depth',         action='store', type='int',   default=3,           help='Depth of the folder tree')
+    parser.add_option('--files',             dest='files',         action='store', type='int',   default=20,          help='Files per folder')
+    parser.add_option('--sizes',             dest='sizes',         action='store',               default='lognormal', help='File size distribution (fixed, uniform, lognormal)')
+    parser.add_option('--mean-size',         dest='mean_size',     action='store', type='int',   default=262144,      help='Mean file size in bytes')
+    parser.add_option('--duplicates',        dest='duplicates',    action='store', type='float', default=0.0,         help='Fraction of files that share a name with a sibling')
+    parser.add_option('--changes',           dest='changes',       action='store', type='int',   default=1000,        help='Changes to apply before the timed update')
+    parser.add_option('--new-fraction',      dest='new_fraction',  action='store', type='float', default=0.1,         help='Fraction of changes that add a file')
+    parser.add_option('--seed',              dest='seed',          action='store', type='int',   default=0,           help='Seed for the generator')
+    parser.add_option('--baseline',          dest='baseline',      action='store',               default=None,        help='Compare against the results saved in this file')
+    parser.add_option('--save-baseline',     dest='save_baseline', action='store',               default=None,        help='Save the results to this file')
+    parser.add_option('--threshold',         dest='threshold',     action='store', type='float', default=0.2,         help='Fractional slowdown counted as a regression')
+    (options, args) = parser.parse_args()
+    return (options, args)
+
+
+def main():
+    "Main function."
+    (opts, args) = _parseArgs()
+    shape = DriveShape(opts.fanout, opts.depth, opts.files, opts.sizes, opts.mean_size, opts.duplicates, opts.seed)
+    results = run(shape, opts.changes, opts.new_fraction, opts.verbose, opts.debug)
+    for name, value in sorted(results.items()):
+        print "%-20s %12.3f" % (name, value)
+    # Results are only comparable between runs against drives of the same shape.
+    shape = dict(vars(shape), changes=opts.changes, new_fraction=opts.new_fraction)
+    if opts.save_baseline:
+        f = open(opts.save_baseline, 'w')
+        json.dump({ "shape": shape, "results": results }, f, indent=2, sort_keys=True)
+        f.close()
+    if opts.baseline:
+        f = open(opts.baseline, 'r')
+        baseline = json.load(f)
+        f.close()
+        if baseline["shape"] != shape:
+            print >>sys.stderr, "Error: the baseline was measured on a drive of another shape: %s" % baseline["shape"]
+            return 2
+        regressions = compare(results, baseline["results"], opts.threshold)
+        for name, value, expected in regressions:
+            print "REGRESSION: %s is %.3f, baseline %.3f" % (name, value, expected)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Benchmarks sequential reads of a file, as a FUSE mount would see them, against a local
+# stand-in server answering ranged requests with a configurable latency and bandwidth.
+#
+# Usage: python seqbench.py [--size MIB] [--read-size KIB] [--latency SECONDS] [--bandwidth BYTES]
+
+import os, sys, json, random, shutil, logging, optparse, tempfile
+
+import gdocs
+import replay
+from blockcache import BlockCache
+from readahead import Prefetcher, ReadAhead
+
+
+HOST = "doc-bench.googleusercontent.com"    # Host the benchmark file is served from.
+PATH = "/bench/content"                     # Path the benchmark file is served from.
+
+MODES = ("direct", "cached", "readahead")
+
+
+def _makeFixtures(fixturedir, size, seed):
+    "Write a fixture directory serving a file of random content of the specified size."
+    os.mkdir(os.path.join(fixturedir, replay.BODY_DIR))
+    bodyfile = os.path.join(replay.BODY_DIR, "content")
+    generator = random.Random(seed)
+    f = open(os.path.join(fixturedir, bodyfile), 'wb')
+    for offset in xrange(0, size, 65536):
+        f.write("".join(chr(generator.getrandbits(8)) for i in xrange(min(65536, size - offset))))
+    f.close()
+    f = open(os.path.join(fixturedir, replay.INDEX_FILE), 'w')
+    f.write(json.dumps({ "method": "GET", "host": HOST, "path": PATH, "status": 200, "reason": "OK",
+                         "headers": [["content-type", "application/octet-stream"]], "body": bodyfile }) + "\n")
+    f.close()
+
+
+def _stream(session, mode, size, read_size, cachedir, block_size, readahead, threads):
+    "Read the whole file sequentially in read_size requests, returning its content."
+    uri = "https://%s%s" % (HOST, replay._normalise(PATH))
+    fetch = lambda start, end: session.fetchRange(uri, start, end)
+    if mode == "direct":
+        read = lambda offset: fetch(offset, min(offset + read_size, size))
+    else:
+        cache = BlockCache(cachedir, size * 2, block_size)
+        if mode == "cached":
+            read = lambda offset: cache.read("bench", "1", size, offset, read_size, fetch)
+        else:
+            handle = ReadAhead(cache, Prefetcher(threads), "bench", "1", size, fetch, readahead)
+            read = lambda offset: handle.read(offset, read_size)
+    return "".join(read(offset) for offset in xrange(0, size, read_size))
+
+
+def run(size, read_size, latency=0.0, bandwidth=0, block_size=1048576, readahead=8388608, threads=4, seed=0,
+        verbose=False, debug=False):
+    "Run the benchmark in each mode, returning a list of (mode, seconds, requests) tuples."
+    fixturedir = tempfile.mkdtemp(prefix="gdrive-seqbench-")
+    results = []
+    try:
+        _makeFixtures(fixturedir, size, seed)
+        f = open(os.path.join(fixturedir, replay.BODY_DIR, "content"), 'rb')
+        expected = f.read()
+        f.close()
+        server = replay.ReplayServer(fixturedir, latency, bandwidth)
+        server.start()
+        try:
+            with replay.scratchConfig({ "general": { "rate": "0" } }) as localroot:
+                # There are no folder fixtures, so the session starts out knowing of no files.
+                session = gdocs.Session(verbose, debug, client=server.getClient())
+                for mode in MODES:
+                    cachedir = os.path.join(localroot, "blocks-%s" % mode)
+                    requests = server.stats["requests"]
+                    timings = []
+                    data = replay.timed(timings, mode, _stream, session, mode, size, read_size, cachedir,
+                                        block_size, readahead, threads)
+                    if data != expected:
+                        raise AssertionError("%s read returned the wrong content" % mode)
+                    results.append((mode, timings[0][1], server.stats["requests"] - requests))
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(fixturedir)
+    return results
+
+
+def _parseArgs():
+    "Parse command-line arguments."
+    helpStr = """
+%prog [options]
+
+Benchmark sequential reads through the block cache, with and without read-ahead.
+
+"""
+    parser = optparse.OptionParser(usage=helpStr)
+    parser.add_option('-v', '--verbose',     dest='verbose',       action='store_true', default=False,       help='Turn on extra logging')
+    parser.add_option('-d', '--debug',       dest='debug',         action='store_true', default=False,       help='Turn on debug logging')
+    parser.add_option('--size',              dest='size',          action='store', type='int',   default=32,          help='File size in MiB')
+    parser.add_option('--read-size',         dest='read_size',     action='store', type='int',   default=128,         help='Size of each read in KiB, as FUSE issues them')
+    parser.add_option('--block-size',        dest='block_size',    action='store', type='int',   default=1024,        help='Cache block size in KiB')
+    parser.add_option('--readahead',         dest='readahead',     action='store', type='int',   default=8192,        help='Largest read-ahead window in KiB')
+    parser.add_option('--threads',           dest='threads',       action='store', type='int',   default=4,           help='Prefetch threads')
+    parser.add_option('--latency',           dest='latency',       action='store', type='float', default=0.05,        help='Seconds to wait before each response')
+    parser.add_option('--bandwidth',         dest='bandwidth',     action='store', type='int',   default=8388608,     help='Bandwidth of each response in bytes per second (0 for no limit)')
+    parser.add_option('--seed',              dest='seed',          action='store', type='int',   default=0,           help='Seed for the file content')
+    (options, args) = parser.parse_args()
+    return (options, args)
+
+
+def main():
+    "Main function."
+    (opts, args) = _parseArgs()
+    size = opts.size * 1024 * 1024
+    results = run(size, opts.read_size * 1024, opts.latency, opts.bandwidth, opts.block_size * 1024,
+                  opts.readahead * 1024, opts.threads, opts.seed, opts.verbose, opts.debug)
+    print "%-12s %10s %10s %10s" % ("mode", "seconds", "MiB/s", "requests")
+    for mode, seconds, requests in results:
+        print "%-12s %10.3f %10.2f %10d" % (mode, seconds, size / 1048576.0 / seconds, requests)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import time, threading
+
+import metrics
+
+
+class _Call(object):
+    "A call in flight, or recently completed."
+
+    def __init__(self):
+        "Class constructor."
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished = None    ## The time at which the call completed.
+
+
+class SingleFlight(object):
+    """Deduplicates calls with the same key.
+
+    A call made while an identical one is in flight waits for it and shares its result, instead
+    of making a second request. If ttl is non-zero, successful results are also reused for ttl
+    seconds after the call completes, or until clear() is called; with a ttl of 0, only calls in
+    flight are shared. Failures (exceptions or a None result) are shared with the calls already
+    waiting, but are not reused.
+    """
+
+    def __init__(self, ttl=30):
+        "Class constructor."
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._swept = time.time()
+
+    def _sweep(self, now):
+        "Drop results that have expired. Called with the lock held."
+        for key, call in self._calls.items():
+            if call.finished is not None and now - call.finished > self._ttl:
+                del self._calls[key]
+        self._swept = now
+
+    def do(self, key, func, *args, **kwargs):
+        "Call func, or share the result of an identical call identified by key."
+        with self._lock:
+            now = time.time()
+            if now - self._swept > self._ttl:
+                self._sweep(now)
+            call = self._calls.get(key)
+            if call is not None and call.finished is not None and now - call.finished > self._ttl:
+                call = None
+            if call is not None:
+                owner = False
+            else:
+                call = self._calls[key] = _Call()
+                owner = True
+        if not owner:
+            metrics.increment("gdrive_singleflight_shared_total", endpoint=key[0])
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception, e:
+            call.error = e
+        with self._lock:
+            if call.error is not None or call.result is None or not self._ttl:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            else:
+                call.finished = time.time()
+        call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def clear(self):
+        "Forget completed results, so that later calls make fresh requests."
+        with self._lock:
+            for key, call in self._calls.items():
+                if call.finished is not None:
+                    del self._calls[key]
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import logging, threading, Queue
+
+import gdata.client
+
+from transfer import TransferPool
+import metrics
+
+
+class SyncEngine(object):
+    """Runs the API requests of a Session concurrently, keeping many of them in flight.
+
+    Requests run on a pool of workers, and their results are delivered back to the calling
+    thread, which is the only one to touch the Session's metadata maps. The Session API
+    itself stays synchronous: each engine method returns once all of its requests are done.
+    """
+
+    def __init__(self, session, concurrency=16):
+        "Class constructor."
+        self._session = session
+        self._pool = TransferPool(concurrency)
+        self._pending = 0                       ## Number of requests in flight.
+        self._results = Queue.Queue()           ## Completed requests, as (callback, errback, result, exception) tuples.
+        self._lock = threading.Lock()           ## Serialises callers, which share the result queue.
+
+    def _submit(self, callback, errback, func, *args):
+        """Start a request. Its result is passed to callback on the calling thread. If the request
+           or the callback fails, errback (if not None) is called there instead, with the arguments."""
+        def run():
+            try:
+                self._results.put((callback, errback, func(*args), None))
+            except Exception, e:
+                self._results.put((callback, errback, args, e))
+        self._pool.submit(None, run)
+        self._pending += 1
+
+    def _drain(self):
+        "Run callbacks for completed requests until none are left in flight."
+        error = None
+        while self._pending > 0:
+            callback, errback, result, exception = self._results.get()
+            self._pending -= 1
+            if exception == None:
+                try:
+                    callback(result)
+                except Exception, e:
+                    exception = e
+            if exception:
+                # Keep going, so that no stale results are left behind for the next caller.
+                logging.error("Request failed: %s" % exception)
+                error = error or exception
+                if errback:
+                    errback(result)
+        if error:
+            raise error
+
+    def walk(self, root='/'):
+        "Walk the server-side tree from the specified folder, populating the session maps."
+        session = self._session
+        # A folder's ETag is only recorded once all of its files have been described, since a later
+        # walk skips the files of an unchanged folder. Maps folder paths to [files left, ETag].
+        remaining = {}
+
+        def listed(result):
+            path, entries, etag = result
+            if entries == None and etag == None:
+                logging.error("Failed to read folder \"%s\"" % path)
+                return
+            if entries == None:
+                # Unchanged since it was last listed, so only its subfolders need to be checked.
+                folders, files = session.listFolder(path)
+                if not session.isStopping():
+                    for folder in folders:
+                        self._submit(listed, None, self._listFolder, folder)
+                return
+            # Until the new listing is complete, the old ETag no longer describes the maps.
+            session._setFolderEtag(path, None)
+            remaining[path] = [0, etag]
+            for entry in entries:
+                item = session._entryToItem(path, entry)
+                if item["type"] == "folder":
+                    session._addItem(item)
+                    if not session.isStopping():
+                        self._submit(listed, None, self._listFolder, item["path"])
+                else:
+                    remaining[path][0] += 1
+                    self._submit(described, failed, self._describe, path, item, entry)
+            countDown(path, 0)
+
+        def described(result):
+            path, item, metadata = result
+            session._setResourceMetadata(item, metadata)
+            session._addItem(item)
+            if metadata == None:
+                # Its revisions could not be fetched, so the folder must be listed again next time.
+                remaining.pop(path, None)
+            countDown(path, 1)
+
+        def failed(args):
+            # The folder must be listed again next time, so never record its ETag.
+            path, item, entry = args
+            remaining.pop(path, None)
+
+        def countDown(path, done):
+            if path not in remaining:
+                return
+            remaining[path][0] -= done
+            if remaining[path][0] == 0:
+                session._setFolderEtag(path, remaining.pop(path)[1])
+
+        with self._lock:
+            self._submit(listed, None, self._listFolder, root)
+            self._drain()
+
+    def _listFolder(self, path):
+        "Fetch all of the entries in a folder, or None if it is unchanged. Runs on a worker."
+        logging.debug("Reading folder \"%s\"" % path)
+        try:
+            entries, etag = self._session._getFolderEntries(path)
+        except gdata.client.NotModified:
+            logging.debug("Folder \"%s\" is unchanged" % path)
+            metrics.increment("gdrive_folder_listings_total", result="not_modified")
+            return path, None, self._session._metadata["etags"].get(path)
+        return path, entries, etag
+
+    def _describe(self, path, item, entry):
+        "Fetch the revision metadata for a file in the specified folder. Runs on a worker."
+        logging.debug("Getting metadata for path %s" % item["path"])
+        return path, item, self._session._getResourceMetadata(entry)
+
+    def stop(self):
+        "Stop the request workers."
+        self._pool.stop()
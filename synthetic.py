@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Generates synthetic drive trees, and serves them through a stand-in for the Docs API client,
+# so that Sessions can be exercised at scale without the service.
+
+import re, math, random, hashlib, urllib, threading
+
+import gdata.client
+
+from drive_config import DriveConfig
+
+
+FEED_PREFIX = "https://docs.google.com/feeds/default/private/full/"
+CHANGES_URI = "https://docs.google.com/feeds/default/private/changes"
+DOWNLOAD_PREFIX = "https://doc-fake.googleusercontent.com/download/"
+PAGE_SIZE = 500         # Entries per page of folder and change feeds.
+
+_FOLDER_URI = re.compile(r"/feeds/default/private/full/folder%3A([^/?]+)/contents")
+
+
+class DriveShape(object):
+    """The shape of a synthetic drive.
+
+    Each folder down to the specified depth holds fanout subfolders and files files. File sizes
+    are drawn from the named distribution ("fixed", "uniform" or "lognormal") with the specified
+    mean, and a fraction duplicates of files share their name with a sibling.
+    """
+
+    def __init__(self, fanout=10, depth=3, files=20, sizes="lognormal", mean_size=262144, duplicates=0.0, seed=0):
+        "Class constructor."
+        self.fanout = fanout
+        self.depth = depth
+        self.files = files
+        self.sizes = sizes
+        self.mean_size = mean_size
+        self.duplicates = duplicates
+        self.seed = seed
+
+
+class _Value(object):
+    "An element with text, as found in gdata entries."
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+
+class _Link(object):
+    "A link, as found in gdata entries."
+    __slots__ = ("href",)
+
+    def __init__(self, href):
+        self.href = href
+
+
+class _Child(object):
+    "An extension element, as found in gdata entries."
+    __slots__ = ("tag", "text", "attributes")
+
+    def __init__(self, tag, text=None, attributes=None):
+        self.tag = tag
+        self.text = text
+        self.attributes = attributes or {}
+
+
+class _Author(object):
+    __slots__ = ("name", "email")
+
+    def __init__(self, name, email):
+        self.name = _Value(name)
+        self.email = _Value(email)
+
+
+class _Content(object):
+    __slots__ = ("src", "type")
+
+    def __init__(self, src, type):
+        self.src = src
+        self.type = type
+
+
+class _Entry(object):
+    "A resource entry, built on demand from the compact record of a resource."
+
+    def __init__(self, drive, index):
+        "Class constructor."
+        kind, res_id, title, parent, size, md5, updated = drive._resources[index]
+        self._kind = kind
+        self._parent = parent
+        self._drive = drive
+        self.id = _Value(drive._selfLink(index))
+        self.resource_id = _Value(res_id)
+        self.title = _Value(title)
+        self.updated = _Value(updated)
+        self.quota_bytes_used = _Value(str(size))
+        if kind == "folder":
+            self.content = _Content(drive._folderUri(index), "application/atom+xml;type=feed")
+        else:
+            self.content = _Content(DOWNLOAD_PREFIX + urllib.quote(res_id), "application/octet-stream")
+
+    def get_resource_type(self):
+        return self._kind
+
+    def GetRevisionsFeedLink(self):
+        if self._kind == "folder":
+            return None
+        return _Link(self.id.text + "/revisions")
+
+    def InCollections(self):
+        if self._parent == 0:
+            return [_Link(DriveConfig.ROOT_FOLDER_HREF)]
+        return [_Link(self._drive._selfLink(self._parent))]
+
+
+class _Feed(object):
+    "A page of a feed."
+
+    def __init__(self, entries, etag=None, next_page=None):
+        "Class constructor."
+        self.entry = entries
+        self.etag = etag
+        self._next_page = next_page     ## Callable returning the next page, if any.
+
+    def GetNextLink(self):
+        if self._next_page is None:
+            return None
+        return _Link(self._next_page)
+
+
+class _Changestamp(object):
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class _Change(object):
+    __slots__ = ("resource_id", "changestamp")
+
+    def __init__(self, res_id, changestamp):
+        self.resource_id = _Value(res_id)
+        self.changestamp = _Changestamp(str(changestamp))
+
+
+class _Response(object):
+    "A download response with synthetic content."
+
+    def __init__(self, size):
+        "Class constructor."
+        self.status = 200
+        self.reason = "OK"
+        self._remaining = size
+
+    def read(self, amt=None):
+        if amt is None or amt > self._remaining:
+            amt = self._remaining
+        self._remaining -= amt
+        return "\0" * amt
+
+
+class SyntheticDrive(object):
+    """A generated drive tree, served through the subset of the DocsClient interface used by Session.
+
+    Resources are held as compact tuples, and entry objects are only built when requested, so that
+    trees of millions of resources fit in memory. Index 0 is the root folder.
+    """
+
+    def __init__(self, shape):
+        "Class constructor."
+        self._shape = shape
+        self._random = random.Random(shape.seed)
+        self._lock = threading.Lock()
+        self._resources = [("folder", "folder:root", "", None, 0, None, self._timestamp(0))]
+        self._children = { 0: [] }      ## Child indexes, keyed by folder index.
+        self._versions = { 0: 1 }       ## Listing versions, used as ETags, keyed by folder index.
+        self._byid = { "folder:root": 0 }
+        self._changes = []              ## (changestamp, resource index), in order.
+        self._generate(0, shape.depth)
+        for index in xrange(1, len(self._resources)):
+            self._changes.append((index, index))
+
+    def _timestamp(self, changestamp):
+        "Return an Atom timestamp that advances with the changestamp."
+        return "2013-01-01T00:00:00.%03dZ" % (changestamp % 1000)
+
+    def _size(self):
+        "Draw a file size from the configured distribution."
+        mean = self._shape.mean_size
+        if self._shape.sizes == "fixed":
+            return mean
+        if self._shape.sizes == "uniform":
+            return self._random.randint(0, 2 * mean)
+        # A lognormal distribution with the specified mean, and a long tail of large files.
+        sigma = 1.5
+        mu = math.log(mean) - sigma * sigma / 2
+        return int(self._random.lognormvariate(mu, sigma))
+
+    def _add(self, kind, parent, title, size=0):
+        "Add a resource to a folder, returning its index."
+        index = len(self._resources)
+        prefix = "folder" if kind == "folder" else "file"
+        res_id = "%s:%s%d" % (prefix, prefix[0], index)
+        md5 = None
+        if kind != "folder":
+            md5 = hashlib.md5("%s/%d" % (res_id, size)).hexdigest()
+        self._resources.append((kind, res_id, title, parent, size, md5, self._timestamp(index)))
+        self._children[parent].append(index)
+        self._versions[parent] = self._versions.get(parent, 0) + 1
+        self._byid[res_id] = index
+        if kind == "folder":
+            self._children[index] = []
+            self._versions[index] = 1
+        return index
+
+    def _generate(self, folder, depth):
+        "Populate a folder, and its subfolders down to the specified depth."
+        names = []
+        for i in xrange(self._shape.files):
+            if names and self._random.random() < self._shape.duplicates:
+                name = self._random.choice(names)
+            else:
+                name = "file-%d.dat" % i
+                names.append(name)
+            self._add("file", folder, name, self._size())
+        if depth == 0:
+            return
+        for i in xrange(self._shape.fanout):
+            self._generate(self._add("folder", folder, "folder-%d" % i), depth - 1)
+
+    def getNumResources(self):
+        "Return the number of resources in the drive, not counting the root."
+        return len(self._resources) - 1
+
+    def getLargestChangestamp(self):
+        return self._changes[-1][0] if self._changes else 0
+
+    def mutate(self, changes, new_fraction=0.1):
+        "Apply the specified number of changes: new files, or new revisions of existing files."
+        files = [index for index, resource in enumerate(self._resources) if resource[0] != "folder"]
+        folders = self._children.keys()
+        with self._lock:
+            for i in xrange(changes):
+                changestamp = self.getLargestChangestamp() + 1
+                if not files or self._random.random() < new_fraction:
+                    folder = self._random.choice(folders)
+                    index = self._add("file", folder, "new-%d.dat" % changestamp, self._size())
+                    files.append(index)
+                else:
+                    index = self._random.choice(files)
+                    kind, res_id, title, parent, size, md5, updated = self._resources[index]
+                    size = self._size()
+                    md5 = hashlib.md5("%s/%d/%d" % (res_id, size, changestamp)).hexdigest()
+                    self._resources[index] = (kind, res_id, title, parent, size, md5, self._timestamp(changestamp))
+                    self._versions[parent] += 1
+                self._changes.append((changestamp, index))
+
+    def _find(self, path):
+        "Return the index of the resource at the specified path."
+        index = 0
+        for title in path.strip('/').split('/'):
+            index = [child for child in self._children[index] if self._resources[child][2] == title][0]
+        return index
+
+    def getPath(self, index):
+        "Return the path of the resource with the specified index."
+        titles = []
+        while index:
+            kind, res_id, title, parent, size, md5, updated = self._resources[index]
+            titles.insert(0, title)
+            index = parent
+        return '/' + '/'.join(titles)
+
+    def _change(self, index):
+        "Record a change to a resource. Must hold the lock."
+        self._changes.append((self.getLargestChangestamp() + 1, index))
+
+    def delete(self, path):
+        "Delete the resource at the specified path. Its change entry refers to a resource that no longer exists."
+        with self._lock:
+            index = self._find(path)
+            parent = self._resources[index][3]
+            self._children[parent].remove(index)
+            self._versions[parent] += 1
+            del self._byid[self._resources[index][1]]
+            self._change(index)
+
+    def move(self, path, folder, title):
+        "Move the file at the specified path into another folder, under a new title."
+        with self._lock:
+            index = self._find(path)
+            target = self._find(folder) if folder.strip('/') else 0
+            kind, res_id, old_title, parent, size, md5, updated = self._resources[index]
+            self._children[parent].remove(index)
+            self._versions[parent] += 1
+            self._children[target].append(index)
+            self._versions[target] += 1
+            self._resources[index] = (kind, res_id, title, target, size, md5, updated)
+            self._change(index)
+
+    def _selfLink(self, index):
+        return FEED_PREFIX + urllib.quote(self._resources[index][1], safe='')
+
+    def _folderUri(self, index):
+        return FEED_PREFIX + urllib.quote(self._resources[index][1], safe='') + "/contents"
+
+    # The DocsClient interface.
+
+    def _query(self, uri, name, default):
+        "Return an integer query parameter of a feed URI."
+        match = re.search(r"[?&]%s=(\d+)" % name, uri)
+        if match is None:
+            return default
+        return int(match.group(1))
+
+    def GetResources(self, uri=None, http_request=None, **kwargs):
+        uri = str(uri)
+        match = _FOLDER_URI.search(uri)
+        if match is None:
+            raise gdata.client.RequestError("Unknown feed %s" % uri)
+        folder_id = "folder:" + urllib.unquote(match.group(1))
+        start = self._query(uri, "start", 0)
+        page_size = self._query(uri, "max-results", PAGE_SIZE)
+        with self._lock:
+            folder = self._byid[folder_id]
+            etag = '"%d"' % self._versions[folder]
+            if http_request is not None and start == 0 and http_request.headers.get('If-None-Match') == etag:
+                raise gdata.client.NotModified("Not modified")
+            children = self._children[folder]
+            entries = [_Entry(self, index) for index in children[start:start + page_size]]
+        next_page = None
+        if start + page_size < len(children):
+            next_page = "%s?start=%d&max-results=%d" % (uri.split('?')[0], start + page_size, page_size)
+        return _Feed(entries, etag, next_page)
+
+    def GetAllResources(self, uri=None, **kwargs):
+        feed = self.GetResources(uri)
+        entries = feed.entry
+        while feed.GetNextLink() is not None:
+            feed = self.GetResources(feed.GetNextLink().href)
+            entries.extend(feed.entry)
+        return entries
+
+    def GetResourceById(self, res_id, **kwargs):
+        with self._lock:
+            if res_id not in self._byid:
+                error = gdata.client.RequestError("Server responded with: 404, Not Found")
+                error.status = 404
+                error.reason = "Not Found"
+                error.body = "Resource %s not found" % res_id
+                error.headers = []
+                raise error
+            return _Entry(self, self._byid[res_id])
+
+    def GetResourceBySelfLink(self, href, **kwargs):
+        return self.GetResourceById(urllib.unquote(href[len(FEED_PREFIX):]))
+
+    def GetRevisions(self, resource, **kwargs):
+        # Like DocsClient, this needs the revisions feed link of the entry, which a listing must ask for.
+        if resource.GetRevisionsFeedLink() is None:
+            raise AttributeError("'NoneType' object has no attribute 'href'")
+        with self._lock:
+            kind, res_id, title, parent, size, md5, updated = self._resources[self._byid[resource.resource_id.text]]
+        revision = _Entry(self, self._byid[res_id])
+        revision.author = [_Author("Synthetic User", "user@example.com")]
+        revision.children = [_Child("edited", updated), _Child("md5Checksum", md5)]
+        return _Feed([revision])
+
+    def _getChanges(self, uri):
+        "Return a page of the change feed."
+        start = self._query(uri, "start-index", 1)
+        page_size = self._query(uri, "max-results", PAGE_SIZE)
+        with self._lock:
+            pending = [(cs, index) for cs, index in self._changes if cs >= start]
+            changes = [_Change(self._resources[index][1], cs) for cs, index in pending[:page_size]]
+        next_page = None
+        if len(pending) > page_size:
+            next_page = "%s?start-index=%d&max-results=%d" % (CHANGES_URI, pending[page_size][0], page_size)
+        return _Feed(changes, None, next_page)
+
+    def GetChanges(self, changestamp=None, max_results=PAGE_SIZE, show_root=None, **kwargs):
+        return self._getChanges("%s?start-index=%s&max-results=%d" % (CHANGES_URI, changestamp or 1, max_results))
+
+    def GetFeed(self, uri, **kwargs):
+        uri = str(uri)
+        if "/changes" in uri:
+            return self._getChanges(uri)
+        return self.GetResources(uri, **kwargs)
+
+    def GetNext(self, feed, **kwargs):
+        return self.GetFeed(feed.GetNextLink().href)
+
+    def GetMetadata(self, **kwargs):
+        metadata = _Entry(self, 0)
+        metadata.quota_bytes_total = _Value(str(1 << 40))
+        metadata.quota_bytes_used = _Value(str(sum(resource[4] for resource in self._resources)))
+        metadata.quota_bytes_used_in_trash = _Value("0")
+        metadata.import_formats = []
+        metadata.export_formats = []
+        metadata.features = []
+        metadata.max_upload_sizes = []
+        metadata.children = [_Child("largestChangestamp", attributes={ "value": str(self.getLargestChangestamp()) })]
+        return metadata
+
+    def request(self, method, uri, **kwargs):
+        res_id = urllib.unquote(uri[len(DOWNLOAD_PREFIX):])
+        with self._lock:
+            size = self._resources[self._byid[res_id]][4]
+        return _Response(size)
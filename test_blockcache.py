@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Tests of the BlockCache. Run with: python -m unittest discover -p 'test_*.py'
+
+import os, time, shutil, tempfile, threading, unittest
+
+import metrics
+from blockcache import BlockCache
+
+
+CONTENT = "abcdefghijklmnopqrst"
+BLOCK_SIZE = 4
+
+
+class _Fetcher(object):
+    "Serves ranges of CONTENT, counting the requests."
+
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, start, end):
+        self.requests.append((start, end))
+        return CONTENT[start:end]
+
+
+class BlockCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fetch = _Fetcher()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, cache, index):
+        return cache.read("file:abc", "1", len(CONTENT), index * BLOCK_SIZE, BLOCK_SIZE, self.fetch)
+
+    def isCached(self, cache, index):
+        return cache.peek("file:abc", "1", len(CONTENT), index * BLOCK_SIZE, BLOCK_SIZE) is not None
+
+    def testReadAcrossBlocks(self):
+        cache = BlockCache(self.directory, 100, BLOCK_SIZE)
+        self.assertEqual(cache.read("file:abc", "1", len(CONTENT), 2, 8, self.fetch), CONTENT[2:10])
+        self.assertEqual(self.fetch.requests, [(0, 4), (4, 8), (8, 12)])
+        self.assertEqual(cache.read("file:abc", "1", len(CONTENT), 3, 6, self.fetch), CONTENT[3:9])
+        self.assertEqual(len(self.fetch.requests), 3)
+        # Another revision never sees the blocks of this one.
+        cache.read("file:abc", "2", len(CONTENT), 0, 4, self.fetch)
+        self.assertEqual(len(self.fetch.requests), 4)
+
+    def testEvictsLeastRecentlyUsed(self):
+        cache = BlockCache(self.directory, 3 * BLOCK_SIZE, BLOCK_SIZE)
+        for index in range(3):
+            self.read(cache, index)
+        # Using block 0 again leaves block 1 as the least recently used.
+        self.read(cache, 0)
+        self.read(cache, 3)
+        self.assertEqual([self.isCached(cache, index) for index in range(4)], [True, False, True, True])
+        stats = cache.getStats()
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["bytes"], 3 * BLOCK_SIZE)
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+    def testRebuildsOrderFromModificationTimes(self):
+        cache = BlockCache(self.directory, 100, BLOCK_SIZE)
+        for index in range(3):
+            self.read(cache, index)
+        # Block 1 was used longest ago, then block 0.
+        for index, mtime in ((1, 1000), (0, 2000), (2, 3000)):
+            os.utime(os.path.join(self.directory, cache._getName("file:abc", "1", index)), (mtime, mtime))
+        # A working copy left by a crash is removed.
+        open(os.path.join(self.directory, "partial.tmp"), 'w').close()
+        cache = BlockCache(self.directory, 2 * BLOCK_SIZE, BLOCK_SIZE)
+        self.assertEqual([self.isCached(cache, index) for index in range(3)], [True, False, True])
+        self.assertEqual(cache.getStats()["blocks"], 2)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def testReaderSharesPrefetch(self):
+        cache = BlockCache(self.directory, 100, BLOCK_SIZE)
+        started = threading.Event()
+        release = threading.Event()
+        def slowFetch(start, end):
+            started.set()
+            release.wait()
+            return self.fetch(start, end)
+        prefetch = threading.Thread(target=cache.prefetch, args=("file:abc", "1", len(CONTENT), 1, slowFetch))
+        prefetch.start()
+        started.wait()
+        shared = metrics.registry.getCounter("gdrive_singleflight_shared_total", endpoint="block")
+        result = []
+        reader = threading.Thread(target=lambda: result.append(self.read(cache, 1)))
+        reader.start()
+        # Wait for the reader to join the prefetch in flight.
+        deadline = time.time() + 5
+        while metrics.registry.getCounter("gdrive_singleflight_shared_total", endpoint="block") == shared:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.001)
+        release.set()
+        prefetch.join()
+        reader.join()
+        self.assertEqual(result, [CONTENT[4:8]])
+        self.assertEqual(self.fetch.requests, [(4, 8)])
+        # A block that is already cached is not prefetched again.
+        cache.prefetch("file:abc", "1", len(CONTENT), 1, self.fetch)
+        self.assertEqual(len(self.fetch.requests), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Tests of the daemon poll loop. Run with: python -m unittest discover -p 'test_*.py'
+
+import errno, socket, threading, unittest
+
+import drived
+
+
+class _Session(object):
+    "Stands in for a Session whose change probe fails a number of times, then stops the loop."
+
+    def __init__(self, errors, sync):
+        self.errors = list(errors)
+        self.sync = sync
+        self.probes = 0
+        self.closed = False
+
+    def requestStop(self):
+        pass
+
+    def hasPendingWork(self):
+        return False
+
+    def hasChanges(self):
+        self.probes += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sync._stopping.set()
+        return False
+
+    def close(self):
+        self.closed = True
+
+
+class AccountSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self._session = drived.Session
+        self._interval = drived.RETRY_INTERVAL
+        drived.RETRY_INTERVAL = 0
+
+    def tearDown(self):
+        drived.Session = self._session
+        drived.RETRY_INTERVAL = self._interval
+
+    def run_sync(self, errors):
+        sync = drived.AccountSync(None, None, None)
+        session = _Session(errors, sync)
+        drived.Session = lambda *args, **kwargs: session
+        sync.start()
+        sync.join(10)
+        self.assertFalse(sync.is_alive())
+        return session
+
+    def testSurvivesNetworkOutage(self):
+        session = self.run_sync([socket.error(errno.ENETUNREACH, "Network is unreachable")] * 3)
+        self.assertEqual(session.probes, 4)
+        self.assertTrue(session.closed)
+
+    def testStopsOnProgrammingError(self):
+        session = self.run_sync([KeyError("bug")])
+        self.assertEqual(session.probes, 1)
+        self.assertTrue(session.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Tests of the Session against a synthetic drive. Run with: python -m unittest discover -p 'test_*.py'
+
+import os, time, socket, threading, unittest, StringIO
+
+import gdata.client
+
+import gdocs
+import replay
+from dirtree import StoredDict
+from retry import RetryPolicy
+from synthetic import DriveShape, SyntheticDrive
+
+
+DOWNLOAD_URI = "https://doc-0.googleusercontent.com/download/abc"
+
+
+class _SlowDrive(SyntheticDrive):
+    "A synthetic drive that answers listing and revision requests after a delay, counting how many overlap."
+
+    LATENCY = 0.02
+
+    def __init__(self, shape):
+        SyntheticDrive.__init__(self, shape)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.inflight = 0
+        self.peak = 0
+
+    def _wait(self):
+        with self._lock:
+            self.requests += 1
+            self.inflight += 1
+            self.peak = max(self.peak, self.inflight)
+        time.sleep(self.LATENCY)
+        with self._lock:
+            self.inflight -= 1
+
+    def GetResources(self, *args, **kwargs):
+        self._wait()
+        return SyntheticDrive.GetResources(self, *args, **kwargs)
+
+    def GetRevisions(self, *args, **kwargs):
+        self._wait()
+        return SyntheticDrive.GetRevisions(self, *args, **kwargs)
+
+
+class SessionTestCase(unittest.TestCase):
+    "Runs each test with a Session on a small synthetic drive, in a scratch configuration."
+
+    DRIVE = SyntheticDrive
+    SHAPE = { "fanout": 2, "depth": 2, "files": 3 }
+    CONCURRENCY = 1
+    CONCURRENT = False
+    MEMORY_LIMIT = 0
+
+    def setUp(self):
+        self.drive = self.DRIVE(DriveShape(sizes="fixed", mean_size=1024, seed=1, **self.SHAPE))
+        self._config = replay.scratchConfig({ "general": { "rate": "0", "concurrency": str(self.CONCURRENCY) },
+                                              "daemon": { "memory_limit": str(self.MEMORY_LIMIT) } })
+        self.localroot = self._config.__enter__()
+        self.session = gdocs.Session(client=self.drive, concurrent=self.CONCURRENT)
+
+    def tearDown(self):
+        self.session.close()
+        self._config.__exit__(None, None, None)
+
+    def getPaths(self, session):
+        "Return the set of (path, resource ID, checksum) tuples of everything below the root known to a session."
+        return set((path, item["resource_id"], item.get("md5checksum"))
+                   for path, item in session._metadata["map"]["bypath"].iteritems() if path)
+
+
+class ChangesTest(SessionTestCase):
+
+    def testNoChangesAfterUpdate(self):
+        self.assertTrue(self.session.hasChanges())
+        self.session.update('/', download=False, interactive=False)
+        self.assertFalse(self.session.hasChanges())
+
+    def testChangesAfterMutation(self):
+        self.session.update('/', download=False, interactive=False)
+        self.drive.mutate(3)
+        self.assertTrue(self.session.hasChanges())
+        self.session.update('/', download=False, interactive=False)
+        self.assertFalse(self.session.hasChanges())
+
+    def testSkipsDeletedResource(self):
+        self.session.update('/', download=False, interactive=False)
+        # A file created and deleted between updates: its change entry refers to a resource that 404s.
+        self.drive.mutate(1, new_fraction=1.0)
+        self.drive.delete(self.drive.getPath(len(self.drive._resources) - 1))
+        self.drive.mutate(2, new_fraction=0.0)
+        self.session.update('/', download=False, interactive=False)
+        self.assertEqual(self.session._metadata["changestamp"], self.drive.getLargestChangestamp() + 1)
+        self.assertFalse(self.session.hasChanges())
+
+    def testRefreshFollowsMovedFile(self):
+        self.session.refresh()
+        res_id = self.session._getItem("/folder-0/file-1.dat")["resource_id"]
+        self.drive.move("/folder-0/file-1.dat", "/folder-1", "moved.dat")
+        self.session.refresh()
+        self.assertEqual(self.session._getItem("/folder-0/file-1.dat"), None)
+        self.assertEqual(self.session._getItem("/folder-1/moved.dat")["resource_id"], res_id)
+        self.assertFalse(self.session.hasChanges())
+        fresh = gdocs.Session(client=self.drive)
+        try:
+            fresh.reset()
+            self.assertEqual(self.getPaths(self.session), self.getPaths(fresh))
+        finally:
+            fresh.close()
+
+    def testReplayUpdateLeavesLocalTree(self):
+        self.drive.mutate(3)
+        replay._update(self.session)
+        self.assertEqual(os.listdir(self.localroot), [])
+
+
+class DownloadTest(SessionTestCase):
+
+    def testDownloadTree(self):
+        localpath = os.path.join(self.localroot, "tree")
+        self.assertTrue(self.session.download('/', localpath, overwrite=True))
+        self.assertFalse(self.session.hasPendingWork())
+        count = 0
+        for root, dirs, files in os.walk(localpath):
+            count += len(files)
+        self.assertEqual(count, self.session.getNumRemoteFiles('/'))
+
+    def testUploadToUnknownFolderIsRetried(self):
+        localpath = os.path.join(self.localroot, "file.txt")
+        open(localpath, 'w').close()
+        self.session.upload(localpath, "/no-such-folder")
+        self.assertEqual(len(self.session._queue), 1)
+        self.assertFalse(self.session.hasPendingWork())
+
+    def testUnavailableRangeIsRetried(self):
+        self.session._retry = RetryPolicy(base_delay=0, max_delay=0)
+        self.drive.http_client = _RangeTransport([_RangeResponse(503, "Service Unavailable"),
+                                                  _RangeResponse(206, "Partial Content", "abcd")])
+        self.assertEqual(self.session.fetchRange(DOWNLOAD_URI, 4, 8), "abcd")
+        self.assertEqual(self.drive.http_client.requests, ["bytes=4-7", "bytes=4-7"])
+
+    def testMissingRangeIsNotRetried(self):
+        self.session._retry = RetryPolicy(base_delay=0, max_delay=0)
+        self.drive.http_client = _RangeTransport([_RangeResponse(404, "Not Found")])
+        try:
+            self.session.fetchRange(DOWNLOAD_URI, 4, 8)
+            self.fail("Expected a RequestError")
+        except gdata.client.RequestError, e:
+            self.assertEqual(e.status, 404)
+
+
+class _RangeResponse(object):
+    "A response to a ranged download."
+
+    def __init__(self, status, reason, body=''):
+        self.status = status
+        self.reason = reason
+        self._body = body
+
+    def read(self):
+        return self._body
+
+    def getheaders(self):
+        return []
+
+
+class _RangeTransport(object):
+    "Stands in for the authorised transport of a client, answering ranged requests in turn."
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def request(self, http_request):
+        self.requests.append(http_request.headers['Range'])
+        return self.responses.pop(0)
+
+
+class _Uploader(object):
+    "Stands in for a ResumableUploader whose server loses some chunks, and the response to the last."
+
+    chunk_size = 4
+
+    def __init__(self, fail):
+        self.received = ''
+        self.fail = fail        ## Chunk start offsets to fail after the server has stored half of the chunk.
+        self.chunks = 0
+
+    def UploadChunk(self, start, data):
+        self.chunks += 1
+        self.received = self.received[:start] + data
+        if start in self.fail:
+            self.fail.remove(start)
+            self.received = self.received[:start + len(data) / 2]
+            raise socket.error("Connection reset")
+        if len(self.received) == 10:
+            raise socket.error("Connection reset after the upload completed")
+        return None
+
+    def QueryUploadStatus(self):
+        if len(self.received) == 10:
+            return True
+        return len(self.received)
+
+
+class UploadTest(SessionTestCase):
+
+    def testChunksResumeAfterFailures(self):
+        uploader = _Uploader([4])
+        self.session._retry = RetryPolicy(base_delay=0, max_delay=0)
+        entry = self.session._sendChunks(uploader, StringIO.StringIO("0123456789"))
+        self.assertEqual(entry, None)
+        self.assertEqual(uploader.received, "0123456789")
+        self.assertEqual(uploader.chunks, 3)
+
+    def deadLetter(self, localpath, path, replace):
+        "Queue an upload and fail it until it is given up on."
+        f = open(localpath, 'w')
+        f.write("changed")
+        f.close()
+        if replace:
+            self.session.queueReplace(localpath, path)
+        else:
+            self.session._queue.put("upload", path, localpath=localpath, folder=os.path.dirname(path))
+        queue = self.session._queue
+        queue.RETRY_DELAY = 0
+        while True:
+            next_item = queue.get()
+            if next_item == None:
+                break
+            queue.release(next_item[0])
+
+    def testDiscardRemovesStagedCopy(self):
+        staging = self.session.getConfig().getStagingDir()
+        os.makedirs(staging)
+        staged = os.path.join(staging, "%2Ffolder-0%2Fnew.dat")
+        self.deadLetter(staged, "/folder-0/new.dat", True)
+        other = os.path.join(self.localroot, "other.dat")
+        self.deadLetter(other, "/folder-0/other.dat", False)
+        self.assertEqual(len(self.session.getDeadLetters()), 2)
+        self.assertEqual(len(self.session.clearDeadLetters()), 2)
+        self.assertEqual(self.session.getDeadLetters(), [])
+        # Changes written through the mount are thrown away, but a file uploaded from the command line is left alone.
+        self.assertFalse(os.path.exists(staged))
+        self.assertTrue(os.path.exists(other))
+
+
+class WalkTest(SessionTestCase):
+
+    def testFailedFileDropsFolderEtag(self):
+        etags = self.session._metadata["etags"]
+        folders = set(etags)
+        self.assertTrue("/folder-0" in folders)
+        res_id = self.session._getItem("/folder-0/file-1.dat")["resource_id"]
+        getRevisions = self.drive.GetRevisions
+        def failing(resource, **kwargs):
+            if resource.resource_id.text == res_id:
+                error = gdata.client.RequestError("Server responded with: 404, Not Found")
+                error.status = 404
+                raise error
+            return getRevisions(resource, **kwargs)
+        self.drive.GetRevisions = failing
+        etags.clear()
+        self.session._walk()
+        # The folder must be listed again next time, for the file's revisions to be fetched.
+        self.assertEqual(set(etags), folders - set(["/folder-0"]))
+        self.assertEqual(self.session._getItem("/folder-0/file-1.dat")["shared"], "true")
+
+
+class EngineTest(WalkTest):
+
+    CONCURRENCY = 4
+    CONCURRENT = True
+
+    def testWalkMatchesSequentialWalk(self):
+        self.assertNotEqual(self.session._engine, None)
+        sequential = gdocs.Session(client=self.drive)
+        try:
+            self.assertEqual(sequential._engine, None)
+            self.assertEqual(self.getPaths(self.session), self.getPaths(sequential))
+            self.assertEqual(len(self.getPaths(self.session)), self.drive.getNumResources())
+        finally:
+            sequential.close()
+
+    def testWalkAfterMutation(self):
+        # Revisions fetched by the first walk must not be served to the second.
+        self.drive.mutate(5)
+        self.session.reset()
+        sequential = gdocs.Session(client=self.drive)
+        try:
+            self.assertEqual(self.getPaths(self.session), self.getPaths(sequential))
+        finally:
+            sequential.close()
+
+    def testCloseStopsEngine(self):
+        engine = self.session._engine
+        self.session.close()
+        self.assertEqual(self.session._engine, None)
+        self.assertRaises(RuntimeError, engine._pool.submit, None, lambda: None)
+
+
+class SlowEngineTest(SessionTestCase):
+
+    DRIVE = _SlowDrive
+    CONCURRENCY = 8
+    CONCURRENT = True
+
+    def testWalkOverlapsRequests(self):
+        self.drive.requests = self.drive.peak = 0
+        start = time.time()
+        self.session.reset()
+        elapsed = time.time() - start
+        self.assertEqual(len(self.getPaths(self.session)), self.drive.getNumResources())
+        self.assertTrue(self.drive.peak > 1)
+        # A serial walk would wait out the latency of every request in turn.
+        self.assertTrue(elapsed < self.drive.requests * self.drive.LATENCY / 2)
+
+
+class StoreTest(SessionTestCase):
+
+    # More entries than fit in a 1 MiB memory limit.
+    SHAPE = { "fanout": 4, "depth": 2, "files": 40 }
+    MEMORY_LIMIT = 1
+
+    def testEvicted(self):
+        self.assertTrue(self.session._metadata["map"]["bypath"].hasEvicted())
+        self.assertTrue(isinstance(self.session._metadata["map"]["byid"], StoredDict))
+
+    def testReloadWithoutLimit(self):
+        paths = self.getPaths(self.session)
+        self.session.close()
+        replay._setOptions(None, { "daemon": { "memory_limit": "0" } })
+        self.session = gdocs.Session(client=self.drive)
+        self.assertEqual(self.getPaths(self.session), paths)
+        self.assertEqual(type(self.session._metadata["map"]["byid"]), dict)
+        self.assertEqual(len(self.session._metadata["map"]["byid"]), len(paths))
+
+    def testReset(self):
+        paths = self.getPaths(self.session)
+        self.session.reset()
+        self.assertEqual(self.getPaths(self.session), paths)
+        for path, res_id, checksum in paths:
+            self.assertEqual(self.session._resourceIdToPath(res_id), path)
+
+    def testRemoveEvicted(self):
+        tree = self.session._metadata["map"]["bypath"]
+        resident = tree.getStats()["resident"]
+        path = sorted(self.getPaths(self.session))[0][0]
+        self.session._removeItem(path)
+        self.assertEqual(self.session._getItem(path), None)
+        self.assertTrue(tree.getStats()["resident"] <= resident)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import os, shutil, tempfile, threading, unittest
+
+import ipc
+
+
+class _Account(object):
+    "Stands in for an AccountSync."
+
+    def __init__(self, session):
+        self.account = None
+        self.session = session
+        self.lock = threading.Lock()
+
+
+class _Session(object):
+    "Stands in for a Session, answering listings from a dict."
+
+    def __init__(self, listings, dead=()):
+        self._listings = listings
+        self._dead = list(dead)
+
+    def listFolder(self, path):
+        return self._listings[path]
+
+    def getDeadLetters(self):
+        return self._dead
+
+    def clearDeadLetters(self):
+        dead, self._dead = self._dead, []
+        return dead
+
+
+class QueryServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.account = _Account(None)
+        self.server = ipc.QueryServer(os.path.join(self._dir, "sock"), [self.account])
+        self.server.start()
+        self.client = ipc.QueryClient(os.path.join(self._dir, "sock"), timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self._dir)
+
+    def testPingBeforeSessionIsReady(self):
+        self.assertEqual(self.client.call("ping"), True)
+        self.assertRaises(ipc.QueryError, self.client.call, "list", path="/")
+
+    def testQueryDuringSync(self):
+        self.account.session = _Session({ "/": (["/a"], []) })
+        # A long sync must not hold up queries.
+        with self.account.lock:
+            self.assertEqual(self.client.call("ping"), True)
+        self.assertEqual(self.client.call("list", path="/"), { "folders": ["/a"], "files": [], "stats": {} })
+
+    def testDeadLetters(self):
+        item = { "op": "upload", "path": "/a", "localpath": "/tmp/a", "attempts": 5 }
+        self.account.session = _Session({}, [item])
+        remote = ipc.RemoteSession(self.client)
+        self.assertEqual(remote.getDeadLetters(), [item])
+        self.assertEqual(remote.clearDeadLetters(), [item])
+        self.assertEqual(remote.getDeadLetters(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
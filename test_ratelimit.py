@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Tests of the RateGovernor and request lanes. Run with: python -m unittest discover -p 'test_*.py'
+
+import time, threading, unittest
+
+import ratelimit
+from ratelimit import RateGovernor
+from transfer import TransferPool
+
+
+class RateGovernorTest(unittest.TestCase):
+
+    def drain(self, governor):
+        "Use up the burst, so that the next request has to wait for a token."
+        while governor.acquire(ratelimit.INTERACTIVE) < 0.001:
+            pass
+
+    def testNoLimit(self):
+        governor = RateGovernor(0)
+        for n in range(100):
+            self.assertEqual(governor.acquire(), 0.0)
+        governor.penalise()
+        self.assertEqual(governor.getRate(), 0.0)
+
+    def testInteractiveGoesFirst(self):
+        governor = RateGovernor(10)
+        self.drain(governor)
+        order = []
+        def request(lane):
+            governor.acquire(lane)
+            order.append(lane)
+        background = threading.Thread(target=request, args=(ratelimit.BACKGROUND,))
+        background.start()
+        # Let the background request start waiting for the next token.
+        time.sleep(0.02)
+        interactive = threading.Thread(target=request, args=(ratelimit.INTERACTIVE,))
+        interactive.start()
+        background.join()
+        interactive.join()
+        self.assertEqual(order, [ratelimit.INTERACTIVE, ratelimit.BACKGROUND])
+
+    def testPenaliseHalvesRate(self):
+        governor = RateGovernor(8)
+        governor.penalise()
+        self.assertEqual(governor.getRate(), 4)
+        # Several reports of the same burst only slow down once.
+        governor.penalise()
+        self.assertEqual(governor.getRate(), 4)
+        for n in range(10):
+            governor._penalised = 0.0
+            governor.penalise()
+        self.assertEqual(governor.getRate(), RateGovernor.MIN_RATE)
+
+    def testRewardRecovers(self):
+        governor = RateGovernor(10)
+        governor.penalise()
+        self.assertEqual(governor.getRate(), 5)
+        governor.reward()
+        self.assertAlmostEqual(governor.getRate(), 5 + 10 * RateGovernor.RECOVERY)
+        for n in range(int(1 / RateGovernor.RECOVERY)):
+            governor.reward()
+        # Never faster than the configured budget.
+        self.assertEqual(governor.getRate(), 10)
+
+
+class LaneTest(unittest.TestCase):
+
+    def testLaneFollowsTransfers(self):
+        pool = TransferPool(1)
+        try:
+            self.assertEqual(pool.submit(None, ratelimit.currentLane, None).wait(), None)
+            with ratelimit.lane(ratelimit.BACKGROUND):
+                self.assertEqual(ratelimit.currentLane(), ratelimit.BACKGROUND)
+                job = pool.submit(None, ratelimit.currentLane, None)
+            self.assertEqual(job.wait(), ratelimit.BACKGROUND)
+            self.assertEqual(ratelimit.currentLane(ratelimit.INTERACTIVE), ratelimit.INTERACTIVE)
+        finally:
+            pool.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Tests of ReadAhead. Run with: python -m unittest discover -p 'test_*.py'
+
+import shutil, tempfile, unittest
+
+from blockcache import BlockCache
+from readahead import ReadAhead
+
+
+BLOCK_SIZE = 4
+CONTENT = "".join(chr(ord('a') + n % 26) for n in range(100))
+
+
+class _Prefetcher(object):
+    "Stands in for a Prefetcher, recording the blocks it is asked to fetch without fetching them."
+
+    def __init__(self):
+        self.blocks = []
+
+    def submit(self, func, res_id, revision, file_size, index, fetch):
+        self.blocks.append(index)
+
+
+class ReadAheadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.requests = []
+        self.prefetcher = _Prefetcher()
+        cache = BlockCache(self.directory, 1000, BLOCK_SIZE)
+        self.reader = ReadAhead(cache, self.prefetcher, "file:abc", "1", len(CONTENT), self.fetch, 4 * BLOCK_SIZE)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, start, end):
+        self.requests.append((start, end))
+        return CONTENT[start:end]
+
+    def read(self, index):
+        "Read a block, returning the blocks scheduled for prefetching."
+        del self.prefetcher.blocks[:]
+        self.assertEqual(self.reader.read(index * BLOCK_SIZE, BLOCK_SIZE), CONTENT[index * BLOCK_SIZE:(index + 1) * BLOCK_SIZE])
+        return self.prefetcher.blocks
+
+    def testWindowDoubles(self):
+        self.assertEqual(self.read(0), [1])
+        self.assertEqual(self.read(1), [2, 3])
+        self.assertEqual(self.read(2), [])
+        self.assertEqual(self.read(3), [4, 5, 6, 7])
+        self.assertEqual(self.read(4), [])
+        self.assertEqual(self.read(5), [])
+        # The window stays at its largest, four blocks.
+        self.assertEqual(self.read(6), [8, 9, 10])
+        self.assertEqual(self.read(7), [])
+        self.assertEqual(self.read(8), [])
+        self.assertEqual(self.read(9), [11, 12, 13])
+
+    def testRandomReadResetsWindow(self):
+        self.read(0)
+        self.read(1)
+        del self.requests[:]
+        del self.prefetcher.blocks[:]
+        # A random read takes only the bytes asked for, and prefetches nothing.
+        self.assertEqual(self.reader.read(61, 2), CONTENT[61:63])
+        self.assertEqual(self.requests, [(61, 63)])
+        self.assertEqual(self.prefetcher.blocks, [])
+        # Reading on from there starts again with a window of one block.
+        self.assertEqual(self.read(16), [17])
+        self.assertEqual(self.read(17), [18, 19])
+
+    def testRandomReadUsesCache(self):
+        self.read(0)
+        self.read(1)
+        del self.requests[:]
+        self.assertEqual(self.reader.read(50, 2), CONTENT[50:52])
+        self.assertEqual(self.reader.read(1, 2), CONTENT[1:3])
+        self.assertEqual(self.requests, [(50, 52)])
+
+    def testPrefetchesEachBlockOnce(self):
+        blocks = []
+        for index in range(len(CONTENT) // BLOCK_SIZE):
+            blocks.extend(self.read(index))
+        # Every block after the first, and nothing past the end of the file.
+        self.assertEqual(blocks, range(1, len(CONTENT) // BLOCK_SIZE))
+        self.assertEqual(self.reader.read(len(CONTENT), BLOCK_SIZE), '')
+
+
+if __name__ == "__main__":
+    unittest.main()
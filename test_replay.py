@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Tests of sessions against recorded responses. Run with: python -m unittest discover -p 'test_*.py'
+
+import os, re, json, shutil, tempfile, unittest
+from xml.etree import ElementTree
+
+import atom.core
+import gdata.docs.data
+
+import gdocs
+import replay
+from drive_config import DriveConfig
+
+
+NAMESPACES = { "": "http://www.w3.org/2005/Atom",
+               "gd": "http://schemas.google.com/g/2005",
+               "docs": "http://schemas.google.com/docs/2007" }
+
+REVISIONS_HREF = "https://docs.google.com/feeds/default/private/full/file%3Aabc/revisions"
+
+# A listing entry for a file, as served without a partial response field selection.
+FULL_LISTING = """<feed xmlns="http://www.w3.org/2005/Atom" xmlns:gd="http://schemas.google.com/g/2005"
+      xmlns:docs="http://schemas.google.com/docs/2007" gd:etag='"listing"'>
+  <entry gd:etag='"entry"'>
+    <id>https://docs.google.com/feeds/id/file%3Aabc</id>
+    <updated>2013-01-02T00:00:00.000Z</updated>
+    <category scheme="http://schemas.google.com/g/2005#kind" term="http://schemas.google.com/docs/2007#file" label="file"/>
+    <title>notes.txt</title>
+    <content type="text/plain" src="https://doc-0.googleusercontent.com/download/abc"/>
+    <link rel="self" type="application/atom+xml" href="https://docs.google.com/feeds/default/private/full/file%3Aabc"/>
+    <author><name>Someone</name><email>someone@example.com</email></author>
+    <gd:resourceId>file:abc</gd:resourceId>
+    <gd:quotaBytesUsed>12</gd:quotaBytesUsed>
+    <docs:md5Checksum>0123456789abcdef0123456789abcdef</docs:md5Checksum>
+    <gd:feedLink rel="http://schemas.google.com/acl/2007#accessControlList" href="https://docs.google.com/feeds/default/private/full/file%3Aabc/acl"/>
+    <gd:feedLink rel="http://schemas.google.com/docs/2007/revisions" href="https://docs.google.com/feeds/default/private/full/file%3Aabc/revisions"/>
+  </entry>
+</feed>"""
+
+REVISIONS = """<feed xmlns="http://www.w3.org/2005/Atom" xmlns:docs="http://schemas.google.com/docs/2007">
+  <entry>
+    <id>https://docs.google.com/feeds/id/file%3Aabc/revisions/1</id>
+    <updated>2013-01-02T00:00:00.000Z</updated>
+    <title>Revision 1</title>
+    <author><name>Someone</name><email>someone@example.com</email></author>
+    <docs:md5Checksum>0123456789abcdef0123456789abcdef</docs:md5Checksum>
+  </entry>
+</feed>"""
+
+
+def _qualify(name):
+    "Return the ElementTree tag for a field name such as gd:resourceId."
+    prefix, local = name.split(':') if ':' in name else ("", name)
+    return "{%s}%s" % (NAMESPACES[prefix], local)
+
+
+def _project(feed, fields):
+    """Return a feed with only the entry elements named in a partial response field selection,
+       as the server would, going by element name and any [@rel=...] or [@scheme=...] condition."""
+    selection = re.search(r"entry\((.*)\)$", fields).group(1)
+    wanted = []
+    for field in re.findall(r"([\w:]+)(?:\[@(\w+)='([^']*)'\])?", selection):
+        wanted.append((_qualify(field[0]), field[1], field[2]))
+    root = ElementTree.fromstring(feed)
+    for entry in root.findall(_qualify("entry")):
+        for child in list(entry):
+            if not [tag for tag, attribute, value in wanted
+                    if child.tag == tag and (not attribute or child.get(attribute) == value)]:
+                entry.remove(child)
+    return ElementTree.tostring(root)
+
+
+class ProjectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fixturedir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.fixturedir, replay.BODY_DIR))
+        f = open(os.path.join(self.fixturedir, replay.BODY_DIR, "revisions"), 'w')
+        f.write(REVISIONS)
+        f.close()
+        f = open(os.path.join(self.fixturedir, replay.INDEX_FILE), 'w')
+        path = replay._normalise(REVISIONS_HREF[len("https://docs.google.com"):])
+        f.write(json.dumps({ "method": "GET", "host": "docs.google.com", "path": path, "status": 200, "reason": "OK",
+                             "headers": [["content-type", "application/atom+xml"]],
+                             "body": os.path.join(replay.BODY_DIR, "revisions") }) + "\n")
+        f.close()
+        self.server = replay.ReplayServer(self.fixturedir)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.fixturedir)
+
+    def testProjectedListingDescribesFile(self):
+        listing = _project(FULL_LISTING, DriveConfig.LISTING_FIELDS)
+        self.assertFalse("accessControlList" in listing)
+        # Checksums come from the revisions feed, so the listing need not carry them.
+        self.assertFalse("md5Checksum" in listing)
+        feed = atom.core.parse(listing, gdata.docs.data.ResourceFeed)
+        with replay.scratchConfig({ "general": { "rate": "0" } }):
+            session = gdocs.Session(client=self.server.getClient())
+            try:
+                metadata = session._getResourceMetadata(feed.entry[0])
+            finally:
+                session.close()
+        self.assertEqual(metadata["md5checksum"], "0123456789abcdef0123456789abcdef")
+        self.assertEqual(metadata["updated"], "2013-01-02T00:00:00.000Z")
+        self.assertEqual(metadata["author-email"], "someone@example.com")
+
+
+if __name__ == "__main__":
+    unittest.main()
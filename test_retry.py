@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Tests of the retry policy. Run with: python -m unittest discover -p 'test_*.py'
+
+import errno, socket, httplib, unittest
+
+import gdata.client
+
+from retry import RetryPolicy, isTransient
+
+
+class TransientTest(unittest.TestCase):
+
+    def testNetworkErrors(self):
+        self.assertTrue(isTransient(socket.error(errno.ECONNRESET, "Connection reset")))
+        self.assertTrue(isTransient(socket.timeout("timed out")))
+        self.assertTrue(isTransient(httplib.BadStatusLine("")))
+
+    def testLocalErrors(self):
+        self.assertFalse(isTransient(IOError(errno.ENOENT, "No such file or directory")))
+        self.assertFalse(isTransient(IOError(errno.EACCES, "Permission denied")))
+        self.assertFalse(isTransient(OSError(errno.ENOENT, "No such file or directory")))
+
+    def testLocalErrorIsNotRetried(self):
+        calls = []
+        def fail():
+            calls.append(None)
+            raise IOError(errno.ENOENT, "No such file or directory")
+        self.assertRaises(IOError, RetryPolicy(base_delay=0).call, "Test", fail)
+        self.assertEqual(len(calls), 1)
+
+    def testStatuses(self):
+        for status, transient in ((503, True), (429, True), (404, False)):
+            error = gdata.client.RequestError("%d returned by server" % status)
+            error.status = status
+            error.body = ""
+            self.assertEqual(isTransient(error), transient)
+
+
+if __name__ == "__main__":
+    unittest.main()
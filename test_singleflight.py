@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Tests of SingleFlight. Run with: python -m unittest discover -p 'test_*.py'
+
+import threading, unittest
+
+from singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def testSharesCallsInFlight(self):
+        flights = SingleFlight(ttl=0)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def slow():
+            calls.append(None)
+            started.set()
+            release.wait()
+            return len(calls)
+        results = []
+        first = threading.Thread(target=lambda: results.append(flights.do(("k",), slow)))
+        first.start()
+        started.wait()
+        second = threading.Thread(target=lambda: results.append(flights.do(("k",), slow)))
+        second.start()
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(results, [1, 1])
+        self.assertEqual(len(calls), 1)
+
+    def testNoReuseWithoutTtl(self):
+        flights = SingleFlight(ttl=0)
+        counter = iter(range(10))
+        self.assertEqual(flights.do(("k",), counter.next), 0)
+        self.assertEqual(flights.do(("k",), counter.next), 1)
+
+    def testReuseWithTtl(self):
+        flights = SingleFlight(ttl=30)
+        counter = iter(range(1, 10))
+        self.assertEqual(flights.do(("k",), counter.next), 1)
+        self.assertEqual(flights.do(("k",), counter.next), 1)
+        flights.clear()
+        self.assertEqual(flights.do(("k",), counter.next), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Tests of the Tracer. Run with: python -m unittest discover -p 'test_*.py'
+
+import os, time, shutil, signal, tempfile, threading, unittest
+
+from tracing import Tracer
+
+
+class _Filesystem(object):
+    "Stands in for the filesystem whose calls are traced."
+
+    def getattr(self, path):
+        return path
+
+    def readdir(self, path):
+        for name in ("a", "b"):
+            time.sleep(0.01)
+            yield name
+
+
+class TracerTest(unittest.TestCase):
+
+    def testSamplesOneInInterval(self):
+        fs = _Filesystem()
+        tracer = Tracer(3)
+        tracer.instrument(fs, ("getattr",))
+        for n in range(7):
+            self.assertEqual(fs.getattr("/a"), "/a")
+        # The first call, and then every third one.
+        self.assertEqual(tracer._histograms["getattr"].count, 3)
+
+    def testTimesGeneratorUntilExhausted(self):
+        fs = _Filesystem()
+        tracer = Tracer()
+        tracer.instrument(fs, ("readdir",))
+        entries = fs.readdir("/")
+        self.assertEqual(tracer._histograms["readdir"].count, 0)
+        self.assertEqual(list(entries), ["a", "b"])
+        histogram = tracer._histograms["readdir"]
+        self.assertEqual(histogram.count, 1)
+        self.assertTrue(histogram.sum >= 0.02)
+
+    def testRender(self):
+        fs = _Filesystem()
+        tracer = Tracer(2)
+        tracer.instrument(fs, ("getattr", "readdir"))
+        tracer.record("getattr", ("/a",), 0.0003)
+        tracer.record("getattr", ("/b",), 0.02)
+        lines = tracer.render().splitlines()
+        self.assertEqual(lines[0], "Sampling 1 in 2 calls")
+        self.assertEqual(lines[2].split(), ["getattr", "2", "10.150", "0.50", "25.00"])
+        # Operations never sampled have no percentiles.
+        self.assertEqual(lines[3].split(), ["readdir", "0", "0.000", "-", "-"])
+        self.assertTrue("getattr latency:" in lines)
+        self.assertTrue("  <=     0.50 ms          1" in lines)
+        self.assertTrue("  <=    25.00 ms          1" in lines)
+
+
+class SignalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        shutil.rmtree(self.directory)
+
+    def testDumpsWhileMainThreadIsBlocked(self):
+        path = os.path.join(self.directory, "trace")
+        tracer = Tracer()
+        tracer.installSignalHandler(path)
+        dumped = []
+        blocked = threading.Lock()
+        blocked.acquire()
+        def unblock():
+            # Give the main thread time to block first.
+            time.sleep(0.05)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            deadline = time.time() + 5
+            while not os.path.exists(path) and time.time() < deadline:
+                time.sleep(0.01)
+            dumped.append(os.path.exists(path))
+            blocked.release()
+        thread = threading.Thread(target=unblock)
+        thread.start()
+        # Like the FUSE main loop, this waits in C, where Python signal handlers never run.
+        blocked.acquire()
+        thread.join()
+        self.assertEqual(dumped, [True])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Tests of the WorkQueue. Run with: python -m unittest discover -p 'test_*.py'
+
+import os, shutil, tempfile, unittest
+
+from workqueue import WorkQueue
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "queue")
+        self.queue = WorkQueue(self.path)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmpdir)
+
+    def reopen(self):
+        self.queue.close()
+        self.queue = WorkQueue(self.path)
+
+    def testUnacknowledgedSurvivesRestart(self):
+        self.queue.put("download", "/a", localpath="/tmp/a")
+        self.queue.get()
+        self.reopen()
+        op_id, item = self.queue.get()
+        self.assertEqual(item["path"], "/a")
+
+    def testReleaseDelaysRetry(self):
+        op_id = self.queue.put("download", "/a", localpath="/tmp/a")
+        self.queue.get()
+        self.assertTrue(self.queue.release(op_id))
+        self.assertEqual(self.queue.get(), None)
+        self.assertEqual(self.queue.getNumDue(), 0)
+        self.assertEqual(len(self.queue), 1)
+
+    def testDeadLetter(self):
+        self.queue.RETRY_DELAY = 0
+        op_id = self.queue.put("upload", "/a", localpath="/tmp/a", folder="/")
+        for n in range(WorkQueue.MAX_ATTEMPTS - 1):
+            self.assertEqual(self.queue.get()[0], op_id)
+            self.assertTrue(self.queue.release(op_id))
+        self.queue.get()
+        self.assertFalse(self.queue.release(op_id))
+        self.assertEqual(self.queue.get(), None)
+        self.assertEqual(len(self.queue), 0)
+        self.reopen()
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual([op_id], [dead_id for dead_id, item in self.queue.getDeadLetters()])
+        self.queue.clearDeadLetters()
+        self.reopen()
+        self.assertEqual(self.queue.getDeadLetters(), [])
+
+    def _deadLetter(self, path):
+        self.queue.RETRY_DELAY = 0
+        op_id = self.queue.put("upload", path, localpath="/tmp" + path, folder="/")
+        for n in range(WorkQueue.MAX_ATTEMPTS):
+            self.queue.get()
+            self.queue.release(op_id)
+        return op_id
+
+    def testRetryDeadLetters(self):
+        op_id = self._deadLetter("/a")
+        self._deadLetter("/b")
+        self.queue.put("upload", "/b", localpath="/tmp/b2", folder="/")
+        # The newer request for /b supersedes its dead letter.
+        self.assertEqual(self.queue.retryDeadLetters(), 1)
+        self.assertEqual(self.queue.getDeadLetters(), [])
+        self.reopen()
+        self.assertEqual(self.queue.getDeadLetters(), [])
+        self.assertEqual(len(self.queue), 2)
+        items = dict((item["path"], (retry_id, item)) for retry_id, item in [self.queue.get(), self.queue.get()])
+        self.assertEqual(items["/a"][0], op_id)
+        self.assertEqual(items["/b"][1]["localpath"], "/tmp/b2")
+        # A retried operation starts afresh.
+        self.assertTrue("attempts" not in items["/a"][1])
+
+    def testClearLeavesOutSuperseded(self):
+        self._deadLetter("/a")
+        self._deadLetter("/b")
+        self.queue.put("upload", "/b", localpath="/tmp/b2", folder="/")
+        self.assertEqual([item["path"] for item in self.queue.clearDeadLetters()], ["/a"])
+        self.assertEqual(self.queue.getDeadLetters(), [])
+        self.assertEqual(self.queue.get()[1]["localpath"], "/tmp/b2")
+
+    def testGetByOperation(self):
+        self.queue.put("download", "/a/b", localpath="/tmp/a/b")
+        self.queue.put("mkdir", "/a", localpath="/tmp/a")
+        op_id, item = self.queue.get(("delete", "mkdir"))
+        self.assertEqual(item["op"], "mkdir")
+        self.assertEqual(self.queue.get(("delete", "mkdir")), None)
+
+    def testSecondOpenerDoesNotOwnJournal(self):
+        self.queue.put("download", "/a", localpath="/tmp/a")
+        other = WorkQueue(self.path)
+        try:
+            self.assertTrue(self.queue.isOwner())
+            self.assertFalse(other.isOwner())
+            # The other queue must not have compacted the journal away.
+            self.assertEqual(len(other), 0)
+            other.put("download", "/b", localpath="/tmp/b")
+        finally:
+            other.close()
+        self.reopen()
+        self.assertEqual(len(self.queue), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
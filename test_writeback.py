@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+# Tests of WriteBack. Run with: python -m unittest discover -p 'test_*.py'
+
+import os, time, shutil, hashlib, tempfile, threading, unittest
+
+from workqueue import WorkQueue
+from writeback import WriteBack
+
+
+class _Session(object):
+    "Stands in for a Session, uploading the files on its work queue into a dict."
+
+    def __init__(self, queuepath):
+        self.queue = WorkQueue(queuepath)
+        self.remote = {}        ## Maps remote paths to the MD5 checksums of their content.
+        self.uploads = []       ## The (path, content) of each upload, in order.
+        self._stop = threading.Event()
+
+    def queueReplace(self, localpath, path):
+        self.queue.put("upload", path, localpath=localpath, folder=os.path.dirname(path),
+                       title=os.path.basename(path), replace=True)
+
+    def processQueue(self):
+        while True:
+            next_item = self.queue.get()
+            if next_item == None:
+                break
+            op_id, item = next_item
+            f = open(item["localpath"], 'rb')
+            data = f.read()
+            f.close()
+            self.uploads.append((item["path"], data))
+            self.remote[item["path"]] = hashlib.md5(data).hexdigest()
+            self.queue.ack(op_id)
+
+    def hasPendingWork(self, due=True):
+        return len(self.queue) > 0
+
+    def getItem(self, path):
+        if path not in self.remote:
+            return None
+        return { "md5checksum": self.remote[path] }
+
+    def requestStop(self):
+        self._stop.set()
+
+    def isStopping(self):
+        return self._stop.is_set()
+
+    def waitForStop(self, timeout):
+        self._stop.wait(timeout)
+        return self._stop.is_set()
+
+
+class WriteBackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmpdir, "staging")
+        self.session = _Session(os.path.join(self.tmpdir, "queue"))
+        self.writeback = WriteBack(self.session, self.directory, delay=0.1)
+
+    def tearDown(self):
+        self.session.queue.close()
+        shutil.rmtree(self.tmpdir)
+
+    def save(self, path, data):
+        "Write a file through the write-back, as a program saving it would."
+        handle = self.writeback.open(path, True, None)
+        handle.write(data, 0)
+        self.writeback.release(handle)
+
+    def testRepeatedSavesUploadOnce(self):
+        self.writeback.start()
+        try:
+            for n in range(3):
+                self.save("/a.txt", "version %d" % n)
+            deadline = time.time() + 5
+            while self.writeback.getLocalFile("/a.txt") != None and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            self.session.requestStop()
+            self.writeback.stop()
+        self.assertEqual(self.session.uploads, [("/a.txt", "version 2")])
+        # Once uploaded, the staged copy is removed.
+        self.assertEqual(self.writeback.getLocalFile("/a.txt"), None)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def testSweepKeepsNewerChanges(self):
+        self.save("/a.txt", "one")
+        self.session.processQueue()
+        # Saved again before the sweep: the remote file doesn't have this content yet.
+        self.save("/a.txt", "two")
+        self.writeback._sweep()
+        self.assertNotEqual(self.writeback.getLocalFile("/a.txt"), None)
+        reader = self.writeback.openRead("/a.txt")
+        self.assertEqual(reader.read(0, 10), "two")
+        reader.close()
+        self.session.processQueue()
+        self.writeback._sweep()
+        self.assertEqual(self.writeback.getLocalFile("/a.txt"), None)
+        self.assertEqual([data for path, data in self.session.uploads], ["one", "two"])
+
+    def testRestartResumesAndCleansUp(self):
+        self.save("/a.txt", "saved")
+        # A file still open for writing when the process dies leaves its working copy.
+        handle = self.writeback.open("/b.txt", True, None)
+        handle.write("unsaved", 0)
+        handle.close()
+        self.session.queue.close()
+        self.session = _Session(os.path.join(self.tmpdir, "queue"))
+        self.writeback = WriteBack(self.session, self.directory, delay=0.1)
+        self.assertEqual(os.listdir(self.directory), ["%2Fa.txt"])
+        self.assertEqual(self.writeback.listFolder("/"), ["/a.txt"])
+        # The upload queued before the restart carries on, and its staged copy is then removed.
+        self.session.processQueue()
+        self.writeback._sweep()
+        self.assertEqual(self.session.uploads, [("/a.txt", "saved")])
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import os, time, json, hashlib, logging, datetime, threading
+
+import metrics
+
+
+class TokenManager(object):
+    """Keeps the access token of an OAuth 2.0 token valid, and caches it between runs.
+
+    The access token and its expiry are saved to a sidecar file, so that a new session can use
+    it without first refreshing it. A token that is close to expiry is refreshed in the background
+    while requests continue to use it; an expired one is refreshed before the request is sent.
+    Only one refresh is made at a time, and requests that fail with 401 while a refresh is in
+    progress wait for it and share its result.
+    """
+
+    REFRESH_MARGIN = 300        # Refresh this many seconds before the access token expires.
+
+    def __init__(self, token, cachefile):
+        "Class constructor."
+        self._token = token
+        self._cachefile = cachefile
+        self._lock = threading.Lock()           ## Serialises refreshes.
+        self._refreshing = threading.Event()    ## Set while a background refresh is running.
+        self._request = None                    ## The unauthorised request method of the client.
+        self._expiry = None                     ## The access token expiry time, in seconds since the epoch.
+
+    def _getRefreshTokenHash(self):
+        "Return a digest of the refresh token, identifying the grant a cached access token belongs to."
+        return hashlib.sha1(self._token.refresh_token or '').hexdigest()
+
+    def load(self):
+        "Use the cached access token, if it belongs to the current refresh token and has not expired."
+        if not os.path.exists(self._cachefile):
+            return False
+        try:
+            f = open(self._cachefile, 'r')
+            try:
+                cache = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            logging.warn("Ignoring unreadable access token cache: %s" % e)
+            return False
+        if cache.get("refresh_token_hash") != self._getRefreshTokenHash():
+            logging.debug("Cached access token belongs to another grant")
+            return False
+        if cache.get("expiry", 0) <= time.time():
+            logging.debug("Cached access token has expired")
+            return False
+        logging.debug("Using cached access token")
+        self._token.access_token = cache["access_token"]
+        self._token.token_expiry = datetime.datetime.fromtimestamp(cache["expiry"])
+        self._expiry = cache["expiry"]
+        return True
+
+    def save(self):
+        "Save the access token and its expiry to the cache file."
+        if not self._token.access_token:
+            return
+        expiry = getattr(self._token, "token_expiry", None)
+        if expiry is None:
+            return
+        self._expiry = time.mktime(expiry.timetuple())
+        cache = { "access_token": self._token.access_token,
+                  "expiry": self._expiry,
+                  "refresh_token_hash": self._getRefreshTokenHash() }
+        tmpfile = self._cachefile + ".tmp"
+        # The access token is a credential, so keep it private.
+        fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(cache, f)
+        finally:
+            f.close()
+        os.rename(tmpfile, self._cachefile)
+
+    def refresh(self, stale):
+        """Refresh the access token, unless it has already been replaced since the stale token
+           was seen. Returns False if the token could not be refreshed."""
+        with self._lock:
+            if self._token.access_token != stale:
+                # Another thread refreshed it while we were waiting.
+                return True
+            logging.debug("Refreshing access token...")
+            # A failed refresh marks the token invalid for good, but the failure may have been temporary.
+            self._token._invalid = False
+            with metrics.timer("gdrive_token_refresh_seconds"):
+                response = self._token._refresh(self._request)
+            if self._token.invalid:
+                logging.error("Failed to refresh access token: %s %s" % (response.status, response.reason))
+                metrics.increment("gdrive_token_refreshes_total", result="failed")
+                return False
+            metrics.increment("gdrive_token_refreshes_total", result="ok")
+            try:
+                self.save()
+            except (IOError, OSError), e:
+                logging.warn("Failed to cache access token: %s" % e)
+            return True
+
+    def _refreshInBackground(self):
+        "Start refreshing the access token on another thread, if that isn't already happening."
+        if self._refreshing.is_set():
+            return
+        self._refreshing.set()
+        stale = self._token.access_token
+        def run():
+            try:
+                self.refresh(stale)
+            except Exception:
+                logging.exception("Background token refresh failed:")
+            finally:
+                self._refreshing.clear()
+        thread = threading.Thread(target=run, name="token-refresh")
+        thread.daemon = True
+        thread.start()
+
+    def _ensureFresh(self):
+        "Make sure that a request about to be sent has a usable access token."
+        if not self._token.access_token or self._expiry is None:
+            self.refresh(self._token.access_token)
+            return
+        remaining = self._expiry - time.time()
+        if remaining <= 0:
+            self.refresh(self._token.access_token)
+        elif remaining < self.REFRESH_MARGIN:
+            self._refreshInBackground()
+
+    def authorize(self, client):
+        "Authorise a gdata client with the token. Use instead of the token's own authorize() method."
+        client.auth_token = self._token
+        request = self._request = client.http_client.request
+
+        def authorised_request(http_request):
+            self._ensureFresh()
+            self._token.modify_request(http_request)
+            used = self._token.access_token
+            response = request(http_request)
+            if response.status != 401:
+                return response
+            # The token was revoked or expired early.
+            if not self.refresh(used):
+                return response
+            response.read()
+            self._token.modify_request(http_request)
+            return request(http_request)
+
+        client.http_client.request = authorised_request
+        return client
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import os, time, fcntl, errno, signal, logging, threading, itertools, types
+
+from metrics import Histogram
+
+
+# Latency histogram bucket upper bounds, in seconds. Calls answered from memory take microseconds.
+TRACE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Tracer(object):
+    """Records sampled latency histograms of calls to the methods of an object.
+
+    Methods are instrumented by replacing them on the instance with timing wrappers, so an object
+    that is never instrumented pays nothing for tracing. One in every sample_interval calls of each
+    method is timed; a generator (e.g. from readdir) is timed until it is exhausted. With debug
+    logging on, each sampled call is also logged.
+    """
+
+    def __init__(self, sample_interval=1):
+        "Class constructor."
+        self._sample_interval = max(sample_interval, 1)
+        self._lock = threading.Lock()
+        self._calls = {}        ## Call counters used to pick the calls to sample, keyed by method name.
+        self._histograms = {}   ## Latency histograms of sampled calls, keyed by method name.
+        self._log = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    def instrument(self, obj, names):
+        "Replace the named methods of obj with traced versions."
+        for name in names:
+            self._calls[name] = itertools.count()
+            self._histograms[name] = Histogram(TRACE_BUCKETS)
+            setattr(obj, name, self._wrap(name, getattr(obj, name)))
+
+    def _wrap(self, name, func):
+        "Return a traced version of a bound method."
+        calls = self._calls[name]
+        interval = self._sample_interval
+        def traced(*args):
+            # itertools.count is atomic, so no lock is needed to pick the calls to sample.
+            if calls.next() % interval:
+                return func(*args)
+            start = time.time()
+            result = func(*args)
+            if isinstance(result, types.GeneratorType):
+                return self._drain(name, args, start, result)
+            self.record(name, args, time.time() - start)
+            return result
+        return traced
+
+    def _drain(self, name, args, start, generator):
+        "Pass on the items of a generator, recording the time taken once it is exhausted."
+        for item in generator:
+            yield item
+        self.record(name, args, time.time() - start)
+
+    def record(self, name, args, elapsed):
+        "Record the latency of a sampled call."
+        with self._lock:
+            self._histograms[name].observe(elapsed)
+        if self._log:
+            logging.debug("%s%r took %.3f ms" % (name, args, elapsed * 1000))
+
+    def render(self):
+        "Return a table of the latency histograms."
+        lines = []
+        lines.append("Sampling 1 in %d calls" % self._sample_interval)
+        lines.append("%-10s %10s %10s %10s %10s" % ("operation", "sampled", "mean ms", "p50 ms", "p99 ms"))
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            for name, histogram in histograms:
+                mean = histogram.count and histogram.sum / histogram.count
+                lines.append("%-10s %10d %10.3f %10s %10s" % (name, histogram.count, mean * 1000,
+                                                              self._percentile(histogram, 0.5),
+                                                              self._percentile(histogram, 0.99)))
+            for name, histogram in histograms:
+                lines.append("")
+                lines.append("%s latency:" % name)
+                previous = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append("  <= %8.2f ms %10d" % (bound * 1000, count - previous))
+                    previous = count
+                lines.append("   > %8.2f ms %10d" % (histogram.buckets[-1] * 1000, histogram.count - previous))
+        lines.append("")
+        return "\n".join(lines)
+
+    def _percentile(self, histogram, fraction):
+        "Return the upper bound of the bucket holding the specified fraction of samples, as a string in ms."
+        if not histogram.count:
+            return "-"
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            if count >= fraction * histogram.count:
+                return "%.2f" % (bound * 1000)
+        return ">%.0f" % (histogram.buckets[-1] * 1000)
+
+    def dump(self, path):
+        "Write the latency histograms to a file."
+        f = open(path, 'w')
+        f.write(self.render())
+        f.close()
+        logging.info("Wrote trace to %s" % path)
+
+    def installSignalHandler(self, path, signum=signal.SIGUSR1):
+        """Dump the latency histograms to a file on a signal. Must be called from the main thread.
+           Python signal handlers only run once the main thread is back in Python code, which the FUSE
+           main loop never returns to, so the dump is written by a thread woken through a pipe instead.
+           Other signals with Python handlers also wake it, and so also write a dump."""
+        rfd, wfd = os.pipe()
+        fcntl.fcntl(wfd, fcntl.F_SETFL, fcntl.fcntl(wfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        # The handler does nothing itself. Installing it makes the interpreter write to the wakeup pipe.
+        signal.signal(signum, lambda signum, frame: None)
+        # Don't let the signal interrupt system calls in progress.
+        signal.siginterrupt(signum, False)
+        signal.set_wakeup_fd(wfd)
+        thread = threading.Thread(target=self._watch, args=(rfd, path), name="trace-dump")
+        thread.daemon = True
+        thread.start()
+
+    def _watch(self, fd, path):
+        "Write a dump each time the wakeup pipe is written to. Signals arriving together share a dump."
+        while True:
+            try:
+                if not os.read(fd, 512):
+                    break
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            try:
+                self.dump(path)
+            except (IOError, OSError), e:
+                logging.error("Failed to write trace to %s: %s" % (path, e))
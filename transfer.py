@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import sys, time, logging, threading, collections
+
+import ratelimit
+
+
+CHUNK_SIZE = 64 * 1024      # Transfer chunk size in bytes.
+
+
+class BandwidthLimiter(object):
+    "A token bucket limiting the aggregate transfer rate, shared by all workers."
+
+    def __init__(self, rate=0):
+        "Class constructor. A rate of zero disables limiting."
+        self._rate = rate           ## Bytes per second.
+        self._tokens = rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        "Block until the specified number of bytes may be transferred."
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self._rate, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= nbytes or self._tokens >= self._rate:
+                    self._tokens -= nbytes
+                    return
+                delay = float(nbytes - self._tokens) / self._rate
+            time.sleep(min(delay, 1.0))
+
+
+class Transfer(object):
+    "A unit of work queued on a TransferPool."
+
+    def __init__(self, func, args, kwargs):
+        "Class constructor."
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._lane = ratelimit.currentLane(None)    ## Request lane of the submitting thread, if it set one.
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def run(self):
+        "Run the transfer in the lane it was submitted from, recording its result or exception."
+        try:
+            if self._lane is None:
+                self._result = self._func(*self._args, **self._kwargs)
+            else:
+                with ratelimit.lane(self._lane):
+                    self._result = self._func(*self._args, **self._kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+    def wait(self):
+        "Wait for the transfer to complete, and return its result."
+        self._done.wait()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class TransferPool(object):
+    "A pool of transfer workers shared by several accounts, serving them round-robin."
+
+    def __init__(self, workers=4, bandwidth=0):
+        "Class constructor."
+        self.limiter = BandwidthLimiter(bandwidth)
+        self._queues = collections.OrderedDict()    ## Maps account names to queues of pending transfers.
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        for n in range(workers):
+            thread = threading.Thread(target=self._work, name="transfer-%d" % n)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, account, func, *args, **kwargs):
+        "Queue a transfer on behalf of the specified account."
+        transfer = Transfer(func, args, kwargs)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Transfer pool is stopped")
+            self._queues.setdefault(account, collections.deque()).append(transfer)
+            self._cond.notify()
+        return transfer
+
+    def getQueueDepth(self):
+        "Return the number of queued transfers."
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.itervalues())
+
+    def _next(self):
+        "Return the next transfer, taking turns between accounts. Must hold the lock."
+        for account in self._queues.keys():
+            queue = self._queues.pop(account)
+            if queue:
+                transfer = queue.popleft()
+                # Move the account to the back of the line.
+                self._queues[account] = queue
+                return transfer
+        return None
+
+    def _work(self):
+        "Worker thread main loop."
+        while True:
+            with self._cond:
+                transfer = self._next()
+                while transfer is None:
+                    if self._stopped:
+                        return
+                    self._cond.wait()
+                    transfer = self._next()
+            transfer.run()
+
+    def stop(self, timeout=None):
+        "Stop the workers once the queued transfers have completed."
+        with self._cond:
+            self._stopped = True
+            self._cond.notifyAll()
+        for thread in self._threads:
+            thread.join(timeout)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import os, json, logging, threading, collections, time, fcntl
+
+
+class WorkQueue(object):
+    """A durable queue of pending sync operations, backed by an append-only journal.
+
+    Each operation is a dict with at least an "op" key (download, mkdir, delete or upload).
+    Operations taken with get() must be acknowledged with ack() once complete, or returned
+    with release() on failure. Operations that were taken but not acknowledged when the
+    process died are pending again when the journal is next opened.
+
+    A failed operation is retried with an increasing delay, and after MAX_ATTEMPTS failures
+    it is moved to a dead-letter list, so that one bad operation cannot block the queue.
+
+    Only one process at a time may own the journal. Any other process sharing the same path
+    gets a queue that is held in memory only.
+    """
+
+    OPERATIONS = ("download", "mkdir", "delete", "upload")
+
+    MAX_ATTEMPTS = 5        ## Failures before an operation is dead-lettered.
+    RETRY_DELAY = 30        ## Seconds before the first retry of a failed operation, doubling after that.
+
+    def __init__(self, path):
+        "Class constructor."
+        self._path = path
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()   ## Maps operation IDs to operations.
+        self._inflight = {}                         ## Operations taken but not yet acknowledged.
+        self._keys = {}                             ## Maps (op, path) to operation IDs, to coalesce duplicates.
+        self._dead = collections.OrderedDict()      ## Operations that failed too many times.
+        self._retry_at = {}                         ## Maps operation IDs to the earliest time of their next attempt.
+        self._checkpoint = None
+        self._next_id = 1
+        self._journal = None
+        self._owner = open(path + ".lock", 'a')
+        try:
+            fcntl.flock(self._owner.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logging.warn("Work queue \"%s\" is in use by another process, queued operations will not persist" % path)
+            self._owner.close()
+            self._owner = None
+            return
+        self._replay()
+        self._compact()
+
+    def _replay(self):
+        "Rebuild the queue state from the journal."
+        if not os.path.exists(self._path):
+            return
+        f = open(self._path, 'r')
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn write at the end of the journal, from a crash.
+                logging.warn("Ignoring corrupt work queue journal record")
+                continue
+            if record["type"] == "add":
+                # A dead-lettered operation is added again when it is retried.
+                self._dead.pop(record["id"], None)
+                self._pending[record["id"]] = record["item"]
+                self._keys[self._getKey(record["item"])] = record["id"]
+                self._next_id = max(self._next_id, record["id"] + 1)
+            elif record["type"] == "release":
+                if record["id"] in self._pending:
+                    self._pending[record["id"]]["attempts"] = record["attempts"]
+            elif record["type"] in ("ack", "dead"):
+                item = self._pending.pop(record["id"], None)
+                if record["type"] == "ack":
+                    self._dead.pop(record["id"], None)
+                if item:
+                    self._keys.pop(self._getKey(item), None)
+                    if record["type"] == "dead":
+                        self._dead[record["id"]] = item
+            elif record["type"] == "checkpoint":
+                self._checkpoint = record["value"]
+        f.close()
+        if self._pending:
+            logging.info("Resuming %d pending operations" % len(self._pending))
+
+    def _compact(self):
+        "Rewrite the journal with only the outstanding operations. Must own the journal."
+        tmppath = self._path + ".tmp"
+        f = open(tmppath, 'w')
+        if self._checkpoint is not None:
+            f.write(json.dumps({ "type": "checkpoint", "value": self._checkpoint }) + "\n")
+        for op_id, item in self._pending.iteritems():
+            f.write(json.dumps({ "type": "add", "id": op_id, "item": item }) + "\n")
+        for op_id, item in self._dead.iteritems():
+            f.write(json.dumps({ "type": "add", "id": op_id, "item": item }) + "\n")
+            f.write(json.dumps({ "type": "dead", "id": op_id }) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmppath, self._path)
+        self._journal = open(self._path, 'a')
+
+    def _write(self, record):
+        "Append a record to the journal, if this process owns it. Must hold the lock."
+        if self._journal == None:
+            return
+        self._journal.write(json.dumps(record) + "\n")
+        self._journal.flush()
+
+    def _getKey(self, item):
+        return (item["op"], item.get("path"))
+
+    def put(self, op, path, **args):
+        "Queue an operation, and return its ID. A duplicate of a pending operation replaces it."
+        if op not in self.OPERATIONS:
+            raise ValueError("Unknown operation \"%s\"" % op)
+        item = dict(args)
+        item["op"] = op
+        item["path"] = path
+        with self._lock:
+            op_id = self._keys.get(self._getKey(item))
+            if op_id in self._pending:
+                # A new request starts afresh, rather than inheriting the failures of the one it replaces.
+                self._pending[op_id] = item
+                self._retry_at.pop(op_id, None)
+            else:
+                op_id = self._next_id
+                self._next_id += 1
+                self._pending[op_id] = item
+                self._keys[self._getKey(item)] = op_id
+            self._write({ "type": "add", "id": op_id, "item": item })
+        return op_id
+
+    def get(self, ops=None):
+        """Take the next pending operation that is due, returning an (ID, operation) tuple, or None if there are none.
+           If ops is specified, only operations of those types are taken."""
+        with self._lock:
+            now = time.time()
+            for op_id, item in self._pending.iteritems():
+                if ops != None and item["op"] not in ops:
+                    continue
+                if self._retry_at.get(op_id, 0) > now:
+                    continue
+                del self._pending[op_id]
+                self._retry_at.pop(op_id, None)
+                self._inflight[op_id] = item
+                return op_id, item
+            return None
+
+    def getNumDue(self):
+        "Return the number of pending operations that are due to be run."
+        with self._lock:
+            now = time.time()
+            return len([op_id for op_id in self._pending if self._retry_at.get(op_id, 0) <= now])
+
+    def ack(self, op_id):
+        "Acknowledge that an operation has completed."
+        with self._lock:
+            item = self._inflight.pop(op_id)
+            if self._keys.get(self._getKey(item)) == op_id:
+                del self._keys[self._getKey(item)]
+            self._write({ "type": "ack", "id": op_id })
+            if not self._pending and not self._inflight and self._journal != None:
+                # Nothing outstanding, so the journal can start afresh.
+                self._journal.close()
+                self._compact()
+
+    def release(self, op_id):
+        """Return a failed operation to the queue, to be retried after a delay.
+           Returns False if it has failed too many times, and has been dead-lettered instead."""
+        with self._lock:
+            item = self._inflight.pop(op_id)
+            if self._keys.get(self._getKey(item)) != op_id:
+                # Superseded by a newer request for the same path.
+                return True
+            attempts = item.get("attempts", 0) + 1
+            item["attempts"] = attempts
+            if attempts >= self.MAX_ATTEMPTS:
+                logging.error("Giving up on %s of \"%s\" after %d attempts" % (item["op"], item["path"], attempts))
+                del self._keys[self._getKey(item)]
+                self._dead[op_id] = item
+                self._write({ "type": "dead", "id": op_id })
+                return False
+            self._pending[op_id] = item
+            self._retry_at[op_id] = time.time() + self.RETRY_DELAY * 2 ** (attempts - 1)
+            self._write({ "type": "release", "id": op_id, "attempts": attempts })
+            return True
+
+    def getDeadLetters(self):
+        "Return a list of the (ID, operation) tuples that have been given up on."
+        with self._lock:
+            return self._dead.items()
+
+    def retryDeadLetters(self):
+        """Return the operations that have been given up on to the queue, to be retried afresh.
+           An operation superseded by a newer request for the same path is discarded. Returns the number retried."""
+        with self._lock:
+            count = 0
+            for op_id, item in self._dead.iteritems():
+                if self._getKey(item) in self._keys:
+                    self._write({ "type": "ack", "id": op_id })
+                    continue
+                item.pop("attempts", None)
+                self._pending[op_id] = item
+                self._keys[self._getKey(item)] = op_id
+                self._write({ "type": "add", "id": op_id, "item": item })
+                count += 1
+            self._dead.clear()
+            return count
+
+    def clearDeadLetters(self):
+        """Discard the operations that have been given up on. Returns a list of them, leaving out any
+           superseded by a newer request for the same path."""
+        with self._lock:
+            items = []
+            for op_id, item in self._dead.iteritems():
+                self._write({ "type": "ack", "id": op_id })
+                if self._getKey(item) not in self._keys:
+                    items.append(item)
+            self._dead.clear()
+            return items
+
+    def setCheckpoint(self, value):
+        "Durably record a checkpoint value (e.g. a changestamp) with the queued operations."
+        with self._lock:
+            self._checkpoint = value
+            self._write({ "type": "checkpoint", "value": value })
+            if self._journal != None:
+                os.fsync(self._journal.fileno())
+
+    def getCheckpoint(self):
+        "Return the last checkpoint value, or None."
+        return self._checkpoint
+
+    def sync(self):
+        "Flush the journal to disk."
+        with self._lock:
+            if self._journal != None:
+                os.fsync(self._journal.fileno())
+
+    def isOwner(self):
+        "Return True if this process owns the journal."
+        return self._owner != None
+
+    def close(self):
+        "Close the journal, and give up ownership of it."
+        with self._lock:
+            if self._journal != None:
+                self._journal.close()
+                self._journal = None
+            if self._owner != None:
+                self._owner.close()
+                self._owner = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending) + len(self._inflight)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Jim Lawton. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This code is part of gdrive-linux (https://code.google.com/p/gdrive-linux/).
+
+import os, time, errno, urllib, hashlib, logging, threading, itertools
+
+import ratelimit
+
+
+CHUNK_SIZE = 4 * 1024 * 1024    # Size of the ranged reads used to copy a remote file into the staging area.
+RETRY_INTERVAL = 60             # Seconds to wait before retrying failed uploads.
+
+
+class StagedFile(object):
+    "An open handle on a local copy of a remote file: a private working copy, or else a staged version for reading."
+
+    def __init__(self, path, workpath, mode='r+b'):
+        "Class constructor."
+        self.path = path            ## Remote path of the file.
+        self.workpath = workpath    ## Local path of the copy.
+        self.dirty = False          ## True once the file has been changed.
+        self._lock = threading.Lock()
+        self._file = open(workpath, mode)
+
+    def read(self, offset, length):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+    def write(self, data, offset):
+        with self._lock:
+            self._file.seek(offset)
+            self._file.write(data)
+            self.dirty = True
+        return len(data)
+
+    def truncate(self, length):
+        with self._lock:
+            self._file.truncate(length)
+            self.dirty = True
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class WriteBack(object):
+    """Stages files written through the mount on local disk, and uploads them in the background.
+
+    Each handle open for writing works on a private copy of the file. When a changed file is closed
+    its copy replaces the staged version of the file, which is queued for upload through the
+    session's work queue. Uploads start once no file has been closed for delay seconds; a file
+    saved again while its upload is still queued is only uploaded once. A staged file is kept,
+    and served to readers, until the session's metadata shows the remote file with the same
+    content. Staged files are named after their remote paths, so uploads interrupted by a restart
+    carry on from the queue and are cleaned up afterwards.
+    """
+
+    def __init__(self, session, directory, delay=2):
+        "Class constructor."
+        self._session = session
+        self._directory = directory
+        self._delay = delay
+        self._lock = threading.Lock()
+        self._handles = {}                  ## Handles open for writing, keyed by remote path.
+        self._counter = itertools.count()   ## Numbers the working copies.
+        self._pending = threading.Event()   ## Set when there are uploads to run.
+        self._released = 0                  ## Time at which a changed file was last closed.
+        self._thread = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        for name in os.listdir(directory):
+            if name.endswith(".tmp"):
+                # Working copies of files that were never closed.
+                os.remove(os.path.join(directory, name))
+
+    def _getStagedPath(self, path):
+        "Return the local path of the staged version of a remote file."
+        return os.path.join(self._directory, urllib.quote(path, safe=''))
+
+    def getLocalFile(self, path):
+        "Return the local copy of a remote file holding changes not yet uploaded, or None."
+        with self._lock:
+            handles = self._handles.get(path)
+            if handles:
+                return handles[-1].workpath
+        staged = self._getStagedPath(path)
+        if os.path.exists(staged):
+            return staged
+        return None
+
+    def listFolder(self, path):
+        "Return the remote paths of the files with local changes in the specified folder."
+        paths = set()
+        with self._lock:
+            paths.update(self._handles)
+        for name in os.listdir(self._directory):
+            if not name.endswith(".tmp"):
+                paths.add(urllib.unquote(name))
+        return sorted(p for p in paths if os.path.dirname(p) == path)
+
+    def open(self, path, truncate, item):
+        "Open a remote file for writing, starting from its current content unless truncate is True."
+        workpath = "%s.%d.tmp" % (self._getStagedPath(path), self._counter.next())
+        staged = self.getLocalFile(path)
+        f = open(workpath, 'wb')
+        try:
+            if truncate:
+                pass
+            elif staged != None:
+                src = open(staged, 'rb')
+                try:
+                    while True:
+                        data = src.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        f.write(data)
+                finally:
+                    src.close()
+            elif item != None:
+                size = int(item.get("size") or 0)
+                for start in xrange(0, size, CHUNK_SIZE):
+                    f.write(self._session.fetchRange(item["uri"], start, min(start + CHUNK_SIZE, size)))
+        except:
+            f.close()
+            os.remove(workpath)
+            raise
+        f.close()
+        handle = StagedFile(path, workpath)
+        # A file that is created or truncated is changed even if it is never written to.
+        handle.dirty = truncate
+        with self._lock:
+            self._handles.setdefault(path, []).append(handle)
+        return handle
+
+    def openRead(self, path):
+        "Open the local copy of a remote file holding changes not yet uploaded for reading, or return None."
+        localpath = self.getLocalFile(path)
+        if localpath == None:
+            return None
+        try:
+            return StagedFile(path, localpath, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Uploaded and removed since we looked.
+            return None
+
+    def release(self, handle):
+        "Close a file, queueing its upload if it was open for writing and was changed."
+        handle.close()
+        with self._lock:
+            if handle not in self._handles.get(handle.path, ()):
+                # Opened for reading.
+                return
+            handles = self._handles[handle.path]
+            handles.remove(handle)
+            if not handles:
+                del self._handles[handle.path]
+            if not handle.dirty:
+                os.remove(handle.workpath)
+                return
+            staged = self._getStagedPath(handle.path)
+            os.rename(handle.workpath, staged)
+            self._released = time.time()
+        self._session.queueReplace(staged, handle.path)
+        self._pending.set()
+
+    def start(self):
+        "Start uploading in the background, beginning with any uploads left from an earlier run."
+        self._thread = threading.Thread(target=self._run, name="writeback")
+        self._thread.daemon = True
+        self._thread.start()
+        self._pending.set()
+
+    def stop(self):
+        "Wait for the upload thread to exit, once the session has been asked to stop."
+        self._pending.set()
+        self._thread.join()
+
+    def _run(self):
+        "Upload thread main loop."
+        # Uploads give way to requests that someone is waiting for.
+        with ratelimit.lane(ratelimit.BACKGROUND):
+            while not self._session.isStopping():
+                # Uploads queued from elsewhere, e.g. failed ones retried from the command line, don't set the event.
+                self._pending.wait(RETRY_INTERVAL)
+                # Wait for writers to settle, so that a burst of saves of a file is uploaded once.
+                while True:
+                    with self._lock:
+                        idle = time.time() - self._released
+                    if idle >= self._delay:
+                        break
+                    time.sleep(self._delay - idle)
+                self._pending.clear()
+                try:
+                    self._session.processQueue()
+                    self._sweep()
+                except Exception, e:
+                    logging.error("Background upload failed: %s" % e)
+                if self._session.hasPendingWork(due=False):
+                    # Failed uploads stay queued, so try them again later.
+                    self._session.waitForStop(RETRY_INTERVAL)
+                    self._pending.set()
+
+    def _getChecksum(self, localpath):
+        "Return the MD5 checksum of a local file."
+        m = hashlib.md5()
+        f = open(localpath, 'rb')
+        try:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                m.update(data)
+        finally:
+            f.close()
+        return m.hexdigest()
+
+    def _sweep(self):
+        "Remove the staged files whose content has reached the server."
+        for name in os.listdir(self._directory):
+            if name.endswith(".tmp"):
+                continue
+            path = urllib.unquote(name)
+            item = self._session.getItem(path)
+            if item == None or "md5checksum" not in item:
+                continue
+            staged = os.path.join(self._directory, name)
+            with self._lock:
+                # Hold the lock so that a file closed meanwhile isn't lost.
+                try:
+                    if self._getChecksum(staged) == item["md5checksum"]:
+                        logging.debug("Upload of %s is complete" % path)
+                        os.remove(staged)
+                except (IOError, OSError), e:
+                    if e.errno != errno.ENOENT:
+                        raise